@@ -0,0 +1,825 @@
+# Benchmark.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import os
+import sys
+import time
+import random
+import select
+import signal
+import socket
+import timeit
+import resource
+import threading
+import subprocess
+
+from InstantProtocol import *
+from Scheduler import *
+from ReliableSession import *
+from SessionDirectory import *
+from ReceiveRing import *
+from UserListSnapshot import *
+from Reassembly import *
+from IdAllocator import *
+from Metrics import *
+from SocketError import *
+
+# One message of each type (as they travel through the network)
+SAMPLE_MESSAGES = [
+    {'type': ConnectionRequest.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'username': 'erika'}},
+    {'type': ConnectionAccept.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'client_id': 12}},
+    {'type': ConnectionReject.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'error': 1}},
+    {'type': UserListRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 12, 'group_id': 0x01},
+    {'type': UserListResponse.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x01, 'options': {'user_list': [
+        {'client_id': i, 'group_id': 0x01, 'username': 'user{}'.format(i), 'ip_address': '127.0.0.1', 'port': 2000 + i} for i in range(1, 21)]}},
+    {'type': DataMessage.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 12, 'group_id': 0x01, 'options': {'data_length': 11, 'payload': 'hello world'}},
+    {'type': GroupCreationRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 12, 'group_id': 0x00, 'options': {'type': 1, 'client_ids': [3, 4, 5]}},
+    {'type': GroupCreationAccept.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'type': 1, 'group_id': 7}},
+    {'type': GroupCreationReject.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00},
+    {'type': GroupInvitationRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 12, 'group_id': 0x00, 'options': {'type': 0, 'group_id': 7, 'client_id': 4}},
+    {'type': GroupInvitationAccept.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 4, 'group_id': 0x00, 'options': {'type': 0, 'group_id': 7}},
+    {'type': GroupInvitationReject.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 4, 'group_id': 0x00, 'options': {'type': 0, 'group_id': 7}},
+    {'type': GroupDisjointRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 4, 'group_id': 0x00},
+    {'type': GroupDissolution.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x01},
+    {'type': UpdateList.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 0x00, 'group_id': 0xFF, 'options': {'user_list': [
+        {'client_id': 3, 'group_id': 7, 'username': 'jesus', 'ip_address': '10.0.0.3', 'port': 4444}]}},
+    {'type': UpdateDisconnection.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0xFF, 'options': {'client_id': 3}},
+    {'type': DisconnectionRequest.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 12, 'group_id': 0x00},
+    {'type': DataMessage.TYPE, 'sequence': 1, 'ack': 1, 'source_id': 0x00, 'group_id': 0x00},
+]
+
+def _rate(function, number):
+    # Best of three runs (operations per second)
+    return number / min(timeit.repeat(function, number=number, repeat=3))
+
+# Messages decoded/encoded per second for each message type (header only as routing does, then with options)
+def bench_codec(number=20000):
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('type', 'header/s', 'decode/s', 'encode/s'))
+    for dictdata in SAMPLE_MESSAGES:
+        message = InstantProtocolMessage(dictdata=dictdata)
+        rawdata = message.serialize()
+        header = _rate(lambda: InstantProtocolMessage(rawdata=rawdata), number)
+        decode = _rate(lambda: InstantProtocolMessage(rawdata=rawdata).options, number)
+        encode = _rate(lambda: InstantProtocolMessage(dictdata=dictdata).serialize(), number)
+        name = 'Acknowledgement' if message.ack else message.options.__class__.__name__
+        print('{0:<24}{1:>16.0f}{2:>16.0f}{3:>16.0f}'.format(name, header, decode, encode))
+    # Mixed traffic (one datagram of each type)
+    datagrams = [InstantProtocolMessage(dictdata=dictdata).serialize() for dictdata in SAMPLE_MESSAGES]
+    header = _rate(lambda: [InstantProtocolMessage(rawdata=rawdata) for rawdata in datagrams], number / 10) * len(datagrams)
+    decode = _rate(lambda: [InstantProtocolMessage(rawdata=rawdata).options for rawdata in datagrams], number / 10) * len(datagrams)
+    print('{0:<24}{1:>16.0f}{2:>16.0f}'.format('mixed', header, decode))
+    # Same traffic decoded in place from a receive buffer
+    buffers = [memoryview(bytearray(rawdata)) for rawdata in datagrams]
+    header = _rate(lambda: [InstantProtocolMessage(rawdata=rawdata) for rawdata in buffers], number / 10) * len(buffers)
+    decode = _rate(lambda: [InstantProtocolMessage(rawdata=rawdata).options for rawdata in buffers], number / 10) * len(buffers)
+    print('{0:<24}{1:>16.0f}{2:>16.0f}'.format('mixed (memoryview)', header, decode))
+
+# User List Response of a full server (255 users), with and without the records cached by the sessions, and the snapshot of the server
+def bench_user_list(number=2000, users=255):
+    user_list = [{'client_id': i, 'group_id': 0x01, 'username': 'user{}'.format(i), 'ip_address': '10.0.{}.{}'.format(i / 256, i % 256), 'port': 2000 + i} for i in range(users)]
+    cached_list = [dict(user, record=UserListResponse.pack_record(user)) for user in user_list]
+    print('{0:<24}{1:>16}'.format('records', 'encode/s'))
+    for name, entries in (('packed', user_list), ('cached', cached_list)):
+        encode = _rate(lambda: InstantProtocolMessage(dictdata={'type': UserListResponse.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x01,
+                                                                'options': {'user_list': entries}}).serialize(), number)
+        print('{0:<24}{1:>16.0f}'.format(name, encode))
+    sessions = SessionDirectory()
+    for user in cached_list:
+        session = _DirectorySession(user['client_id'])
+        session.user_info = (lambda user=user: user)
+        sessions.add(session)
+    snapshot = UserListSnapshot(sessions)
+    print('{0:<24}{1:>16.0f}'.format('snapshot', _rate(lambda: snapshot.get(0x01), number)))
+    print(snapshot)
+
+# ACKs built per second (encoded each time vs cached frame)
+def bench_ack(number=100000):
+    encode = _rate(lambda: InstantProtocolMessage(dictdata={'type': DataMessage.TYPE, 'sequence': 1, 'ack': 1, 'source_id': 0x00, 'group_id': 0x00}).serialize(), number)
+    cached = _rate(lambda: Acknowledgement.frame(DataMessage.TYPE, 1, 0x00), number)
+    print('{0:<24}{1:>16}'.format('ack', 'frames/s'))
+    print('{0:<24}{1:>16.0f}'.format('encoded', encode))
+    print('{0:<24}{1:>16.0f}'.format('cached', cached))
+
+# Frames prepared per chat line for a group (encoded per recipient vs encoded once and shared)
+def bench_fanout(number=200, members=200):
+    dictdata = {'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 12, 'group_id': 0x01, 'options': {'data_length': 11, 'payload': 'hello world'}}
+    def per_recipient():
+        for i in xrange(members):
+            InstantProtocolMessage(dictdata=dict(dictdata, sequence=i % 2)).serialize()
+    def shared():
+        frames = InstantProtocolMessage.sequence_variants(InstantProtocolMessage(dictdata=dictdata).serialize())
+        for i in xrange(members):
+            frames[i % 2]
+    print('{0:<24}{1:>16}'.format('{} members'.format(members), 'lines/s'))
+    print('{0:<24}{1:>16.0f}'.format('per recipient', _rate(per_recipient, number)))
+    print('{0:<24}{1:>16.0f}'.format('shared', _rate(shared, number)))
+
+def _thread_timer(delay, callback, *args):
+    timer = threading.Timer(delay, callback, args)
+    timer.start()
+    return timer
+
+# Resend timers of many sessions under loss: every session keeps a 500ms timer armed (resent when it expires)
+# and a part of them is acknowledged (cancelled and armed again) every 10ms
+def bench_timers(sessions=1000, duration=3.0):
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{} sessions'.format(sessions), 'max threads', 'cpu (s)', 'expired'))
+    wheel = TimerWheel().start()
+    for name, call_later in (('TimerWheel', wheel.call_later), ('threading.Timer', _thread_timer)):
+        timers = [None] * sessions
+        expired = [0]
+        running = [True]
+        def resend(i):
+            expired[0] += 1
+            if (running[0]):
+                timers[i] = call_later(0.5, resend, i)
+        for i in xrange(sessions):
+            timers[i] = call_later(random.uniform(0, 0.5), resend, i)
+        max_threads = 0
+        start_cpu, start = time.clock(), time.time()
+        while (time.time() - start < duration):
+            for i in random.sample(xrange(sessions), sessions / 100): # ACKs
+                timers[i].cancel()
+                timers[i] = call_later(0.5, resend, i)
+            max_threads = max(max_threads, threading.active_count())
+            time.sleep(0.01)
+        cpu = time.clock() - start_cpu
+        running[0] = False
+        for timer in timers:
+            timer.cancel()
+        print('{0:<24}{1:>16}{2:>16.2f}{3:>16}'.format(name, max_threads, cpu, expired[0]))
+    wheel.stop()
+
+# Session whose peer is another session of the process (link with delay and loss on the timer wheel)
+class _LinkSession(ReliableSession):
+    def __init__(self, scheduler, extended, delay, loss_rate):
+        super(_LinkSession, self).__init__(None, scheduler, extended)
+        self.peer = None
+        self.delay = delay
+        self.loss_rate = loss_rate
+        self.link = list() # frames on the way to the peer (in order, as on loopback)
+        self.received = 0
+        self.expected = 0
+        self.done = threading.Event()
+
+    def _local_id(self):
+        return 0x00
+
+    def _sendto(self, frame):
+        if (random.random() >= self.loss_rate):
+            self.link.append(frame)
+            self.scheduler.call_later(self.delay, self.peer._receive, self.link)
+
+    def _expired(self):
+        self.done.set()
+
+    def _receive(self, link):
+        message = InstantProtocolMessage(rawdata=link.pop(0))
+        if (message.ack == Acknowledgement.FLAG):
+            if (self._acknowledges(message)):
+                self._acknowledged(message.sequence)
+        else:
+            if (self._is_new(message)):
+                self.received += 1
+                if (self.received == self.expected):
+                    self.done.set()
+            self._send_ack(message)
+
+# Chat lines delivered per second through one session (10ms each way), Stop & Wait vs extended mode
+def bench_window(messages=100, delay=0.01):
+    print('{0:<24}{1:>16}{2:>16}'.format('{} messages'.format(messages), 'loss', 'messages/s'))
+    frames = InstantProtocolMessage.sequence_variants(InstantProtocolMessage(dictdata=dict(SAMPLE_MESSAGES[5], sequence=0)).serialize())
+    scheduler = TimerWheel().start()
+    for loss_rate in (0.0, 0.02):
+        for name, extended in (('stop & wait', False), ('window={}'.format(ReliableSession.WINDOW), True)):
+            sender = _LinkSession(scheduler, extended, delay, loss_rate)
+            receiver = _LinkSession(scheduler, extended, delay, loss_rate)
+            sender.peer, receiver.peer = receiver, sender
+            receiver.expected = messages
+            start = time.time()
+            for i in xrange(messages):
+                sender._send_frames(frames)
+            receiver.done.wait()
+            print('{0:<24}{1:>16.2f}{2:>16.0f}'.format(name, loss_rate, receiver.received / (time.time() - start)))
+    scheduler.stop()
+
+# Session over a UDP socket with losses (SocketError), the receiver reassembles the fragments of Data Messages
+class _UdpSession(ReliableSession):
+    def __init__(self, scheduler, extended, loss_rate):
+        self.sock = SocketError(socket.AF_INET, socket.SOCK_DGRAM, loss_rate)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.sock.setblocking(False)
+        super(_UdpSession, self).__init__(None, scheduler, extended)
+        self.peer_extended = extended # known after the connection
+        self.reassembler = Reassembler()
+        self.messages = 0 # payloads reassembled
+
+    def _local_id(self):
+        return 0x00
+
+    def _sendto(self, frame):
+        self.sock.sendto(frame, self.address)
+
+    def _expired(self):
+        raise RuntimeError('peer unreachable')
+
+    def receive(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(2048)
+            except socket.error:
+                return
+            message = InstantProtocolMessage(rawdata=data)
+            if (message.ack == Acknowledgement.FLAG):
+                if (self._acknowledges(message)):
+                    self._acknowledged(message.sequence)
+            else:
+                if (self._is_new(message) and (self.reassembler.add(message.source_id, message.options) is not None)):
+                    self.messages += 1
+                self._send_ack(message)
+
+# Messages of 60 KB sent in fragments through a UDP socket with losses (SocketError), Stop & Wait vs extended mode
+def bench_fragments(size=61440, messages=5, timeout=120):
+    payload = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for i in xrange(size))
+    parts = DataMessage.split(payload)
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{} x {} fragments'.format(messages, len(parts)), 'loss', 'KB/s', 'resent'))
+    for loss_rate in (0.0, 0.02, 0.05):
+        for name, extended in (('stop & wait', False), ('window={}'.format(ReliableSession.WINDOW), True)):
+            scheduler = TimerWheel()
+            sender = _UdpSession(scheduler, extended, loss_rate)
+            receiver = _UdpSession(scheduler, extended, loss_rate)
+            sender.address, receiver.address = receiver.sock.sock.getsockname(), sender.sock.sock.getsockname()
+            sent = [0]
+            sendto = sender._sendto
+            def counted(frame):
+                sent[0] += 1
+                sendto(frame)
+            sender._sendto = counted
+            start = time.time()
+            for message_id in xrange(messages):
+                for i, part in enumerate(parts):
+                    sender._send_frames(InstantProtocolMessage.sequence_variants(InstantProtocolMessage(dictdata={'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0,
+                        'source_id': 0x01, 'group_id': 0x01, 'options': {'data_length': len(part), 'payload': part, 'fragment': (message_id, i, len(parts))}}).serialize()))
+            while ((receiver.messages < messages) and (time.time() - start < timeout)):
+                select.select([sender.sock.sock, receiver.sock.sock], [], [], scheduler.next_timeout())
+                receiver.receive()
+                sender.receive()
+                scheduler.advance()
+            elapsed = time.time() - start
+            print('{0:<24}{1:>16.2f}{2:>16.0f}{3:>16}'.format(name, loss_rate, receiver.messages * size / 1024.0 / elapsed, sent[0] - messages * len(parts)))
+            sender.sock.sock.close()
+            receiver.sock.sock.close()
+
+class _DirectorySession(object):
+    def __init__(self, client_id, group_id=0x01):
+        self.client_id = client_id
+        self.username = 'user{}'.format(client_id)
+        self.address = ('127.0.0.1', 2000 + client_id)
+        self.group_id = group_id
+
+# Session lookups per second (by client ID for every datagram, by username for every Connection Request)
+def bench_directory(number=20000, sessions=255):
+    session_list = [_DirectorySession(client_id) for client_id in xrange(1, sessions + 1)]
+    directory = SessionDirectory()
+    for session in session_list:
+        directory.add(session)
+    client_ids = [random.randint(1, sessions) for i in xrange(number)]
+    def scan():
+        for client_id in client_ids:
+            for session in session_list:
+                if (session.client_id == client_id):
+                    break
+        any('nobody' == session.username for session in session_list)
+    def indexed():
+        for client_id in client_ids:
+            directory.get(client_id)
+        directory.get_by_username('nobody')
+    print('{0:<24}{1:>16}'.format('{} sessions'.format(sessions), 'lookups/s'))
+    print('{0:<24}{1:>16.0f}'.format('list scan', _rate(scan, 1) * number))
+    print('{0:<24}{1:>16.0f}'.format('directory', _rate(indexed, 1) * number))
+
+# Recipients of a chat line and group size check in a private group of 2 users (the rest in the public group)
+def bench_groups(number=20000, sessions=255):
+    session_list = [_DirectorySession(client_id, 0x07 if client_id <= 2 else 0x01) for client_id in xrange(1, sessions + 1)]
+    directory = SessionDirectory()
+    for session in session_list:
+        directory.add(session)
+    sender = session_list[0]
+    def scan():
+        recipients = [session for session in session_list if ((session != sender) and (session.group_id == sender.group_id))]
+        return (len([session for session in session_list if (session.group_id == sender.group_id)]) == 1)
+    def indexed():
+        recipients = [session for session in directory.members(sender.group_id) if (session != sender)]
+        return (directory.group_size(sender.group_id) == 1)
+    print('{0:<24}{1:>16}'.format('{} sessions'.format(sessions), 'lines/s'))
+    print('{0:<24}{1:>16.0f}'.format('list scan', _rate(scan, number)))
+    print('{0:<24}{1:>16.0f}'.format('group index', _rate(indexed, number)))
+
+# Every 16-bit ID allocated one by one (old pool list with pop(0) against the free list), then groups
+# created and dissolved again and again (the old pool runs out after 254 groups, released IDs are reused)
+def bench_ids(ids=0xFF00, groups=10000):
+    def pool():
+        pool_ids = random.sample(xrange(256, 256 + ids), ids)
+        while (pool_ids):
+            pool_ids.pop(0)
+    def allocator():
+        pool_ids = IdAllocator(xrange(256, 256 + ids))
+        while (pool_ids.allocate() is not None):
+            pass
+    print('{0:<24}{1:>16}'.format('{} IDs'.format(ids), 'allocations/s'))
+    print('{0:<24}{1:>16.0f}'.format('pool list', _rate(pool, 1) * ids))
+    print('{0:<24}{1:>16.0f}'.format('free list', _rate(allocator, 1) * ids))
+    group_ids = IdAllocator(xrange(2, 256), quarantine=0)
+    created = 0
+    for i in xrange(groups):
+        group_id = group_ids.allocate()
+        if (group_id is None):
+            break
+        group_ids.release(group_id) # last member left
+        created += 1
+    print('{0:<24}{1:>16}'.format('groups created', '{}/{}'.format(created, groups)))
+    print(group_ids)
+
+# Search of the idle sessions (done every Server.KEEPALIVE_INTERVAL): every session visited against the sessions
+# ordered by the second of their last message, with a few idle ones among many active ones
+def bench_idle(number=10, sessions=10000, idle=10):
+    session_list = [_DirectorySession(client_id) for client_id in xrange(sessions)]
+    now = time.time()
+    since = now - 15.0 # Server.KEEPALIVE
+    last = dict((session, now - (60 if (i < idle) else random.random() * 10)) for i, session in enumerate(session_list))
+    def build():
+        index = IdleIndex()
+        for session in sorted(session_list, key=last.get): # as the messages arrived
+            index.touch(session, last[session])
+        return index
+    indexes = [build() for i in xrange(3 * number)] # the idle sessions leave the index when they are found
+    searched = list() # (not freed while it is timed)
+    def scan():
+        return [session for session in session_list if (last[session] < since)]
+    def indexed():
+        searched.append(indexes.pop())
+        return searched[-1].idle(since)
+    assert len(scan()) == len(build().idle(since)) == idle
+    index = build()
+    print('{0:<24}{1:>16}'.format('{} sessions'.format(sessions), 'searches/s'))
+    print('{0:<24}{1:>16.0f}'.format('scan', _rate(scan, number)))
+    print('{0:<24}{1:>16.0f}'.format('idle index', _rate(indexed, number)))
+    print('{0:<24}{1:>16.0f}'.format('touch/s', _rate(lambda: index.touch(session_list[-1], now), number * 10000)))
+
+# Slow client: a burst of chat lines of one user is queued, then a Group Invitation Request (old list drained
+# with pop(0) against the queue with priorities, limited to MessageQueue.LIMIT lines with each policy)
+def bench_queue(burst=2000):
+    data = InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 7, 'group_id': 1,
+        'options': {'data_length': 5, 'payload': 'hello'}}))
+    control = InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': GroupInvitationRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 7, 'group_id': 1,
+        'options': {'type': 0, 'group_id': 9, 'client_id': 8}}))
+    # -> (messages sent before the invitation, lines sent)
+    def run(queue, pop):
+        for i in xrange(burst):
+            queue.append(data)
+        queue.append(control)
+        sent = [pop() for i in xrange(len(queue))]
+        return sent.index(control), len(sent) - 1
+    print('{0:<24}{1:>16}{2:>16}{3:>16}{4:>16}'.format('{} lines'.format(burst), 'before control', 'lines sent', 'coalesced', 'bursts/s'))
+    queue = list()
+    position, sent = run(queue, lambda: queue.pop(0))
+    print('{0:<24}{1:>16}{2:>16}{3:>16}{4:>16.1f}'.format('list', position, sent, 0, _rate(lambda: run(queue, lambda: queue.pop(0)), 10)))
+    for policy in (MessageQueue.DROP, MessageQueue.COALESCE):
+        queue = MessageQueue(policy=policy)
+        position, sent = run(queue, queue.popleft)
+        coalesced = queue.coalesced
+        print('{0:<24}{1:>16}{2:>16}{3:>16}{4:>16.1f}'.format(policy, position, sent, coalesced, _rate(lambda: run(queue, queue.popleft), 10)))
+
+# Client of the load generator (legacy Stop & Wait, every message received is acknowledged)
+# wide = it asks for wide IDs, then its messages use the extended mode (still one at a time)
+class _LoadClient(object):
+    RESEND_TIMER = 0.2
+
+    def __init__(self, server_address, username, wide=False):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.server_address = server_address
+        self.username = username
+        self.client_id = None
+        self.last_seq_sent = 0
+        self.last_seq_recv = 0 if (wide) else 1 # Connection Accept is the first message of the server
+        self.pending = None # frame waiting for ACK
+        self.sent = 0
+        self.lines = 0 # lines to send
+        self.received = 0 # lines received
+        self.update_lists = 0 # Update List received
+        self.users = dict() # client_id -> entry (User List Response)
+        self.chunks = 0 # chunks of the User List Response received
+        self.synced = False # last chunk received
+        self.wide = wide
+
+    def _send(self, dictdata):
+        if (self.wide and self.client_id):
+            self.last_seq_sent = (self.last_seq_sent + 1) % InstantProtocolMessage.EXTENDED_SEQUENCES
+            dictdata['sequence'] = 0
+            self.pending = InstantProtocolMessage.extended_frame(InstantProtocolMessage.encode(dictdata, True), self.last_seq_sent)
+        else:
+            self.last_seq_sent = 1 - self.last_seq_sent
+            dictdata['sequence'] = self.last_seq_sent
+            self.pending = InstantProtocolMessage(dictdata=dictdata).serialize()
+        self.resend()
+
+    def resend(self):
+        self.sent = time.time()
+        self.sock.sendto(self.pending, self.server_address)
+
+    def connect(self):
+        self._send({'type': ConnectionRequest.TYPE, 'extended': int(self.wide), 'ack': 0, 'source_id': 0x00, 'group_id': ConnectionRequest.WIDE_IDS if (self.wide) else 0x00, 'options': {'username': self.username}})
+
+    def user_list_request(self):
+        self._send({'type': UserListRequest.TYPE, 'ack': 0, 'source_id': self.client_id, 'group_id': 0x01})
+
+    def next_line(self):
+        self.pending = None
+        if (self.lines):
+            self.lines -= 1
+            self._send({'type': DataMessage.TYPE, 'ack': 0, 'source_id': self.client_id, 'group_id': 0x01, 'options': {'data_length': 4, 'payload': 'load'}})
+
+    def receive(self):
+        message = InstantProtocolMessage(rawdata=self.sock.recv(2048))
+        if (message.ack == Acknowledgement.FLAG):
+            if (self.pending and (message.sequence == self.last_seq_sent)):
+                self.next_line()
+            return
+        if (message.extension): # in order only (cumulative ACKs)
+            new = (message.sequence == (self.last_seq_recv + 1) % InstantProtocolMessage.EXTENDED_SEQUENCES)
+        else:
+            new = (message.sequence != self.last_seq_recv)
+        if (message.type == ConnectionAccept.TYPE): # implicit ACK
+            self.client_id = message.options.client_id
+            self.pending = None
+            if (self.wide): # extended mode from now on
+                self.last_seq_sent = 0
+        elif ((message.type == DataMessage.TYPE) and new):
+            self.received += 1 + message.options.payload.count('\n') # lines coalesced by a queue of the server
+        elif ((message.type == UpdateList.TYPE) and new):
+            self.update_lists += 1
+        elif ((message.type == UserListResponse.TYPE) and new):
+            if (message.options.chunk == 0): # implicit ACK of the request
+                self.pending = None
+            self.users.update((user['client_id'], user) for user in message.options.user_list)
+            self.chunks += 1
+            self.synced = (message.options.chunk == message.options.chunks - 1)
+        if (new or (not message.extension)):
+            self.last_seq_recv = message.sequence
+        self.sock.sendto(Acknowledgement.frame(message.type, self.last_seq_recv, self.client_id or 0x00, extended=int(self.wide), extension=message.extension), self.server_address)
+
+# Every client sends lines to the public group (one at a time), it ends when every line has been received by everybody
+def _load(server_address, clients, lines, timeout=120):
+    load_clients = [_LoadClient(server_address, 'load{}'.format(i)) for i in xrange(clients)]
+    by_socket = dict((client.sock, client) for client in load_clients)
+    for client in load_clients:
+        client.connect()
+    def wait(done):
+        deadline = time.time() + timeout
+        while ((not done()) and (time.time() < deadline)):
+            readable, _, _ = select.select(by_socket.keys(), [], [], 0.05)
+            for sock in readable:
+                by_socket[sock].receive()
+            now = time.time()
+            for client in load_clients:
+                if (client.pending and (now - client.sent > client.RESEND_TIMER)):
+                    client.resend()
+        return done()
+    if (not wait(lambda: all(client.client_id and not client.pending for client in load_clients))):
+        raise RuntimeError('clients not connected')
+    start = time.time()
+    for client in load_clients:
+        client.lines = lines
+        client.next_line()
+    if (not wait(lambda: all(client.received >= (clients - 1) * lines for client in load_clients))):
+        raise RuntimeError('lines lost')
+    elapsed = time.time() - start
+    for client in load_clients:
+        client.sock.close()
+    return elapsed
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+# Socket of the server with the given receive buffer and a sender (datagrams queued before they are read)
+def _udp_pair(rcvbuf):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(False)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return receiver, sender
+
+# Datagrams read and routed (header decoded) per second: recvfrom (a new string of the buffer size each, shrunk
+# after the read) against the receive ring (batches of 64 views of preallocated buffers), with the buffer of the
+# server (1024) and a big one (65535, the biggest datagram), the socket is filled with data messages before every run
+# Then a socket with a small SO_RCVBUF is flooded without reading it, the ring reports what the kernel dropped
+def bench_receive(datagrams=2000, rounds=50):
+    frame = InstantProtocolMessage(dictdata=SAMPLE_MESSAGES[5]).serialize()
+    receiver, sender = _udp_pair(1 << 21)
+    address = receiver.getsockname()
+    def fill():
+        for i in xrange(datagrams):
+            sender.sendto(frame, address)
+    def recvfrom(buffer):
+        received = 0
+        while True:
+            try:
+                data, client_address = receiver.recvfrom(buffer)
+            except socket.error:
+                return received
+            received += InstantProtocolMessage(rawdata=data).type == DataMessage.TYPE
+    def drain(ring):
+        received = 0
+        while True:
+            batch = ring.drain()
+            for data, client_address in batch:
+                received += InstantProtocolMessage(rawdata=data).type == DataMessage.TYPE
+            if (len(batch) < len(ring.views)):
+                return received
+    print('{0:<24}{1:>16}{2:>16}'.format('{} datagrams'.format(datagrams), 'buffer 1024/s', 'buffer 65535/s'))
+    for name, function, arguments in (('recvfrom', recvfrom, (1024, 65535)), ('recvfrom_into ring', drain, (ReceiveRing(receiver, 1024), ReceiveRing(receiver, 65535)))):
+        rates = list()
+        for argument in arguments:
+            elapsed = 0
+            for i in xrange(rounds):
+                fill()
+                start = time.time()
+                assert (function(argument) == datagrams)
+                elapsed += time.time() - start
+            rates.append(datagrams * rounds / elapsed)
+        print('{0:<24}{1:>16.0f}{2:>16.0f}'.format(name, *rates))
+    receiver.close()
+    receiver, sender = _udp_pair(4096)
+    ring = ReceiveRing(receiver, 1024)
+    for i in xrange(datagrams):
+        sender.sendto(frame, receiver.getsockname())
+    received = 0
+    while True:
+        batch = ring.drain()
+        received += len(batch)
+        if (not batch):
+            break
+    print('{0:<24}{1:>16}{2:>16}'.format('SO_RCVBUF=4096', 'received', 'kernel drops'))
+    print('{0:<24}{1:>16}{2:>16}'.format('flood of {}'.format(datagrams), received, ring.check_drops()))
+    receiver.close()
+
+# Server in another process (Server(...) with the given arguments), returns the load and its CPU time (every process of the server)
+# prelude = code run by the server process before it loads the server
+def _load_server(arguments, clients, lines, workers=1, prelude=''):
+    server_address = ('127.0.0.1', _free_port())
+    # queues without limit: every line is delivered, however far behind the clients are
+    code = prelude + 'import Server; Server.Server(address={!r}, loss_rate=0, queue_limit=None, {}).run()'.format(server_address, arguments)
+    if (workers > 1):
+        code = prelude + 'import Server, Cluster; Cluster.Cluster({}).run(lambda cluster: Server.Server(address={!r}, loss_rate=0, queue_limit=None, cluster=cluster, {}).run())'.format(workers, server_address, arguments)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull)
+    time.sleep(0.5) # bind
+    try:
+        elapsed = _load(server_address, clients, lines)
+    finally:
+        start_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        end_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return elapsed, (end_cpu.ru_utime + end_cpu.ru_stime) - (start_cpu.ru_utime + start_cpu.ru_stime)
+
+# User List Response of a full server (255 users) received by the last client, from the request to the last chunk
+def bench_sync(clients=255, rounds=5, timeout=60):
+    server_address = ('127.0.0.1', _free_port())
+    code = 'import Server; Server.Server(address={!r}, loss_rate=0, engine=\'loop\').run()'.format(server_address)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+    time.sleep(0.5) # bind
+    load_clients = [_LoadClient(server_address, 'load{}'.format(i)) for i in xrange(clients)]
+    by_socket = dict((client.sock, client) for client in load_clients)
+    def wait(done, timeout=timeout):
+        deadline = time.time() + timeout
+        while ((not done()) and (time.time() < deadline)):
+            readable, _, _ = select.select(by_socket.keys(), [], [], 0.05)
+            for sock in readable:
+                by_socket[sock].receive()
+            now = time.time()
+            for client in load_clients:
+                if (client.pending and (now - client.sent > client.RESEND_TIMER)):
+                    client.resend()
+        return done()
+    try:
+        for client in load_clients:
+            client.connect()
+        if (not wait(lambda: all(client.client_id and not client.pending for client in load_clients))):
+            raise RuntimeError('clients not connected')
+        wait(lambda: False, 2.0) # Update List of the connections
+        client = load_clients[-1]
+        print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{} users'.format(clients), 'users', 'chunks', 'ms'))
+        for i in xrange(rounds):
+            client.users.clear()
+            client.chunks = 0
+            client.synced = False
+            start = time.time()
+            client.user_list_request()
+            if (not wait(lambda: client.synced)):
+                raise RuntimeError('user list not received')
+            print('{0:<24}{1:>16}{2:>16}{3:>16.1f}'.format('request {}'.format(i + 1), len(client.users), client.chunks, (time.time() - start) * 1000))
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        for client in load_clients:
+            client.sock.close()
+
+# Clients connecting at the same time (each connection is announced to every connected user), Update List received
+# by all of them with the changes sent at once (no window) and merged by the server (window of ServerSession)
+def bench_presence(clients=(50, 100, 200), duration=2.0):
+    print('{0:<24}{1:>16}{2:>16}'.format('connections', 'no window', 'window'))
+    for number in clients:
+        counts = list()
+        for window in ('0', 'ServerSession.ServerSession.PRESENCE_WINDOW'):
+            server_address = ('127.0.0.1', _free_port())
+            code = 'import Server, ServerSession; ServerSession.ServerSession.PRESENCE_WINDOW = {0}; ServerSession.ServerSession.PRESENCE_MAX_DELAY = {0}; Server.Server(address={1!r}, loss_rate=0, engine=\'loop\').run()'.format(window, server_address)
+            with open(os.devnull, 'w') as devnull:
+                server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+            time.sleep(0.5) # bind
+            load_clients = [_LoadClient(server_address, 'load{}'.format(i)) for i in xrange(number)]
+            by_socket = dict((client.sock, client) for client in load_clients)
+            try:
+                for client in load_clients:
+                    client.connect()
+                deadline = time.time() + duration # every change announced
+                while (time.time() < deadline):
+                    readable, _, _ = select.select(by_socket.keys(), [], [], 0.05)
+                    for sock in readable:
+                        by_socket[sock].receive()
+                    now = time.time()
+                    for client in load_clients:
+                        if (client.pending and (now - client.sent > client.RESEND_TIMER)):
+                            client.resend()
+            finally:
+                server.send_signal(signal.SIGINT)
+                server.wait()
+                for client in load_clients:
+                    client.sock.close()
+            counts.append(sum(client.update_lists for client in load_clients))
+        print('{0:<24}{1:>16}{2:>16}'.format(number, *counts))
+
+# Flood of Connection Requests (a new username each, never acknowledged) from many addresses or from a single one,
+# without and with admission control: sessions created (Connection Accepts received), time for a user to
+# connect just after the flood and CPU time of the server
+def bench_flood(requests=2000, duration=2.0, timeout=10.0):
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{} requests'.format(requests), 'accepts', 'connect (s)', 'cpu (s)'))
+    for addresses in (500, 1):
+        for admission, arguments in (('off', 'address_rate=None, client_rate=None, max_pending=None'), ('on', '')):
+            server_address = ('127.0.0.1', _free_port())
+            code = 'import Server; Server.Server(address={!r}, loss_rate=0, engine=\'loop\', {}).run()'.format(server_address, arguments)
+            with open(os.devnull, 'w') as devnull:
+                server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+            time.sleep(0.5) # bind
+            socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in xrange(addresses)]
+            try:
+                for i in xrange(requests):
+                    socks[i % addresses].sendto(InstantProtocolMessage.encode({'type': ConnectionRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00,
+                        'options': {'username': 'flood{}'.format(i)}}), server_address)
+                user = _LoadClient(server_address, 'user')
+                start = time.time()
+                user.connect()
+                while ((not user.client_id) and (time.time() - start < timeout)):
+                    if (select.select([user.sock], [], [], 0.05)[0]):
+                        user.receive()
+                    elif (time.time() - user.sent > user.RESEND_TIMER):
+                        user.resend()
+                connect = '{:.2f}'.format(time.time() - start) if (user.client_id) else 'failed'
+                time.sleep(duration)
+                accepts = 0
+                for sock in socks:
+                    sock.setblocking(False)
+                    while True:
+                        try:
+                            data = sock.recv(2048)
+                        except socket.error:
+                            break
+                        accepts += (InstantProtocolMessage(rawdata=data).type == ConnectionAccept.TYPE)
+            finally:
+                start_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+                server.send_signal(signal.SIGINT)
+                server.wait()
+                end_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+                for sock in socks:
+                    sock.close()
+            cpu = (end_cpu.ru_utime + end_cpu.ru_stime) - (start_cpu.ru_utime + start_cpu.ru_stime)
+            print('{0:<24}{1:>16}{2:>16}{3:>16.2f}'.format('{} addr, admission {}'.format(addresses, admission), accepts, connect, cpu))
+
+# Users connected to a single server with wide IDs (the first 255 users take the 8-bit IDs), and the
+# User List Response requested then by one of them (poll, there are too many sockets for select)
+# They connect in batches, every connection is announced to everybody (Update List)
+def bench_users(clients=(250, 1000), batch=100, rcvbuf=4194304, timeout=120):
+    print('{0:<24}{1:>16}{2:>16}{3:>16}{4:>16}'.format('users', 'wide IDs', 'connect (s)', 'list users', 'list (ms)'))
+    for number in clients:
+        server_address = ('127.0.0.1', _free_port())
+        code = 'import Server; Server.Server(address={!r}, loss_rate=0, engine=\'loop\', rcvbuf={}).run()'.format(server_address, rcvbuf)
+        with open(os.devnull, 'w') as devnull:
+            server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=devnull, stderr=devnull)
+        time.sleep(0.5) # bind
+        load_clients = [_LoadClient(server_address, 'u{}'.format(i), True) for i in xrange(number)]
+        by_fileno = dict((client.sock.fileno(), client) for client in load_clients)
+        poll = select.poll()
+        for fileno in by_fileno:
+            poll.register(fileno, select.POLLIN)
+        def wait(done):
+            deadline = time.time() + timeout
+            while ((not done()) and (time.time() < deadline)):
+                for fileno, event in poll.poll(50):
+                    by_fileno[fileno].receive()
+                now = time.time()
+                for client in load_clients:
+                    if (client.pending and (now - client.sent > client.RESEND_TIMER)):
+                        client.resend()
+            return done()
+        try:
+            start = time.time()
+            for i in xrange(0, number, batch):
+                for client in load_clients[i:(i + batch)]:
+                    client.connect()
+                if (not wait(lambda: all(client.client_id and not client.pending for client in load_clients[:(i + batch)]))):
+                    raise RuntimeError('clients not connected')
+            connect = time.time() - start
+            client = load_clients[-1]
+            start = time.time()
+            client.user_list_request()
+            if (not wait(lambda: client.synced and (len(client.users) == number))):
+                raise RuntimeError('user list not received')
+            print('{0:<24}{1:>16}{2:>16.1f}{3:>16}{4:>16.1f}'.format(number, len([c for c in load_clients if (c.client_id > InstantProtocolMessage.NARROW_ID)]),
+                connect, len(client.users), (time.time() - start) * 1000))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+            for client in load_clients:
+                client.sock.close()
+
+# Same load against each server engine (20 clients sending 50 lines each to the public group)
+def bench_engines(clients=20, lines=50):
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{}x{} lines'.format(clients, lines), 'lines/s', 'deliveries/s', 'cpu (s)'))
+    for engine in ('threads', 'loop'):
+        elapsed, cpu = _load_server('engine={!r}'.format(engine), clients, lines)
+        print('{0:<24}{1:>16.0f}{2:>16.0f}{3:>16.2f}'.format(engine, clients * lines / elapsed, clients * (clients - 1) * lines / elapsed, cpu))
+
+# Same load against 1 to 4 workers (loop engine, clients are shared by the kernel between them)
+def bench_workers(clients=20, lines=50):
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{}x{} lines'.format(clients, lines), 'lines/s', 'deliveries/s', 'cpu (s)'))
+    for workers in (1, 2, 4):
+        elapsed, cpu = _load_server('engine=\'loop\'', clients, lines, workers)
+        print('{0:<24}{1:>16.0f}{2:>16.0f}{3:>16.2f}'.format('{} workers'.format(workers), clients * lines / elapsed, clients * (clients - 1) * lines / elapsed, cpu))
+
+# Cost of the instrumentation: one update of each instrument, then the load of bench_engines with the metrics of the
+# server disabled (every instrument is a NullInstrument) and enabled, alternated (best of rounds)
+def bench_metrics(number=1000000, clients=20, lines=50, rounds=3):
+    counter = Counter()
+    histogram = Histogram(MetricsRegistry.LATENCY_BOUNDS)
+    print('{0:<24}{1:>16}'.format('instrument', 'ns/update'))
+    print('{0:<24}{1:>16.0f}'.format('counter', 1e9 / _rate(counter.inc, number)))
+    print('{0:<24}{1:>16.0f}'.format('histogram', 1e9 / _rate(lambda: histogram.observe(0.003), number)))
+    print('{0:<24}{1:>16.0f}'.format('null instrument', 1e9 / _rate(NULL_INSTRUMENT.inc, number)))
+    results = dict()
+    for i in xrange(rounds):
+        for enabled in (False, True):
+            elapsed, cpu = _load_server('engine=\'loop\'', clients, lines, prelude='import Metrics; Metrics.METRICS.enabled = {}; '.format(enabled))
+            best = results.get(enabled, (float('inf'), float('inf')))
+            results[enabled] = (min(best[0], elapsed), min(best[1], cpu))
+    print('{0:<24}{1:>16}{2:>16}{3:>16}'.format('{}x{} lines'.format(clients, lines), 'lines/s', 'deliveries/s', 'cpu (s)'))
+    for enabled in (False, True):
+        elapsed, cpu = results[enabled]
+        print('{0:<24}{1:>16.0f}{2:>16.0f}{3:>16.2f}'.format('metrics on' if (enabled) else 'metrics off', clients * lines / elapsed, clients * lines * (clients - 1) / elapsed, cpu))
+    print('{0:<24}{1:>15.1f}%'.format('cpu overhead', 100 * (results[True][1] - results[False][1]) / results[False][1]))
+
+BENCHMARKS = {
+    'users': bench_users,
+    'flood': bench_flood,
+    'metrics': bench_metrics,
+    'fragments': bench_fragments,
+    'sync': bench_sync,
+    'presence': bench_presence,
+    'receive': bench_receive,
+    'workers': bench_workers,
+    'engines': bench_engines,
+    'idle': bench_idle,
+    'queue': bench_queue,
+    'ids': bench_ids,
+    'groups': bench_groups,
+    'directory': bench_directory,
+    'window': bench_window,
+    'fanout': bench_fanout,
+    'timers': bench_timers,
+    'ack': bench_ack,
+    'codec': bench_codec,
+    'user_list': bench_user_list,
+}
+
+# Execution (python Benchmark.py [<benchmark> ...])
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or sorted(BENCHMARKS)):
+        print('\033[1m{}\033[0m'.format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,644 @@
+# Checks.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import sys
+import json
+import socket
+import struct
+import cPickle
+import threading
+from contextlib import contextmanager
+
+from InstantProtocol import *
+from Scheduler import *
+from ReliableSession import *
+from Reassembly import *
+from Server import *
+
+# Deterministic checks of what goes on the wire (python Checks.py [<check> ...]), an AssertionError stops them
+
+# Clock of the checks: the timer wheel and the sessions only move when it is advanced
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, wheel, seconds):
+        for i in xrange(int(round(seconds / wheel.tick))): # tick by tick (callbacks see the time of their tick)
+            self.now += wheel.tick
+            wheel.advance(self.now)
+
+CLOCK_MODULES = ('Scheduler', 'ReliableSession', 'Server', 'ServerSession', 'IdAllocator', 'Reassembly') # modules which read time.time()
+
+# with _clock() as (clock, wheel): the modules read the clock of the check until the block ends (even if it fails)
+@contextmanager
+def _clock():
+    clock = _Clock()
+    modules = [sys.modules[name] for name in CLOCK_MODULES]
+    originals = [module.time for module in modules]
+    for module in modules:
+        module.time = clock
+    try:
+        yield clock, TimerWheel()
+    finally:
+        for module, original in zip(modules, originals):
+            module.time = original
+
+# Datagrams sent by a session (nothing leaves the process)
+class _FakeSocket(object):
+    def __init__(self):
+        self.sent = list()
+        self.by_address = dict()
+
+    def sendto(self, frame, address):
+        self.sent.append(frame)
+        self.by_address.setdefault(address, list()).append(frame)
+
+# Session whose datagrams are delivered by the check (_transfer), it keeps the Data Messages received in order
+class _PairSession(ReliableSession):
+    def __init__(self, scheduler, extended):
+        super(_PairSession, self).__init__(None, scheduler, extended)
+        self.sock = _FakeSocket()
+        self.delivered = list()
+        self.expired = False
+
+    def _local_id(self):
+        return 0x00
+
+    def _sendto(self, frame):
+        self.sock.sendto(frame, self.address)
+
+    def _expired(self):
+        self.expired = True
+
+    def receive(self, frame):
+        message = InstantProtocolMessage(rawdata=frame)
+        if (message.ack == Acknowledgement.FLAG):
+            if (self._acknowledges(message)):
+                self._acknowledged(message.sequence)
+        else:
+            if (self._is_new(message)):
+                self.delivered.append(message.options.payload if (message.type == DataMessage.TYPE) else message.type)
+            self._send_ack(message)
+
+    def send_line(self, text):
+        self._send(dictdata={'type': DataMessage.TYPE, 'ack': 0, 'source_id': 0x01, 'group_id': 0x01, 'options': {'data_length': len(text), 'payload': text}})
+
+# Delivers the datagrams sent by source (except the lost ones, by index) -> list of datagrams sent
+def _transfer(source, destination, lost=()):
+    frames, source.sock.sent = source.sock.sent, list()
+    for i, frame in enumerate(frames):
+        if (i not in lost):
+            destination.receive(frame)
+    return frames
+
+def _sequences(frames):
+    return [InstantProtocolMessage(rawdata=frame).sequence for frame in frames]
+
+# Every message type decodes to what was encoded, also with the 16-bit sequence of the extended mode
+def check_codec():
+    from Benchmark import SAMPLE_MESSAGES
+    for dictdata in SAMPLE_MESSAGES:
+        message = InstantProtocolMessage(dictdata=dictdata)
+        frame = message.serialize()
+        assert (repr(InstantProtocolMessage(rawdata=frame)) == repr(message)), (InstantProtocolMessage(rawdata=frame), message)
+        if ((message.type != ConnectionRequest.TYPE) and (not message.ack)): # no extension (capability only)
+            extended = InstantProtocolMessage(rawdata=InstantProtocolMessage.extended_frame(frame, 0x1234))
+            assert extended.extension and (extended.header_length == message.header_length + InstantProtocolMessage.EXTENSION_SIZE), extended
+            assert (((extended.type, extended.sequence, extended.source_id, extended.group_id, repr(extended.options)) == (message.type, 0x1234, message.source_id, message.group_id, repr(message.options)))), extended
+
+# Stop & Wait until the ACKs of the peer announce the extended mode, then a window of 16-bit sequences
+def check_extended_switch():
+    with _clock() as (clock, wheel):
+        sender, receiver = _PairSession(wheel, True), _PairSession(wheel, True)
+        for i in xrange(10):
+            sender.send_line('line {}'.format(i))
+        assert ((len(sender.in_flight), len(sender.message_queue)) == (1, 9)) and (not sender.extended)
+        legacy = _transfer(sender, receiver)
+        assert (not InstantProtocolMessage.has_extension(legacy[0])) and (_sequences(legacy) == [1])
+        acks = _transfer(receiver, sender)
+        assert (InstantProtocolMessage(rawdata=acks[0]).extended == 1) and (not InstantProtocolMessage(rawdata=acks[0]).extension) # R bit (capability) only
+        assert sender.extended and (sender.window == ReliableSession.WINDOW) and (len(sender.in_flight) == ReliableSession.WINDOW)
+        frames = _transfer(sender, receiver)
+        assert all(InstantProtocolMessage.has_extension(frame) for frame in frames) and (_sequences(frames) == range(1, 9)) # sequences start again
+        assert receiver.recv_extended and (receiver.delivered == ['line {}'.format(i) for i in xrange(9)])
+        # A late copy of the legacy message is acknowledged in the legacy mode, it is not delivered again and it is not an ACK of the window
+        receiver.receive(legacy[0])
+        late_ack = receiver.sock.sent.pop()
+        message = InstantProtocolMessage(rawdata=late_ack)
+        assert (len(receiver.delivered) == 9) and (not message.extension) and (message.sequence == 1)
+        sender.receive(late_ack)
+        assert (len(sender.in_flight) == ReliableSession.WINDOW)
+
+# A peer of the original protocol (R = 0 in its ACKs) is always served in Stop & Wait with 1-bit sequences
+def check_legacy_peer():
+    with _clock() as (clock, wheel):
+        sender, receiver = _PairSession(wheel, True), _PairSession(wheel, False)
+        for i in xrange(4):
+            sender.send_line('line {}'.format(i))
+        sent = list()
+        while (sender.in_flight):
+            sent += _transfer(sender, receiver)
+            _transfer(receiver, sender)
+        assert (not sender.extended) and (_sequences(sent) == [1, 0, 1, 0]) and (not any(InstantProtocolMessage.has_extension(frame) for frame in sent))
+        assert (receiver.delivered == ['line {}'.format(i) for i in xrange(4)])
+
+# One cumulative ACK acknowledges the whole window, a lost message is resent with every message after it (Go-Back-N)
+def check_go_back_n():
+    with _clock() as (clock, wheel):
+        sender, receiver = _PairSession(wheel, True), _PairSession(wheel, True)
+        sender.peer_extended = True # known after the connection
+        for i in xrange(ReliableSession.WINDOW):
+            sender.send_line('line {}'.format(i))
+        _transfer(sender, receiver)
+        acks = receiver.sock.sent
+        assert (_sequences(acks) == range(1, ReliableSession.WINDOW + 1))
+        sender.receive(acks[-1]) # the other ACKs are lost
+        receiver.sock.sent = list()
+        assert (not sender.in_flight) and (sender.state == ReliableSession.STATE_IDLE)
+        # Third message lost: the next ones are acknowledged with the last sequence received in order
+        for i in xrange(ReliableSession.WINDOW, 2 * ReliableSession.WINDOW):
+            sender.send_line('line {}'.format(i))
+        _transfer(sender, receiver, lost=(2,))
+        assert (_sequences(_transfer(receiver, sender)) == [9, 10] + [10] * (ReliableSession.WINDOW - 3))
+        assert (_sequences(frame for sequence, frame, sent in sender.in_flight) == range(11, 17))
+        clock.advance(wheel, sender.rtt.rto)
+        assert (_sequences(_transfer(sender, receiver)) == range(11, 17)) and (sender.rtt.backoffs == 1)
+        _transfer(receiver, sender)
+        assert (not sender.in_flight) and (receiver.delivered == ['line {}'.format(i) for i in xrange(2 * ReliableSession.WINDOW)])
+        # Nothing acknowledged -> RETRIES retransmissions with backoff (the RTO doubles every time), then the session gives up
+        sender.send_line('lost')
+        sender.sock.sent = list()
+        rtos = list()
+        for i in xrange(ReliableSession.RETRIES):
+            rtos.append(sender.rtt.rto)
+            clock.advance(wheel, sender.rtt.rto + wheel.tick)
+            assert (len(sender.sock.sent) == i + 1) and (not sender.expired)
+        clock.advance(wheel, sender.rtt.rto + wheel.tick)
+        assert sender.expired and (len(sender.sock.sent) == ReliableSession.RETRIES)
+        assert all(min(2 * rto, RttEstimator.MAX_RTO) == next_rto for rto, next_rto in zip(rtos, rtos[1:])), rtos
+
+# Messages waiting for the window: control messages go before the queued lines, and at LIMIT lines DROP removes
+# the oldest one while COALESCE merges the new line with the last one (or drops the oldest when they cannot be merged)
+def check_message_queue():
+    lines = ['line {}'.format(i) for i in xrange(6)]
+    for policy, delivered in ((MessageQueue.COALESCE, [lines[0], UpdateList.TYPE] + lines[2:4] + ['line 4\nline 5', 'other']),
+                              (MessageQueue.DROP, [lines[0], UpdateList.TYPE] + lines[3:] + ['other'])):
+        with _clock() as (clock, wheel):
+            sender, receiver = _PairSession(wheel, False), _PairSession(wheel, False) # Stop & Wait: one line in flight, the others wait
+            sender.message_queue = MessageQueue(4, policy)
+            for line in lines[:5]:
+                sender.send_line(line)
+            sender._send(dictdata={'type': UpdateList.TYPE, 'ack': 0, 'source_id': 0x00, 'group_id': 0xFF, 'options': {'user_list': []}})
+            sender.send_line(lines[5])
+            assert ((len(sender.message_queue.control), len(sender.message_queue.data)) == (1, 4))
+            other = InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0,
+                        'source_id': 0x02, 'group_id': 0x01, 'options': {'data_length': 5, 'payload': 'other'}}))
+            sender._send_frames(other) # another user: never merged
+            queue = sender.message_queue
+            assert (len(queue.data) == 4) and ((queue.coalesced, queue.dropped) == ((1, 1) if (policy == MessageQueue.COALESCE) else (0, 2))), queue
+            while (sender.in_flight):
+                _transfer(sender, receiver)
+                _transfer(receiver, sender)
+            assert (receiver.delivered == delivered), receiver.delivered
+
+# Users of a User List Response in chunks: the trailer is found because it is shorter than a record
+def check_user_list_chunks():
+    for wide, first_id in ((False, 1), (True, 0x100)):
+        users = [{'client_id': first_id + i, 'group_id': first_id, 'username': 'user{}'.format(i), 'ip_address': '10.0.{}.{}'.format(i / 256, i % 256), 'port': 2000 + i}
+                    for i in xrange(150)]
+        chunks = UserListResponse.split(users, wide)
+        assert (len(chunks) == 3) and (sum(chunks, []) == users)
+        for i, chunk in enumerate(chunks):
+            frame = InstantProtocolMessage.extended_frame(InstantProtocolMessage.encode({'type': UserListResponse.TYPE, 'wide': wide, 'sequence': 0, 'ack': 0,
+                        'source_id': 0x00, 'group_id': first_id, 'options': {'user_list': chunk, 'chunk': i, 'chunks': len(chunks)}}), 0xFFFF)
+            assert (len(frame) <= InstantProtocolMessage.MAX_SIZE), len(frame)
+            message = InstantProtocolMessage(rawdata=frame)
+            assert message.options.trailer and ((message.options.chunk, message.options.chunks) == (i, len(chunks))) and (message.options.user_list == chunk)
+        # Without trailer (older senders) the list is complete
+        frame = InstantProtocolMessage.encode({'type': UserListResponse.TYPE, 'wide': wide, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': first_id, 'options': {'user_list': users[:20]}})
+        message = InstantProtocolMessage(rawdata=frame)
+        assert (not message.options.trailer) and ((message.options.chunk, message.options.chunks) == (0, 1)) and (message.options.user_list == users[:20])
+
+# Fragments of a long Data Message: the trailer follows Data Length bytes of payload, the whole message has none
+def check_fragments():
+    text = ''.join('{:05d} '.format(i) for i in xrange(1000))
+    parts = DataMessage.split(text)
+    assert (len(parts) == 6) and (max(len(part) for part in parts) == DataMessage.FRAGMENT_LENGTH)
+    reassembler = Reassembler()
+    for wide, source_id in ((False, 0x01), (True, 0x101)):
+        for i, part in enumerate(parts):
+            frame = InstantProtocolMessage.extended_frame(InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0, 'source_id': source_id, 'group_id': 0x01,
+                        'options': {'data_length': len(part), 'payload': part, 'fragment': (7, i, len(parts))}}, wide), 0xFFFF)
+            assert (len(frame) <= InstantProtocolMessage.MAX_SIZE), len(frame)
+            message = InstantProtocolMessage(rawdata=frame)
+            assert (message.source_id == source_id) and (message.options.fragment == (7, i, len(parts))) and (message.options.payload == part)
+            payload = reassembler.add(message.source_id, message.options)
+        assert (payload == text)
+    for payload in ('', 'x' * DataMessage.TRAILER_SIZE, 'hello world'):
+        message = InstantProtocolMessage(rawdata=InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'sequence': 1, 'ack': 0, 'source_id': 0x01, 'group_id': 0x01,
+                    'options': {'data_length': len(payload), 'payload': payload}}))
+        assert (message.options.fragment is None) and (message.options.payload == payload)
+
+# IDs of 16 bits are only encoded when an ID does not fit in 8 bits and the peer supports them
+def check_wide_fallback():
+    dictdata = {'type': GroupInvitationRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x101, 'group_id': 0x00, 'options': {'type': 0, 'group_id': 0x102, 'client_id': 0x103}}
+    try:
+        InstantProtocolMessage.encode(dict(dictdata))
+        assert False, 'wide IDs encoded for a peer without them'
+    except struct.error:
+        pass
+    frame = InstantProtocolMessage.encode(dict(dictdata), wide=True)
+    message = InstantProtocolMessage(rawdata=frame)
+    assert message.wide and message.extension and (message.source_id == 0x101) and ((message.options.group_id, message.options.client_id) == (0x102, 0x103))
+    assert (InstantProtocolMessage.extended_frame(frame, 0x1234) == frame[:InstantProtocolMessage.HEADER_SIZE] + '\x12\x34' + frame[(InstantProtocolMessage.HEADER_SIZE + 2):])
+    narrow = InstantProtocolMessage.encode(dict(dictdata, source_id=0x01, options={'type': 0, 'group_id': 0x02, 'client_id': 0x03}), wide=True)
+    assert (not InstantProtocolMessage(rawdata=narrow).wide) and (not InstantProtocolMessage.has_extension(narrow)) # same messages as before when the IDs fit
+    frame = InstantProtocolMessage.encode({'type': GroupCreationRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x01, 'group_id': 0x00, 'options': {'type': 1, 'client_ids': [0x02, 0x1FF]}}, wide=True)
+    assert (InstantProtocolMessage(rawdata=frame).options.client_ids == [0x02, 0x1FF])
+    ack = InstantProtocolMessage(rawdata=Acknowledgement.frame(DataMessage.TYPE, 0x1234, 0x101, 0x00, extended=1, extension=True))
+    assert ack.ack and ack.wide and ((ack.source_id, ack.sequence) == (0x101, 0x1234))
+
+# Server of the process (engine loop, nothing is received from the network): the checks give it the datagrams (_dispatch)
+# and what it sends stays in its _FakeSocket
+def _server(cluster=None):
+    server = Server(address=('127.0.0.1', 0), loss_rate=0, engine=Server.ENGINE_LOOP, cluster=cluster, stats_interval=None)
+    server.sock.close()
+    server.sock = _FakeSocket()
+    return server
+
+# extended = 0 for a client of the original protocol (Stop & Wait)
+def _connect(server, username, port, extended=1):
+    server._dispatch(InstantProtocolMessage(dictdata={'type': ConnectionRequest.TYPE, 'extended': extended, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00,
+                        'options': {'username': username}}).serialize(), ('127.0.0.1', port))
+    return server.sessions.get_by_username(username)
+
+# Messages sent by the server to the client of a session since the last call
+def _received(server, session):
+    return [InstantProtocolMessage(rawdata=frame) for frame in server.sock.by_address.pop(session.address, [])]
+
+# Next message of the client of a session (1-bit sequence, as the clients of the original protocol)
+def _request(server, session, dictdata):
+    dictdata.update(sequence=(session.last_seq_recv + 1) % 2, ack=0, source_id=session.client_id)
+    server._dispatch(InstantProtocolMessage(dictdata=dictdata).serialize(), session.address)
+
+# ACKs of the client of a session for every message in flight
+def _acknowledge(server, session):
+    for sequence, frame, sent in list(session.in_flight):
+        message = InstantProtocolMessage(rawdata=frame)
+        server._dispatch(Acknowledgement.frame(message.type, sequence, session.client_id, extension=message.extension), session.address)
+
+# The Connection Request keeps the size of the original protocol (old servers unpack exactly 8 bytes of options),
+# the client announces wide IDs in its Group ID and uses them only if the Connection Accept is wide
+def check_wide_negotiation():
+    with _clock() as (clock, wheel):
+        server = _server()
+        server.client_ids = IdAllocator([]) # 8-bit IDs exhausted
+        for port, capabilities in ((5001, 0x00), (5002, ConnectionRequest.WIDE_IDS)):
+            request = InstantProtocolMessage.encode({'type': ConnectionRequest.TYPE, 'extended': 1, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': capabilities,
+                            'options': {'username': 'user{}'.format(port)}})
+            assert (len(request) == InstantProtocolMessage.HEADER_SIZE + ConnectionRequest.PSEUDOHEADER_SIZE) and (InstantProtocolMessage(rawdata=request).options.username == 'user{}'.format(port))
+            server._dispatch(request, ('127.0.0.1', port))
+        reject = InstantProtocolMessage(rawdata=server.sock.by_address[('127.0.0.1', 5001)][0])
+        accept = InstantProtocolMessage(rawdata=server.sock.by_address[('127.0.0.1', 5002)][0])
+        assert (reject.type == ConnectionReject.TYPE) and (reject.options.error == 0)
+        assert (accept.type == ConnectionAccept.TYPE) and accept.wide and (accept.options.client_id > 0xFF) and server.sessions.get(accept.options.client_id).wide
+
+# Sessions with the same username or address (the indexes keep the first username and the last address)
+def check_directory_duplicates():
+    with _clock() as (clock, wheel):
+        first, second = _PairSession(wheel, True), _PairSession(wheel, True)
+        first.client_id, first.username, first.address, first.group_id = 1, 'alice', ('127.0.0.1', 5001), 1
+        second.client_id, second.username, second.address, second.group_id = 2, 'alice', ('127.0.0.1', 5001), 1
+        directory = SessionDirectory()
+        directory.add(first)
+        directory.add(second)
+        assert (directory.get_by_username('alice') is first) and (directory.get_by_address(('127.0.0.1', 5001)) is second)
+        directory.remove(second)
+        assert (directory.get_by_username('alice') is first) and (directory.get_by_address(('127.0.0.1', 5001)) is None)
+        directory.remove(first)
+        directory.remove(first)
+        assert (not directory.by_username) and (not directory.by_address) and (not directory.groups) and (not len(directory))
+
+# Changes of users during PRESENCE_WINDOW (or while the previous Update List waits for its ACK) are sent in one
+# Update List, a busy queue delays them PRESENCE_MAX_DELAY at most
+def check_presence():
+    with _clock() as (clock, wheel):
+        server = _server()
+        window = ServerSession.PRESENCE_WINDOW + server.scheduler.tick
+        watcher = _connect(server, 'watcher', 5000, extended=0) # Stop & Wait: one message in flight
+        _acknowledge(server, watcher)
+        _received(server, watcher)
+        for i, username in enumerate(('alice', 'bob', 'carol')):
+            _acknowledge(server, _connect(server, username, 5001 + i))
+        assert (not _received(server, watcher))
+        clock.advance(server.scheduler, window)
+        updates = _received(server, watcher)
+        assert ([message.type for message in updates] == [UpdateList.TYPE]) and ([user['username'] for user in updates[0].options.user_list] == ['alice', 'bob', 'carol'])
+        for i, username in enumerate(('dave', 'erin')):
+            _acknowledge(server, _connect(server, username, 5004 + i))
+            clock.advance(server.scheduler, window)
+        assert all((message.options.user_list == updates[0].options.user_list) for message in _received(server, watcher)) # (resent until acknowledged)
+        _acknowledge(server, watcher)
+        updates = _received(server, watcher)
+        assert ([message.type for message in updates] == [UpdateList.TYPE]) and ([user['username'] for user in updates[0].options.user_list] == ['dave', 'erin'])
+        _acknowledge(server, watcher)
+        # Lines waiting for the window: the change is sent before them once PRESENCE_MAX_DELAY has elapsed
+        for i in xrange(100):
+            line = 'line {}'.format(i)
+            watcher.send_shared(InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0,
+                                'source_id': 0x01, 'group_id': 0x01, 'options': {'data_length': len(line), 'payload': line}})))
+        _acknowledge(server, _connect(server, 'frank', 5006))
+        start, types = clock.now, list()
+        while (UpdateList.TYPE not in types):
+            clock.advance(server.scheduler, 0.05)
+            _acknowledge(server, watcher)
+            types = [message.type for message in _received(server, watcher)]
+            assert (clock.now - start <= ServerSession.PRESENCE_MAX_DELAY + 0.2), clock.now - start
+        assert (clock.now - start >= ServerSession.PRESENCE_MAX_DELAY) and (len(watcher.message_queue) > 50), (clock.now - start, len(watcher.message_queue))
+
+# The User List Response is encoded once for each version of the directory, group and width of the IDs:
+# the version changes only when a session is added, removed or changes of group
+def check_user_list_snapshot():
+    users = lambda frames: [(user['username'], user['group_id']) for user in InstantProtocolMessage(rawdata=frames[0][0]).options.user_list]
+    with _clock() as (clock, wheel):
+        server = _server()
+        snapshot = server.user_lists
+        alice, bob = _connect(server, 'alice', 5001), _connect(server, 'bob', 5002)
+        for session in (alice, bob):
+            _acknowledge(server, session)
+        version = server.sessions.version
+        frames = snapshot.get(0x01)
+        assert (snapshot.get(0x01) is frames) and (snapshot.get(0x01, True) is frames) and ((snapshot.hits, snapshot.misses) == (2, 1)) # (8-bit IDs are enough)
+        assert (users(frames) == [('alice', 0x01), ('bob', 0x01)])
+        # Messages and time do not change the directory
+        _request(server, alice, {'type': DataMessage.TYPE, 'group_id': 0x01, 'options': {'data_length': 5, 'payload': 'hello'}})
+        _request(server, bob, {'type': UserListRequest.TYPE, 'group_id': 0x01})
+        clock.advance(server.scheduler, 2.0)
+        assert (server.sessions.version == version) and (snapshot.get(0x01) is frames) and (snapshot.misses == 1)
+        # Another group: other header, same records
+        other = snapshot.get(0x05)
+        assert (other is not frames) and (InstantProtocolMessage(rawdata=other[0][0]).group_id == 0x05) and (users(other) == users(frames)) and (snapshot.misses == 2)
+        # Change of group, new user with a wide ID, disconnection: new version every time
+        alice.group_id = 0x05
+        assert (server.sessions.version == version + 1) and (snapshot.get(0x01) is not frames) and (users(snapshot.get(0x01)) == [('alice', 0x05), ('bob', 0x01)])
+        request = InstantProtocolMessage(dictdata={'type': ConnectionRequest.TYPE, 'extended': 1, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'username': 'carol'}})
+        server.sessions.add(ServerSession(server, 'carol', 0x101, ('127.0.0.1', 5003), request, True))
+        narrow, wide = snapshot.get(0x01), snapshot.get(0x01, True)
+        assert (narrow is not wide) and (snapshot.get(0x01, True) is wide) and (server.sessions.version == version + 2)
+        assert (users(narrow) == [('alice', 0x05), ('bob', 0x01)]) and (users(wide) == [('alice', 0x05), ('bob', 0x01), ('carol', 0x01)])
+        server.sessions.remove(bob)
+        assert (server.sessions.version == version + 3) and (users(snapshot.get(0x01, True)) == [('alice', 0x05), ('carol', 0x01)])
+
+# A client of the original protocol takes the first chunk of the User List Response as the ACK of its request: a copy
+# of the request brings only the chunk waiting for its ACK again, not another response
+def check_legacy_user_list():
+    with _clock() as (clock, wheel):
+        server = _server()
+        for i in xrange(UserListResponse.CHUNK_RECORDS):
+            _acknowledge(server, _connect(server, 'user{}'.format(i), 6000 + i))
+        client = _connect(server, 'legacy', 5000, extended=0)
+        _acknowledge(server, client)
+        clock.advance(server.scheduler, 2 * ServerSession.PRESENCE_WINDOW)
+        _acknowledge(server, client)
+        _received(server, client)
+        request = InstantProtocolMessage(dictdata={'type': UserListRequest.TYPE, 'sequence': (client.last_seq_recv + 1) % 2, 'ack': 0, 'source_id': client.client_id, 'group_id': 0x01}).serialize()
+        server._dispatch(request, client.address)
+        first = _received(server, client) # (lost)
+        assert ([(message.options.chunk, message.options.chunks) for message in first] == [(0, 2)]) and (len(client.message_queue) == 1)
+        server._dispatch(request, client.address) # (resent by the client)
+        again = _received(server, client)
+        assert ([(message.sequence, message.options.chunk) for message in again] == [(first[0].sequence, 0)]) and (len(client.message_queue) == 1)
+        _acknowledge(server, client)
+        chunks = _received(server, client)
+        assert ([message.options.chunk for message in chunks] == [1])
+        _acknowledge(server, client)
+        assert (not client.in_flight) and (not client.message_queue)
+
+# A client without any message for KEEPALIVE seconds is probed (empty Update List) and expires if it does not answer,
+# an active one is never probed, and nothing is scheduled while there are no sessions
+def check_keepalive():
+    probes = lambda messages: [message for message in messages if ((message.type == UpdateList.TYPE) and (not message.options.user_list))]
+    with _clock() as (clock, wheel):
+        server = _server()
+        assert (server.scheduler.pending == 0)
+        alice, bob = _connect(server, 'alice', 5001), _connect(server, 'bob', 5002)
+        for session in (alice, bob):
+            _acknowledge(server, session)
+        clock.advance(server.scheduler, 2 * ServerSession.PRESENCE_WINDOW)
+        _acknowledge(server, alice)
+        _acknowledge(server, bob)
+        idle_since, probed = clock.now, None
+        while (bob in server.sessions):
+            clock.advance(server.scheduler, 0.5)
+            if (int(clock.now) % 5 == 0): # alice is active, bob never answers again
+                _request(server, alice, {'type': UserListRequest.TYPE, 'group_id': 0x01})
+            _acknowledge(server, alice)
+            assert (not probes(_received(server, alice)))
+            if (probes(_received(server, bob)) and (probed is None)):
+                probed = clock.now - idle_since
+            assert (clock.now - idle_since < Server.KEEPALIVE + 30)
+        assert (Server.KEEPALIVE <= probed <= Server.KEEPALIVE + 2), probed
+        assert (alice in server.sessions) and (server.keepalive_timer is not None)
+        alice._expired() # (as bob)
+        clock.advance(server.scheduler, Server.KEEPALIVE + 2)
+        assert (not server.sessions.by_id) and (server.keepalive_timer is None) and (server.scheduler.pending == 0), server.scheduler.pending
+
+# A username accepted by two workers before their notices cross is kept by the lower worker
+def check_cluster_usernames():
+    for worker, other in ((1, 0), (0, 1)):
+        cluster = Cluster(2)
+        cluster.worker = worker
+        server = _server(cluster)
+        local = _connect(server, 'alice', 5001)
+        assert isinstance(local, ServerSession)
+        cluster._apply('add', other, 0x80 + other, 'alice', ('127.0.0.1', 5002), {'group_id': 0x01}, False)
+        remote = server.sessions.get(0x80 + other)
+        if (other < worker): # the local session is rejected
+            assert (server.sessions.get_by_username('alice') is remote) and (local not in server.sessions) and (not local.in_flight)
+            assert (InstantProtocolMessage(rawdata=server.sock.sent[-1]).type == ConnectionReject.TYPE) and (InstantProtocolMessage(rawdata=server.sock.sent[-1]).options.error == 1)
+        else: # the other worker rejects its session (and removes it)
+            assert (server.sessions.get_by_username('alice') is local) and (local in server.sessions)
+        cluster._apply('remove', 0x80 + other)
+        assert (server.sessions.get_by_username('alice') is (None if (other < worker) else local)) and (remote not in server.sessions)
+        for reception, sending in cluster.channels:
+            reception.close()
+            sending.close()
+
+# Data Messages fanned out to another worker faster than it reads them: datagrams of notices stay under DATAGRAM
+# bytes (whatever the size of the notices), the ones which do not fit in its queue are sent later, all in order
+def check_cluster_flush():
+    cluster = Cluster(2)
+    reception, sending = cluster.channels[1]
+    reception.setblocking(False)
+    sending.setblocking(False)
+    worker = RemoteWorker(cluster, 1, 0x01)
+    lines = ['{:04d} '.format(i) * 150 for i in xrange(2000)] # different frames (not shared by the pickles)
+    for line in lines:
+        worker.send_shared(InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'sequence': 0, 'ack': 0,
+                            'source_id': 0x01, 'group_id': 0x01, 'options': {'data_length': len(line), 'payload': line}})))
+    received, datagrams, full = list(), 0, 0
+    while (cluster.pending[1]):
+        cluster.flush()
+        full += bool(cluster.pending[1])
+        while True:
+            try:
+                data = reception.recv(Cluster.BUFFER)
+            except socket.error:
+                break
+            assert (len(data) <= Cluster.DATAGRAM), len(data)
+            datagrams += 1
+            received += cPickle.loads(data)
+    assert full and (datagrams > len(lines) / Cluster.CHUNK), (full, datagrams)
+    assert ([InstantProtocolMessage(rawdata=notice[3][0][0]).options.payload for notice in received] == lines)
+    for reception, sending in cluster.channels:
+        reception.close()
+        sending.close()
+
+# An invitation to a group whose creation expired or was cancelled cannot be accepted (its ID is used again later)
+def check_stale_invitation():
+    with _clock() as (clock, wheel):
+        server = _server()
+        alice, bob = _connect(server, 'alice', 5001), _connect(server, 'bob', 5002)
+        for session in (alice, bob):
+            _acknowledge(server, session)
+        _request(server, alice, {'type': GroupCreationRequest.TYPE, 'group_id': 0x00, 'options': {'type': 0, 'client_ids': [bob.client_id, bob.client_id]}})
+        group_id = alice.new_group_id
+        assert alice.creating_group and (alice.num_invited_clients == 1) and (bob.invited_by is alice) and (bob.invited_group_id == group_id)
+        bob.invitation_timer.cancel() # the invitation expires
+        bob.invitation_timer.callback(*bob.invitation_timer.args)
+        assert (not alice.creating_group) and (bob.invited_by is None) and (group_id not in server.group_ids.used)
+        _request(server, bob, {'type': GroupInvitationAccept.TYPE, 'group_id': 0x00, 'options': {'type': 0, 'group_id': group_id, 'client_id': bob.client_id}})
+        assert (bob.group_id == ServerSession.PUBLIC_GROUP_ID) and (not server.sessions.members(group_id))
+        _acknowledge(server, bob)
+        # Creation cancelled while the invitation is pending -> withdrawn
+        _request(server, alice, {'type': GroupCreationRequest.TYPE, 'group_id': 0x00, 'options': {'type': 0, 'client_ids': [bob.client_id]}})
+        group_id = alice.new_group_id
+        alice._cancel_group_creation()
+        assert (bob.invited_by is None) and (bob.invitation_timer not in wheel.slots[bob.invitation_timer.slot])
+        _request(server, bob, {'type': GroupInvitationReject.TYPE, 'group_id': 0x00, 'options': {'type': 0, 'group_id': group_id, 'client_id': bob.client_id}})
+        # A valid invitation is still accepted
+        _acknowledge(server, alice)
+        _request(server, alice, {'type': GroupCreationRequest.TYPE, 'group_id': 0x00, 'options': {'type': 0, 'client_ids': [bob.client_id]}})
+        group_id = alice.new_group_id
+        _request(server, bob, {'type': GroupInvitationAccept.TYPE, 'group_id': 0x00, 'options': {'type': 0, 'group_id': group_id, 'client_id': bob.client_id}})
+        assert (alice.group_id == bob.group_id == group_id) and (set(server.sessions.members(group_id)) == set([alice, bob]))
+
+# Datagrams which are not messages (empty, shorter than a header, truncated options, unknown type) are dropped and
+# the server keeps serving (the loop engine receives them from a real socket)
+def check_malformed():
+    server = Server(address=('127.0.0.1', 0), loss_rate=0, engine=Server.ENGINE_LOOP, stats_interval=None)
+    thread = threading.Thread(target=server._run_loop, name='CheckServer')
+    thread.daemon = True
+    thread.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2.0)
+    address = server.sock.sock.getsockname()
+    unknown = InstantProtocolMessage.HEADER_STRUCT.pack(0x1F << 3, 0x01, 0x01, InstantProtocolMessage.HEADER_SIZE)
+    truncated = InstantProtocolMessage.HEADER_STRUCT.pack(ConnectionRequest.TYPE << 3, 0x00, 0x00, InstantProtocolMessage.HEADER_SIZE)
+    for datagram in ('', '\x00', '\x00' * (InstantProtocolMessage.HEADER_SIZE - 1), unknown, truncated):
+        client.sendto(datagram, address)
+    client.sendto(InstantProtocolMessage(dictdata={'type': ConnectionRequest.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00,
+                    'options': {'username': 'alice'}}).serialize(), address)
+    reply = InstantProtocolMessage(rawdata=client.recvfrom(2048)[0]) # (in order on loopback: after the others)
+    try:
+        assert thread.is_alive() and (reply.type == ConnectionAccept.TYPE) and (server.malformed == 4), (reply, server.malformed)
+    finally:
+        server.stop()
+        thread.join()
+        server.close()
+        client.close()
+
+# The metrics endpoint answers from the thread of the sessions (the gauges read them), and stops with the server
+def check_metrics_endpoint():
+    server = Server(address=('127.0.0.1', 0), loss_rate=0, engine=Server.ENGINE_LOOP, stats_address=('127.0.0.1', 0), stats_interval=None)
+    thread = threading.Thread(target=server._run_loop, name='CheckServer')
+    thread.daemon = True
+    thread.start()
+    METRICS.gauge('check.thread', lambda: threading.current_thread().name)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2.0)
+    try:
+        client.sendto('json', server.stats.address)
+        snapshot = json.loads(client.recvfrom(MetricsServer.MAX_SIZE)[0])
+        assert (snapshot['check.thread'] == 'CheckServer') and ('server.sessions' in snapshot), snapshot.get('check.thread')
+    finally:
+        del METRICS.metrics['check.thread']
+        server.stop()
+        thread.join()
+        stats = server.stats
+        server.close()
+        client.close()
+    assert (not stats.thread) and (not stats.running)
+
+# Requests with the client ID of another client (from another address) are dropped as malformed, before the rate
+# of that client is charged: a flood with a spoofed ID does not throttle its real client
+def check_spoofed_source():
+    with _clock() as (clock, wheel):
+        server = _server()
+        alice, bob = _connect(server, 'alice', 5001), _connect(server, 'bob', 5002)
+        for session in (alice, bob):
+            _acknowledge(server, session)
+        clock.advance(server.scheduler, 2 * ServerSession.PRESENCE_WINDOW)
+        for session in (alice, bob):
+            _acknowledge(server, session)
+            _received(server, session)
+        flood = InstantProtocolMessage(dictdata={'type': DataMessage.TYPE, 'sequence': (alice.last_seq_recv + 1) % 2, 'ack': 0, 'source_id': alice.client_id, 'group_id': 0x01,
+                    'options': {'data_length': 4, 'payload': 'fake'}}).serialize()
+        for i in xrange(2 * Server.CLIENT_RATE[1]):
+            server._dispatch(flood, ('127.0.0.1', 6666))
+        assert (server.malformed == 2 * Server.CLIENT_RATE[1]) and (not server.client_limiter.throttled) and (not _received(server, bob))
+        _request(server, alice, {'type': DataMessage.TYPE, 'group_id': 0x01, 'options': {'data_length': 4, 'payload': 'real'}})
+        assert ([message.options.payload for message in _received(server, bob)] == ['real'])
+
+# A Connection Accept never acknowledged (flood of requests) is resent CONNECT_RETRIES times, then its place
+# in max_pending is given to the next request
+def check_pending_expiry():
+    with _clock() as (clock, wheel):
+        server = _server()
+        server.max_pending = 1
+        flood = _connect(server, 'flood', 6666)
+        assert (_connect(server, 'user', 5001) is None) and (server.pending_rejected == 1)
+        elapsed = 0
+        while (flood in server.sessions):
+            clock.advance(server.scheduler, 0.5)
+            elapsed += 0.5
+            assert (elapsed < 2 ** (ServerSession.CONNECT_RETRIES + 1) * ServerSession.RESEND_TIMER + 1)
+        assert (len(_received(server, flood)) == ServerSession.CONNECT_RETRIES + 1) and (not server.pending)
+        user = _connect(server, 'user', 5001)
+        _acknowledge(server, user)
+        assert (user in server.sessions) and (user.state != ServerSession.STATE_PENDING_CONN)
+
+CHECKS = {
+    'codec': check_codec,
+    'extended_switch': check_extended_switch,
+    'legacy_peer': check_legacy_peer,
+    'legacy_user_list': check_legacy_user_list,
+    'go_back_n': check_go_back_n,
+    'keepalive': check_keepalive,
+    'user_list_chunks': check_user_list_chunks,
+    'fragments': check_fragments,
+    'wide_fallback': check_wide_fallback,
+    'wide_negotiation': check_wide_negotiation,
+    'directory_duplicates': check_directory_duplicates,
+    'cluster_usernames': check_cluster_usernames,
+    'cluster_flush': check_cluster_flush,
+    'pending_expiry': check_pending_expiry,
+    'spoofed_source': check_spoofed_source,
+    'stale_invitation': check_stale_invitation,
+    'user_list_snapshot': check_user_list_snapshot,
+    'malformed': check_malformed,
+    'message_queue': check_message_queue,
+    'metrics_endpoint': check_metrics_endpoint,
+    'presence': check_presence,
+}
+
+# Execution (python Checks.py [<check> ...])
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or sorted(CHECKS)):
+        CHECKS[name]()
+        print('{0:<24}{1:>8}'.format(name, 'ok'))
@@ -10,7 +10,10 @@ import logging as log
 
 from InstantProtocol import *
 from SocketError import *
+from Scheduler import *
 from ClientSession import *
+from Reassembly import *
+from Metrics import *
 
 class Client(object):
     SERVER_ID = 0x00
@@ -23,19 +26,28 @@ class Client(object):
     STATE_DISJOINT = 5
     STATE_DISCONNECTED = 6
 
-    def __init__(self, server_address=('localhost', 1313), buffer=1024, loss_rate=5):
+    def __init__(self, server_address=('localhost', 1313), buffer=1024, loss_rate=5, extended=True, window=ReliableSession.WINDOW, wide=True, queue_limit=MessageQueue.LIMIT, queue_policy=MessageQueue.COALESCE):
         self.server_address = server_address
+        self.extended = extended # extended mode with the server and users which support it (sliding window)
+        self.wide = wide # 16-bit IDs if the server needs them (see ConnectionRequest)
+        self.window = window
+        self.queue_limit = queue_limit # Data Messages waiting for each session (see MessageQueue)
+        self.queue_policy = queue_policy
         self.username = None # asked later
         self.client_id = 0 # changed later
         self.group_id = 1 # public by default
         self.decentralized = False # centralized by default
         self.state = self.STATE_PENDING_CONN
         self.user_list = list() # it stores all users' information (ClientInfo) -> small database
+        self.reassembler = Reassembler() # long messages received in fragments
+        self.message_id = 0 # Message ID of our last message sent in fragments
+        self.scheduler = TimerWheel().start() # resend and invitation timers (single thread)
         self.server_session = ClientSessionServer(self, server_address)
         self.user_sessions = list() # it stores others' sessions in decentralized mode
         self.sock = SocketError(socket.AF_INET, socket.SOCK_DGRAM, loss_rate) # UDP with some packet loss
         self.inputs = [ self.sock.sock, sys.stdin ] # (inputs of select) socket reception and user input
         self.buffer = buffer
+        self._register_metrics()
 
     # Execute chat
     def run(self):
@@ -50,6 +62,7 @@ class Client(object):
                 readable, _, _ = select.select([ self.sock.sock ], [], [], 3) # wait 1 second
                 if (not readable):
                     print('Server unreachable')
+                    self.close()
                     sys.exit(1) # error
                 else:
                     data, _ = self.sock.recvfrom(self.buffer)
@@ -61,6 +74,7 @@ class Client(object):
                     elif (message.type == ConnectionReject.TYPE):
                         self.server_session.connection_reject(message)
             except KeyboardInterrupt: # Ctrl + C
+                self.close()
                 sys.exit(0)
 
         # 2. Chat & Group Management (general)
@@ -152,8 +166,10 @@ class Client(object):
                                 print('\033[1muser\t\tgroup\033[0m')
                                 for user in self.user_list:
                                     print('{0:8}\t{1}'.format(user.username, user.group_id))
+                            elif (arguments[0] == '/stats'):
+                                print(METRICS.format())
                             elif (arguments[0] == '/help'):
-                                print('\033[1mCommands\n\033[0m/create_group <0|1> <usernames> (where 0 is centralized and 1 decentralized)\n/invite_group <username>\n/disjoint\n/exit\n/list')
+                                print('\033[1mCommands\n\033[0m/create_group <0|1> <usernames> (where 0 is centralized and 1 decentralized)\n/invite_group <username>\n/disjoint\n/exit\n/list\n/stats')
                         else:
                             if (user_input): # ignore if user press enter
                                 # Centralized mode
@@ -171,7 +187,24 @@ class Client(object):
 
         if (self.state == self.STATE_DISCONNECTED):
             log.info('Closing client...')
-            self.sock.close()
+            self.close()
+
+    # The timer thread is stopped before the interpreter exits (a daemon thread would run during its shutdown)
+    def close(self):
+        self.scheduler.stop()
+        self.sock.close()
+
+    # Gauges of the client (see Metrics, /stats)
+    def _register_metrics(self):
+        sessions = lambda: [self.server_session] + self.user_sessions
+        METRICS.gauge('client.users', lambda: len(self.user_list))
+        METRICS.gauge('client.peers', lambda: len(self.user_sessions))
+        METRICS.gauge('client.queue.messages', lambda: sum(len(session.message_queue) for session in sessions()))
+        METRICS.gauge('client.in_flight', lambda: sum(len(session.in_flight) for session in sessions()))
+        METRICS.gauge('client.timers', lambda: self.scheduler.pending)
+        METRICS.gauge('client.rtt.server', lambda: self.server_session.rtt.srtt)
+        METRICS.gauge('client.reassembly.pending', lambda: self.reassembler.pending)
+        METRICS.gauge('client.reassembly.dropped', lambda: self.reassembler.dropped)
 
 # Execution
 if __name__ == '__main__':
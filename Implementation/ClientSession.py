@@ -3,10 +3,14 @@
 # Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
 # Erika Tarazona <erika.tarazona@imt-atlantique.net>
 
-import threading
 import logging as log
 
 from InstantProtocol import *
+from ReliableSession import *
+
+_LINES_SENT = METRICS.counter('client.lines.sent')
+_FRAGMENTS_SENT = METRICS.counter('client.fragments.sent')
+_LINES_RECEIVED = METRICS.counter('client.lines.received')
 
 # Entry for each user (list as small database)
 class ClientInfo(object):
@@ -24,26 +28,49 @@ class SessionNotFound(Exception):
     pass
 
 # Base object for session used for server (always) and other clients (decentralized mode)
-class ClientSession(object):
+class ClientSession(ReliableSession):
     NO_GROUP_ID = 0x00
-    STATE_IDLE = 0 # ready to send
-    STATE_ACK = 1 # waiting for ack
-    RESEND_TIMER = 0.5 # resend in 500ms
 
     def __init__(self, client, address):
+        super(ClientSession, self).__init__(address, client.scheduler, client.extended, client.window, client.queue_limit, client.queue_policy)
         self.client = client
-        self.address = address
-        self.state = self.STATE_IDLE
-        self.last_seq_sent = 0
-        self.last_seq_recv = 0
-        self.message_queue = list()
-        self.timer = None
 
     # At least, this methods have to be implemented
     #def data_message_send(self, text)
     #def data_message_reception(self, message)
     #def acknowledgement(self, message)
-    #def _send(self, dictdata, retry=1)
+    #def _expired(self)
+
+    def _local_id(self):
+        return self.client.client_id
+
+    def _sendto(self, frame):
+        self.client.sock.sendto(frame, self.address)
+
+    # Text of a Data Message, in fragments if it does not fit in a datagram and the peer supports them (extended mode)
+    def _send_data(self, text):
+        parts = DataMessage.split(text[:DataMessage.MAX_LENGTH])
+        _LINES_SENT.inc()
+        if ((len(parts) == 1) or (not (self.peer_extended and self.extended_capable))):
+            text = parts[0] # the peer would truncate a longer message (receive buffer)
+            self._send(dictdata={'type': DataMessage.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.client.group_id, 'options': {'data_length': len(text), 'payload': text}})
+            return
+        self.client.message_id = (self.client.message_id + 1) % 0x10000
+        log.debug('[Data Message] message_id={}, fragments={}'.format(self.client.message_id, len(parts)))
+        _FRAGMENTS_SENT.inc(len(parts))
+        for i, part in enumerate(parts): # queued at once, the window sends several of them without waiting
+            self._send(dictdata={'type': DataMessage.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.client.group_id,
+                                'options': {'data_length': len(part), 'payload': part, 'fragment': (self.client.message_id, i, len(parts))}})
+
+    # Text of a Data Message received (None until the last fragment of a long message)
+    def _received_data(self, message):
+        if (message.options.fragment is None):
+            _LINES_RECEIVED.inc()
+            return message.options.payload
+        payload = self.client.reassembler.add(message.source_id, message.options)
+        if (payload is not None):
+            _LINES_RECEIVED.inc()
+        return payload
 
 # Class for sessions used by server (always used), it implements its own functions
 class ClientSessionServer(ClientSession):
@@ -56,31 +83,31 @@ class ClientSessionServer(ClientSession):
         self.invitation_timer = None
 
     def __repr__(self):
-        return 'ClientSessionServer(client={}, address={}, last_seq_sent={}, last_seq_recv={}, state={}, message_queue={}, timer={}, temporal_group_id={}, temporal_group_type={}, invitation_timer={})'.format(
-            self.client, self.address, self.last_seq_sent, self.last_seq_recv, self.state, self.message_queue, self.timer, self.temporal_group_id, self.temporal_group_type, self.invitation_timer)
+        return 'ClientSessionServer(client={}, address={}, last_seq_sent={}, last_seq_recv={}, state={}, message_queue={}, timer={}, rtt={}, temporal_group_id={}, temporal_group_type={}, invitation_timer={})'.format(
+            self.client, self.address, self.last_seq_sent, self.last_seq_recv, self.state, self.message_queue, self.timer, self.rtt, self.temporal_group_id, self.temporal_group_type, self.invitation_timer)
 
     def connection_request(self, username):
         if (self.client.state == self.client.STATE_PENDING_CONN):
             self.client.username = ('{0: <8}'.format(username)).strip() # only 8 bytes
             log.info('[Connection Request] username={}'.format(username))
-            self._send(dictdata={'type': ConnectionRequest.TYPE, 'ack': 0, 'source_id': 0x00, 'group_id': self.NO_GROUP_ID, 'options': {'username': username}})
+            capabilities = ConnectionRequest.WIDE_IDS if (self.client.wide and self.extended_capable) else self.NO_GROUP_ID
+            self._send(dictdata={'type': ConnectionRequest.TYPE, 'extended': self.extended_capable, 'ack': 0, 'source_id': 0x00, 'group_id': capabilities, 'options': {'username': username}})
 
     # only for server (id = 0x00)
     def connection_accept(self, message):
         if (self.client.state == self.client.STATE_PENDING_CONN):
             self.client.state = self.client.STATE_NORMAL
             self.client.client_id = message.options.client_id
-            self.timer.cancel() # stop timer (implicit ACK)
-            self.state = self.STATE_IDLE
-            log.info('[Connection] username={}, id={}'.format(self.client.username, self.client.client_id))
+            self.wide = message.wide # the server accepted wide IDs
+            self._acknowledged() # implicit ACK
+            log.info('[Connection] username={}, id={}, wide={}'.format(self.client.username, self.client.client_id, self.wide))
             print('\033[1mLogged in as {}\033[0m'.format(self.client.username))
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     # only for server (id = 0x00)
     def connection_reject(self, message):
         if (self.client.state == self.client.STATE_PENDING_CONN):
-            self.timer.cancel() # stop timer (implicit ACK)
-            self.state = self.STATE_IDLE
+            self._acknowledged() # implicit ACK
             if (message.options.error == 0):
                 log.info('[Connection] (Failed -> maximum reached')
                 print('\033[1mConnection failed -> maximum number of users reached\033[0m')
@@ -89,35 +116,46 @@ class ClientSessionServer(ClientSession):
                 print('\033[1mConnection failed -> username already taken\033[0m')
             else:
                 print('\033[1mConnection failed\033[0m')
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def user_list_request(self):
         log.info('[User List Request] username={}'.format(self.client.username))
         self._send(dictdata={'type': UserListRequest.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.client.group_id})
 
+    # The list comes in chunks, each one is added as it arrives (users already known by an Update List are
+    # updated, not added again)
     def user_list_response(self, message):
-        if (message.sequence != self.last_seq_recv): # we always send an ACK even if the message is repeated (lost ACK)
-            self.timer.cancel() # stop timer (implicit ACK)
-            self.state = self.STATE_IDLE # response has implicit ACK
+        if (self._is_new(message)): # we always send an ACK even if the message is repeated (lost ACK)
+            # First chunk = implicit ACK of our request (only while it waits for it, the server acknowledges it in extended mode)
+            if ((not self.extended) and (message.options.chunk == 0) and self.in_flight and ((ord(self.in_flight[0][1][0]) >> 3) == UserListRequest.TYPE)):
+                self._acknowledged(self.in_flight[0][0])
             # Create list (add also ourselves)
+            known_users = dict((user.client_id, user) for user in self.client.user_list)
             for user in message.options.user_list:
-                self.client.user_list.append(ClientInfo(user['username'], user['client_id'], user['group_id'], (user['ip_address'], user['port'])))
-            log.info('[User List Response] list={}'.format(self.client.user_list))
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+                if (user['client_id'] in known_users):
+                    known_users[user['client_id']].group_id = user['group_id'] # only group_id can change
+                else:
+                    self.client.user_list.append(ClientInfo(user['username'], user['client_id'], user['group_id'], (user['ip_address'], user['port'])))
+            log.debug('[User List Response] chunk={}/{}, users={}'.format(message.options.chunk + 1, message.options.chunks, len(message.options.user_list)))
+            if (message.options.chunk == message.options.chunks - 1): # last chunk
+                log.info('[User List Response] list={}'.format(self.client.user_list))
+        self._send_ack(message)
 
     def data_message_send(self, text):
         log.info('[Data Message] (Send message) text={}'.format(text))
-        self._send(dictdata={'type': DataMessage.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.client.group_id, 'options': {'data_length': len(text), 'payload': text}})
+        self._send_data(text)
 
     def data_message_reception(self, message):
         # Centralized mode (server_session handles this messages)
-        if (message.sequence != self.last_seq_recv):
-            log.info('[Data Message] (Receive message) text={}'.format(message.options.payload))
-            for user in self.client.user_list:
-                if (user.client_id == message.source_id):
-                    print('\033[1m{}:\033[0m {}'.format(user.username, message.options.payload))
-                    break
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        if (self._is_new(message)):
+            payload = self._received_data(message)
+            if (payload is not None):
+                log.info('[Data Message] (Receive message) text={}'.format(payload))
+                for user in self.client.user_list:
+                    if (user.client_id == message.source_id):
+                        print('\033[1m{}:\033[0m {}'.format(user.username, payload))
+                        break
+        self._send_ack(message)
 
     def group_creation_request(self, group_type, raw_clients):
         # Create Group only when client is in Public Group
@@ -136,7 +174,7 @@ class ClientSessionServer(ClientSession):
             print('\033[1mCannot create a group under your current situation\033[0m')
 
     def group_creation_accept(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             if (self.client.state == self.client.STATE_WAIT_GROUP):
                 log.info('[Group Creation] (Accept receive) group_type={}, group_id={}'.format(message.options.type, message.options.group_id))
                 self.client.state = self.client.STATE_NORMAL
@@ -149,15 +187,15 @@ class ClientSessionServer(ClientSession):
                         break
                 # Sessions in decentralized mode will be created based on UpdateList messages
                 print('\033[1mChanging to group {} in {} mode\033[0m'.format(self.client.group_id, 'centralized' if (not self.client.decentralized) else 'decentralized'))
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def group_creation_reject(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             if (self.client.state == self.client.STATE_WAIT_GROUP):
                 log.info('[Group Creation] (Reject receive)')
                 self.client.state = self.client.STATE_NORMAL
                 print('\033[1mGroup creation rejected\033[0m')
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def group_invitation_request_send(self, usernames):
         if (self.client.group_id != self.client.PUBLIC_GROUP_ID): # We can only invite to a private group
@@ -169,18 +207,17 @@ class ClientSessionServer(ClientSession):
             print('Cannot invite users to public group')
 
     def group_invitation_request_reception(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             # Send ACK and after we'll send a reject if it isn't possible to invite
             if (self.client.state == self.client.STATE_NORMAL):
                 log.info('[Group Invitation] (Request receive) group_type={}, group_id={}'.format(message.options.type, message.options.group_id))
                 self.client.state = self.client.STATE_PENDING_INV
                 self.temporal_group_id = message.options.group_id
                 self.temporal_group_type = message.options.type
-                self.invitation_timer = threading.Timer(self.INVITATION_TIMER, self._invitation_expired)
-                self.invitation_timer.start()
+                self.invitation_timer = self.scheduler.call_later(self.INVITATION_TIMER, self._invitation_expired)
             else:
                 self._send(dictdata={'type': GroupInvitationReject.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': message.options.type, 'group_id': message.options.group_id, 'client_id': message.options.client_id}})
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def group_invitation_accept_send(self):
         if (self.client.state == self.client.STATE_PENDING_INV):
@@ -206,10 +243,10 @@ class ClientSessionServer(ClientSession):
                         self.client.user_sessions.append(ClientSessionClient(self.client, user.username, user.client_id, user.address))
 
     def group_invitation_accept_reception(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             # Changes in UpdateList
             log.info('[Group Invitation] (Accept receive) client_id={}'.format(message.source_id))
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def group_invitation_reject_send(self):
         if (self.client.state == self.client.STATE_PENDING_INV):
@@ -220,13 +257,13 @@ class ClientSessionServer(ClientSession):
             self.temporal_group_id = self.temporal_group_type = 0
 
     def group_invitation_reject_reception(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             log.info('[Group Invitation] (Reject receive) client_id={}'.format(message.source_id))
             for user in self.client.user_list:
                 if (user.client_id == message.source_id):
                     print('\033[1mInvitation rejected by {}\033[0m'.format(user.username))
                     break
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def group_disjoint_request(self):
         if (self.client.group_id != self.client.PUBLIC_GROUP_ID):
@@ -240,17 +277,17 @@ class ClientSessionServer(ClientSession):
             print('\033[1mCannot disjoint from Public Group\033[0m')
 
     def group_dissolution(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             log.info('[Group Dissolution] (Obliged)')
             if (self.client.decentralized):
                 self.client.user_sessions = list() # empty list
             self.client.group_id = self.client.PUBLIC_GROUP_ID
             self.client.decentralized = False # centralized by default
             print('\033[1mYou have left the group (you were alone)\033[0m')
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def update_list(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             for new_user in message.options.user_list:
                 found = False
                 for old_user in self.client.user_list:
@@ -275,10 +312,10 @@ class ClientSessionServer(ClientSession):
                         print('\033[1m{} has joined the group\033[0m'.format(new_user['username']))
 
             log.info('[Update List] list={}'.format(self.client.user_list))
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def update_disconnection(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             for user in self.client.user_list:
                 if (user.client_id == message.options.client_id): # it is possible we don't have this user
                     log.info('[Update Disconnection] client_id={}'.format(user.client_id))
@@ -291,7 +328,7 @@ class ClientSessionServer(ClientSession):
                                 if (session.client_id == message.options.client_id):
                                     self.client.user_sessions.remove(session)
                     break # we found the user -> out of loop
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        self._send_ack(message)
 
     def disconnection_request(self):
         log.info('[Disconnection Request] username={}'.format(self.client.username))
@@ -299,55 +336,19 @@ class ClientSessionServer(ClientSession):
         self._send(dictdata={'type': DisconnectionRequest.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
 
     def acknowledgement(self, message):
-        if (message.sequence == self.last_seq_sent): # it can be for connection or any other message
+        if (self._acknowledges(message)): # it can be for connection or any other message
             log.debug('[ACK] ACK received')
-            self.state = self.STATE_IDLE
-            self.timer.cancel() # stop timer
-            if (len(self.message_queue)): # send first message in queue if exists
-                self._send(self.message_queue.pop(0))
-                log.debug('[STATE_IDLE] Message dequeued')
+            self._acknowledged(message.sequence)
             # if user waits for DisconnectionACK
             if ((message.type == DisconnectionRequest.TYPE) and (self.client.state == self.client.STATE_PENDING_DISC)):
                 self.client.state = self.client.STATE_DISCONNECTED
 
-    # Private function (send with reliability)
-    def _send(self, dictdata, retry=5):
-        # When ACK there's no UDP reliability
-        if ((dictdata.get('ack') == 0x01)):
-            self.last_seq_recv = dictdata.get('sequence') # client always replies with an ACK
-            message = InstantProtocolMessage(dictdata=dictdata)
-            log.debug('[---] Sending ACK -> {}'.format(message))
-            self.client.sock.sendto(message.serialize(), self.address)
-        ## UDP reliability
-        elif (retry == 5): # first attempt
-            # Can we send?
-            if (self.state == self.STATE_IDLE):
-                self.last_seq_sent = 1 - self.last_seq_sent # swap: 0 to 1 and viceversa
-                dictdata['sequence'] = self.last_seq_sent # set sequence (different each message)
-                message = InstantProtocolMessage(dictdata=dictdata)
-                log.debug('[STATE_IDLE] Sending message (retry={}) -> {}'.format(retry, message))
-                self.client.sock.sendto(message.serialize(), self.address)
-                # ACK mode and timer to resend
-                self.state = self.STATE_ACK
-                self.timer = threading.Timer(self.RESEND_TIMER, self._send, [dictdata, retry - 1])
-                self.timer.start()
-
-            else: # self.state == self.STATE_ACK
-                log.debug('[STATE_ACK] (Message queued') # don't print the message because it doesn't have sequence yet
-                self.message_queue.append(dictdata)
-
-        elif (retry > -1): # next attempts
-            message = InstantProtocolMessage(dictdata=dictdata)
-            log.debug('[STATE_IDLE] Sending message (retry={}) -> {}'.format(retry, message))
-            self.client.sock.sendto(message.serialize(), self.address)
-            self.timer = threading.Timer(self.RESEND_TIMER, self._send, [dictdata, retry - 1])
-            self.timer.start()
-
-        elif (retry == -1): # last attempt expired -> not connected
-            # Server unreachable or server unreachable for disconnection -> disconnected automatically
-            log.info('[Server unreachable] (Timer expired)')
-            #print('Server unreachable')
-            self.client.state = self.client.STATE_DISCONNECTED
+    # Last attempt expired -> not connected
+    def _expired(self):
+        # Server unreachable or server unreachable for disconnection -> disconnected automatically
+        log.info('[Server unreachable] (Timer expired)')
+        #print('Server unreachable')
+        self.client.state = self.client.STATE_DISCONNECTED
 
     # This function is called when invitation timer expires (15 seconds to answer)
     def _invitation_expired(self):
@@ -362,65 +363,33 @@ class ClientSessionClient(ClientSession):
         super(ClientSessionClient,self).__init__(client, address)
         self.username = username
         self.client_id = client_id # self.group_id is not required because session is created in decentralized mode (only users of the same group)
+        self.wide = client.server_session.wide
+        if (self.wide and (not InstantProtocolMessage.fits(client.client_id, client.group_id))): # every user of the group supports wide IDs (see ServerSession._can_join)
+            self.peer_extended = True # our messages need them from the first one (extended mode)
 
     def __repr__(self):
-        return 'ClientSessionClient(client={}, address={}, last_seq_sent={}, last_seq_recv={}, state={}, message_queue={}, timer={}, username={}, client_id={}'.format(
-            self.client, self.address, self.last_seq_sent, self.last_seq_recv, self.state, self.message_queue, self.username, self.client_id)
+        return 'ClientSessionClient(client={}, address={}, last_seq_sent={}, last_seq_recv={}, state={}, message_queue={}, timer={}, rtt={}, username={}, client_id={})'.format(
+            self.client, self.address, self.last_seq_sent, self.last_seq_recv, self.state, self.message_queue, self.timer, self.rtt, self.username, self.client_id)
 
     def data_message_send(self, text):
         log.info('[Data Message] (Send message) text={}'.format(text))
-        self._send(dictdata={'type': DataMessage.TYPE, 'ack': 0, 'source_id': self.client.client_id, 'group_id': self.client.group_id, 'options': {'data_length': len(text), 'payload': text}})
+        self._send_data(text)
 
     def data_message_reception(self, message):
-        if (message.sequence != self.last_seq_recv):
-            log.info('[Data Message] (Receive message) text={}'.format(message.options.payload))
-            print('\033[1m{}:\033[0m {}'.format(self.username, message.options.payload))
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.client.client_id, 'group_id': self.NO_GROUP_ID})
+        if (self._is_new(message)):
+            payload = self._received_data(message)
+            if (payload is not None):
+                log.info('[Data Message] (Receive message) text={}'.format(payload))
+                print('\033[1m{}:\033[0m {}'.format(self.username, payload))
+        self._send_ack(message)
 
     def acknowledgement(self, message):
-        if (message.sequence == self.last_seq_sent): # it can be for connection or any other message
+        if (self._acknowledges(message)): # it can be for connection or any other message
             log.debug('[ACK] ACK received')
-            self.state = self.STATE_IDLE
-            self.timer.cancel() # stop timer
-            #log.debug('[STATE_ACK] Stop timer -> {}'.format(message))
-            if (len(self.message_queue)): # send first message in queue if exists
-                self._send(self.message_queue.pop(0))
-                log.debug('[STATE_IDLE] Message dequeued')
-
-    # Private function (send with reliability)
-    def _send(self, dictdata, retry=5):
-        # When ACK there's no UDP reliability
-        if ((dictdata.get('ack') == 0x01)):
-            self.last_seq_recv = dictdata.get('sequence') # if we send an ACK, we are acknowledging the last sequence
-            message = InstantProtocolMessage(dictdata=dictdata)
-            log.debug('[---] Sending ACK -> {}'.format(message))
-            self.client.sock.sendto(message.serialize(), self.address)
-        ## UDP reliability
-        elif (retry == 5): # first attempt
-            # Can we send?
-            if (self.state == self.STATE_IDLE):
-                self.last_seq_sent = 1 - self.last_seq_sent # swap: 0 to 1 and viceversa
-                dictdata['sequence'] = self.last_seq_sent # set sequence (different each message)
-                message = InstantProtocolMessage(dictdata=dictdata)
-                log.debug('[STATE_IDLE] Sending message (retry={}) -> {}'.format(retry, message))
-                self.client.sock.sendto(message.serialize(), self.address)
-                # ACK mode and timer to resend
-                self.state = self.STATE_ACK
-                self.timer = threading.Timer(self.RESEND_TIMER, self._send, [dictdata, retry - 1])
-                self.timer.start()
-
-            else: # self.state == self.STATE_ACK
-                log.debug('[STATE_ACK] Message queued') # don't print the message because it doesn't have sequence yet
-                self.message_queue.append(dictdata)
-
-        elif (retry > -1): # next attempts
-            message = InstantProtocolMessage(dictdata=dictdata)
-            log.debug('[STATE_IDLE] Sending message (retry={}) -> {}'.format(retry, message))
-            self.client.sock.sendto(message.serialize(), self.address)
-            self.timer = threading.Timer(self.RESEND_TIMER, self._send, [dictdata, retry - 1])
-            self.timer.start()
-
-        elif (retry == -1): # last attempt expired -> not connected
-            log.info('[User unreachable] (Timer expired) username={}'.format(self.username))
-            if (self in self.client.user_sessions):
-                self.client.user_sessions.remove(self) # remove itself from the list (no message to server, it will realize later)
+            self._acknowledged(message.sequence)
+
+    # Last attempt expired -> not connected
+    def _expired(self):
+        log.info('[User unreachable] (Timer expired) username={}'.format(self.username))
+        if (self in self.client.user_sessions):
+            self.client.user_sessions.remove(self) # remove itself from the list (no message to server, it will realize later)
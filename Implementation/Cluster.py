@@ -0,0 +1,280 @@
+# Cluster.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import os
+import errno
+import signal
+import socket
+import cPickle
+import logging as log
+
+from SessionDirectory import *
+from ServerSession import *
+
+# Server processes sharing the UDP port (SO_REUSEPORT, the kernel keeps each client address on the same worker)
+# Every worker serves its own sessions and knows the sessions of the others (RemoteSession):
+#   - sessions added, removed or changed of group are announced to the other workers
+#   - calls to a RemoteSession (invitations, dissolution...) are executed by the worker of the session
+#   - what is sent to a group or to everybody (Data Message, Update List...) is sent once to each worker (RemoteWorker),
+#     which sends it to its own members (a session just connected to a worker receives it even if the others don't know it yet)
+# A username accepted by two workers at the same time is kept by the lower worker, the session of the other one is rejected
+# Notices are sent through AF_UNIX datagram sockets, in order, once per loop iteration (flush), as many in each datagram
+# as fit in DATAGRAM bytes (far below the send buffer of the socket and the BUFFER of the receiver)
+# Sending never blocks (two workers sending to each other would wait forever): notices which do not fit are kept
+# and sent again when the socket is writable (outputs)
+class Cluster(object):
+    BUFFER = 262144
+    CHUNK = 256 # notices per datagram (at most)
+    DATAGRAM = 65536 # bytes per datagram (at most, fewer notices are sent together when they are larger)
+
+    def __init__(self, workers):
+        if (not hasattr(socket, 'SO_REUSEPORT')): # the workers could not share the port (no worker is started)
+            raise RuntimeError('SO_REUSEPORT is not supported by this system, the server cannot run {} workers'.format(workers))
+        self.workers = workers
+        self.worker = 0 # index of this process (0 = the process which started the others)
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for i in xrange(workers)] # (reception, sending) of each worker
+        self.pending = [list() for i in xrange(workers)] # notices for each worker (sent by flush)
+        self.directory = None # SharedDirectory of this worker
+
+    def __repr__(self):
+        return 'Cluster(workers={}, worker={})'.format(self.workers, self.worker)
+
+    # main(cluster) is executed by every worker (this process is the first one), Ctrl + C stops all of them
+    def run(self, main):
+        children = list()
+        for worker in xrange(1, self.workers):
+            pid = os.fork()
+            if (pid == 0):
+                self.worker = worker
+                try:
+                    self._start(main)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        try:
+            self._start(main)
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError: # already finished
+                    pass
+                os.waitpid(pid, 0)
+
+    def _start(self, main):
+        log.info('[Cluster] worker={}, pid={}'.format(self.worker, os.getpid()))
+        for reception, sending in self.channels:
+            reception.setblocking(False)
+            sending.setblocking(False)
+        main(self)
+
+    def fileno(self):
+        return self.channels[self.worker][0].fileno()
+
+    # Sockets with notices waiting to be sent (select)
+    def outputs(self):
+        return [self.channels[worker][1] for worker, notices in enumerate(self.pending) if (notices)]
+
+    # Client IDs and group IDs of this worker (every worker takes a different part of the pool)
+    def share(self, pool):
+        return [i for i in pool if (i % self.workers == self.worker)]
+
+    def publish(self, notice):
+        for worker in xrange(self.workers):
+            if (worker != self.worker):
+                self.pending[worker].append(notice)
+
+    def call(self, session, method, args):
+        self.pending[session.worker].append(('call', session.client_id, method, [self._encode(arg) for arg in args]))
+
+    def fanout(self, worker, group_id, method, args):
+        self.pending[worker].append(('fanout', group_id, method, [self._encode(arg) for arg in args]))
+
+    # Pending notices are sent (end of each loop iteration)
+    def flush(self):
+        for worker, notices in enumerate(self.pending):
+            count = self.CHUNK
+            while (notices):
+                data = cPickle.dumps(notices[:count], cPickle.HIGHEST_PROTOCOL) # the same frames are pickled once
+                if ((len(data) > self.DATAGRAM) and (count > 1)): # too large -> half of the notices
+                    count /= 2
+                    continue
+                try:
+                    self.channels[worker][1].send(data)
+                except socket.error as e:
+                    if (e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)): # queue of the worker full, sent later
+                        break
+                    if ((e.errno == errno.EMSGSIZE) and (count > 1)): # larger than the send buffer
+                        count /= 2
+                        continue
+                    if (e.errno == errno.EMSGSIZE): # a notice alone does not fit: it is lost, not the worker
+                        log.error('[Cluster] notice of {} bytes dropped: {}'.format(len(data), notices[0][:3]))
+                        del notices[:1]
+                        continue
+                    raise
+                del notices[:count]
+
+    # Notices of the other workers
+    def receive(self):
+        while True:
+            try:
+                data = self.channels[self.worker][0].recv(self.BUFFER)
+            except socket.error as e:
+                if (e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)): # nothing else to read
+                    break
+                raise
+            for notice in cPickle.loads(data):
+                self._apply(*notice)
+
+    def _apply(self, kind, *args):
+        if (kind == 'add'):
+            worker, client_id, username = args[:3]
+            session = self.directory.get_by_username(username)
+            if (isinstance(session, ServerSession) and (worker < self.worker)): # both workers accepted the username before their notices crossed -> the lower one keeps it
+                session.username_taken()
+            self.directory.add(RemoteSession(self, *args))
+        elif (kind == 'group'):
+            client_id, user_info = args
+            session = self.directory.get(client_id)
+            if (isinstance(session, RemoteSession)):
+                old_group_id = session.group_id
+                session.group_id = user_info['group_id']
+                session._user_info = user_info
+                self.directory.change_group(session, old_group_id)
+        elif (kind == 'remove'):
+            session = self.directory.get(args[0])
+            if (isinstance(session, RemoteSession)):
+                self.directory.remove(session)
+        elif (kind == 'call'):
+            client_id, method, args = args
+            session = self.directory.get(client_id)
+            try:
+                if (isinstance(session, ServerSession)):
+                    getattr(session, method)(*[self._decode(arg) for arg in args])
+            except SessionNotFound: # calls with sessions removed meanwhile are ignored
+                pass
+        elif (kind == 'fanout'):
+            group_id, method, args = args
+            try:
+                args = [self._decode(arg) for arg in args]
+            except SessionNotFound:
+                return
+            for session in self.directory.local_fanout(group_id):
+                getattr(session, method)(*args)
+
+    # Sessions travel as their client ID
+    def _encode(self, arg):
+        if (isinstance(arg, list)):
+            return [self._encode(a) for a in arg]
+        if (isinstance(arg, (ServerSession, RemoteSession))):
+            return SessionReference(arg.client_id)
+        return arg
+
+    def _decode(self, arg):
+        if (isinstance(arg, list)):
+            return [self._decode(a) for a in arg]
+        if (isinstance(arg, SessionReference)):
+            session = self.directory.get(arg.client_id)
+            if (session is None):
+                raise SessionNotFound
+            return session
+        return arg
+
+class SessionReference(object):
+    def __init__(self, client_id):
+        self.client_id = client_id
+
+# Session served by another worker (the methods called by other sessions are sent to its worker)
+class RemoteSession(object):
+    def __init__(self, cluster, worker, client_id, username, address, user_info, wide):
+        self.cluster = cluster
+        self.worker = worker
+        self.client_id = client_id
+        self.username = username
+        self.address = address
+        self.wide = wide # the user supports wide IDs
+        self.group_id = user_info['group_id']
+        self._user_info = user_info
+
+    def __repr__(self):
+        return 'RemoteSession(username={}, client_id={}, group_id={}, wide={}, worker={})'.format(self.username, self.client_id, self.group_id, self.wide, self.worker)
+
+    def user_info(self):
+        return self._user_info
+
+    def group_dissolution(self):
+        self.cluster.call(self, 'group_dissolution', [])
+
+    def invite(self, inviter, creation, source_id, group_id, group_type, new_group_id):
+        self.cluster.call(self, 'invite', [inviter, creation, source_id, group_id, group_type, new_group_id])
+
+    def invitation_withdrawn(self, inviter):
+        self.cluster.call(self, 'invitation_withdrawn', [inviter])
+
+    def invitation_accepted(self, invited, source_id, group_type, group_id):
+        self.cluster.call(self, 'invitation_accepted', [invited, source_id, group_type, group_id])
+
+    def invitation_rejected(self, source_id, group_type, group_id):
+        self.cluster.call(self, 'invitation_rejected', [source_id, group_type, group_id])
+
+    def group_invitation_joined(self, source_id, group_type, group_id):
+        self.cluster.call(self, 'group_invitation_joined', [source_id, group_type, group_id])
+
+    def group_invitation_rejected(self, source_id, group_type=None, group_id=None):
+        self.cluster.call(self, 'group_invitation_rejected', [source_id, group_type, group_id])
+
+    def group_creation_reject(self):
+        self.cluster.call(self, 'group_creation_reject', [])
+
+# Members of a group (every session if group_id is None) served by another worker
+class RemoteWorker(object):
+    def __init__(self, cluster, worker, group_id):
+        self.cluster = cluster
+        self.worker = worker
+        self.group_id = group_id
+
+    def __repr__(self):
+        return 'RemoteWorker(worker={}, group_id={})'.format(self.worker, self.group_id)
+
+    def send_shared(self, frames, wide=False):
+        self.cluster.fanout(self.worker, self.group_id, 'send_shared', [frames, wide])
+
+    def send_fragment(self, frames, whole_frames, wide=False):
+        self.cluster.fanout(self.worker, self.group_id, 'send_fragment', [frames, whole_frames, wide])
+
+    def update_list(self, updated_sessions):
+        self.cluster.fanout(self.worker, self.group_id, 'update_list', [updated_sessions])
+
+    def update_disconnection(self, old_session):
+        self.cluster.fanout(self.worker, self.group_id, 'update_disconnection', [old_session])
+
+# Directory of a worker: sessions of this worker are announced to the other workers
+class SharedDirectory(SessionDirectory):
+    def __init__(self, cluster):
+        super(SharedDirectory, self).__init__()
+        self.cluster = cluster
+        cluster.directory = self
+
+    def add(self, session):
+        super(SharedDirectory, self).add(session)
+        if (isinstance(session, ServerSession)):
+            self.cluster.publish(('add', self.cluster.worker, session.client_id, session.username, session.address, session.user_info(), session.wide))
+
+    def remove(self, session):
+        if (isinstance(session, ServerSession) and (session in self)):
+            self.cluster.publish(('remove', session.client_id))
+        super(SharedDirectory, self).remove(session)
+
+    def change_group(self, session, old_group_id):
+        super(SharedDirectory, self).change_group(session, old_group_id)
+        if (isinstance(session, ServerSession) and (session in self)):
+            self.cluster.publish(('group', session.client_id, session.user_info()))
+
+    # Sessions of this worker and one RemoteWorker for each other worker
+    def fanout(self, group_id=None):
+        return self.local_fanout(group_id) + [RemoteWorker(self.cluster, worker, group_id) for worker in xrange(self.cluster.workers) if (worker != self.cluster.worker)]
+
+    def local_fanout(self, group_id=None):
+        return [session for session in super(SharedDirectory, self).fanout(group_id) if (isinstance(session, ServerSession))]
@@ -0,0 +1,66 @@
+# IdAllocator.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import time
+import random
+from collections import deque
+
+# Pool of client or group IDs: allocate and release are O(1) (free list)
+# A released ID stays in quarantine for QUARANTINE seconds before it is used again, so the messages still
+# in the network for the old user or group (resent ReliableSession.RETRIES times, invitations of
+# ServerSession.GROUP_TIMER) cannot reach the new one
+class IdAllocator(object):
+    QUARANTINE = 30.0
+
+    # ids = every ID of the pool (they are given in random order the first time)
+    def __init__(self, ids, quarantine=QUARANTINE):
+        ids = list(ids)
+        random.shuffle(ids)
+        self.free = deque(ids) # IDs ready to be allocated (released ones at the end)
+        self.quarantine = deque() # (release time, ID) of the released IDs (oldest first)
+        self.used = set() # allocated IDs
+        self.capacity = len(ids)
+        self.quarantine_time = quarantine
+        self.allocations = 0
+        self.releases = 0
+
+    def __repr__(self):
+        return 'IdAllocator(capacity={}, used={}, quarantined={}, free={}, allocations={}, releases={})'.format(
+            self.capacity, len(self.used), len(self.quarantine), len(self.free), self.allocations, self.releases)
+
+    # New ID, None if there is no ID left (or they are all in quarantine)
+    def allocate(self):
+        self._expire(time.time())
+        if (not self.free):
+            return None
+        new_id = self.free.popleft()
+        self.used.add(new_id)
+        self.allocations += 1
+        return new_id
+
+    # Nothing happens if the ID is not allocated by this pool (already released, another pool or worker)
+    def release(self, released_id):
+        if (released_id in self.used):
+            self.used.remove(released_id)
+            self.quarantine.append((time.time(), released_id))
+            self.releases += 1
+
+    # Number of IDs that can be allocated now
+    def available(self):
+        self._expire(time.time())
+        return len(self.free)
+
+    # Fraction of the pool in use (allocated or in quarantine)
+    def occupancy(self):
+        if (not self.capacity):
+            return 1.0
+        return float(len(self.used) + len(self.quarantine)) / self.capacity
+
+    def __len__(self):
+        return len(self.used)
+
+    def _expire(self, now):
+        while (self.quarantine and (now - self.quarantine[0][0] >= self.quarantine_time)):
+            self.free.append(self.quarantine.popleft()[1])
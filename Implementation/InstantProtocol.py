@@ -16,86 +16,175 @@ class InstantProtocolMessage(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |
     +-+-+-+-+-+-+-+-+
+
+    Extended mode (R = 1): the sequence number has 16 bits and it follows the header (S = 0)
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |   Type  |R|S|A|   Source ID   |    Group ID   | Header Length |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |               |        Sequence Number        |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Connection Request and ACKs of 5 bytes with R = 1 don't have the extension, they only say
+    that the sender supports the extended mode (old peers ignore the bit)
+
+    Wide IDs (extended mode with S = 1): Source ID and Group ID have 16 bits, their high bytes follow the sequence
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |   Type  |R|S|A|   Source ID   |    Group ID   | Header Length |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |               |        Sequence Number        | Source ID (H) |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    | Group ID (H)  |
+    +-+-+-+-+-+-+-+-+
+    The IDs of the options have 16 bits too. They are only used with peers which asked for them (see ConnectionRequest)
+    and only when an ID does not fit in 8 bits (see encode), the rest of the messages are the same
     """
     HEADER_FORMAT = '>BBBH'
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
-
+    HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+    HEADER_SIZE = HEADER_STRUCT.size
+    EXTENSION_FORMAT = '>H'
+    EXTENSION_STRUCT = struct.Struct(EXTENSION_FORMAT)
+    EXTENSION_SIZE = EXTENSION_STRUCT.size
+    EXTENDED_HEADER_STRUCT = struct.Struct(HEADER_FORMAT + EXTENSION_FORMAT[1:])
+    EXTENDED_SEQUENCES = 0x10000 # sequence space of the extended mode (1 bit otherwise)
+    WIDE_FORMAT = '>BB' # high bytes of Source ID and Group ID
+    WIDE_STRUCT = struct.Struct(WIDE_FORMAT)
+    WIDE_SIZE = WIDE_STRUCT.size
+    WIDE_HEADER_STRUCT = struct.Struct(HEADER_FORMAT + EXTENSION_FORMAT[1:] + WIDE_FORMAT[1:])
+    NARROW_ID = 0xFF # highest ID of 8 bits
+    MAX_SIZE = 1024 # receive buffer of the client and the server by default (below the MTU of Ethernet)
+
+    # rawdata can be a str, a bytearray or a memoryview (receive buffer), it is never sliced
+    # Only the header is decoded here, options are decoded the first time they are read (ACKs and
+    # routing only need the header), so rawdata must not be reused until then
     def __init__(self, dictdata=None, rawdata=None):
         if dictdata:
             self.type = dictdata.get('type')
-            self.reserved = 0
+            self.wide = dictdata.get('wide', False) # 16-bit IDs (only in extended mode)
+            self.extended = dictdata.get('extended', 0) or int(self.wide)
+            self.extension = dictdata.get('extension', False) or self.wide
             self.sequence = dictdata.get('sequence')
             self.ack = dictdata.get('ack')
             self.source_id = dictdata.get('source_id')
             self.group_id = dictdata.get('group_id')
             self.options = None
-            # Create different options depending on the type of the message (Factory function could be created...)
-            if (self.ack == 1): self.options = Acknowledgement()
-            elif (self.type == ConnectionRequest.TYPE): self.options = ConnectionRequest(dictdata=dictdata.get('options'))
-            elif (self.type == ConnectionAccept.TYPE): self.options = ConnectionAccept(dictdata=dictdata.get('options'))
-            elif (self.type == ConnectionReject.TYPE): self.options = ConnectionReject(dictdata=dictdata.get('options'))
-            elif (self.type == UserListRequest.TYPE): self.options = UserListRequest()
-            elif (self.type == UserListResponse.TYPE): self.options = UserListResponse(dictdata=dictdata.get('options'))
-            elif (self.type == DataMessage.TYPE): self.options = DataMessage(dictdata=dictdata.get('options'))
-            elif (self.type == GroupCreationRequest.TYPE): self.options = GroupCreationRequest(dictdata=dictdata.get('options'))
-            elif (self.type == GroupCreationAccept.TYPE): self.options = GroupCreationAccept(dictdata=dictdata.get('options'))
-            elif (self.type == GroupCreationReject.TYPE): self.options = GroupCreationReject()
-            elif (self.type == GroupInvitationRequest.TYPE): self.options = GroupInvitationRequest(dictdata=dictdata.get('options'))
-            elif (self.type == GroupInvitationAccept.TYPE): self.options = GroupInvitationAccept(dictdata=dictdata.get('options'))
-            elif (self.type == GroupInvitationReject.TYPE): self.options = GroupInvitationReject(dictdata=dictdata.get('options'))
-            elif (self.type == GroupDisjointRequest.TYPE): self.options = GroupDisjointRequest()
-            elif (self.type == GroupDissolution.TYPE): self.options = GroupDissolution()
-            elif (self.type == UpdateList.TYPE): self.options = UpdateList(dictdata=dictdata.get('options'))
-            elif (self.type == UpdateDisconnection.TYPE): self.options = UpdateDisconnection(dictdata=dictdata.get('options'))
-            elif (self.type == DisconnectionRequest.TYPE): self.options = DisconnectionRequest()
+            # Create different options depending on the type of the message (registry lookup)
+            option_class = self._option_class()
+            if (option_class):
+                self.options = option_class(dictdata=dictdata.get('options'), wide=self.wide)
             # Compute header length based on both sizes
-            self.header_length = self.HEADER_SIZE + self.options.size()
+            self.options_offset = self.HEADER_SIZE + (self.EXTENSION_SIZE if self.extension else 0) + (self.WIDE_SIZE if self.wide else 0)
+            self.header_length = self.options_offset + self.options.size()
 
         elif rawdata:
-            raw_header = rawdata[:self.HEADER_SIZE]
-            header = struct.unpack(self.HEADER_FORMAT, raw_header)
+            header = self.HEADER_STRUCT.unpack_from(rawdata)
             self.type = (header[0] & 0xF8) >> 3
-            self.reserved = (header[0] & 0x04) >> 2 # reserved
+            self.extended = (header[0] & 0x04) >> 2 # the sender supports the extended mode
             self.sequence = (header[0] & 0x02) >> 1
             self.ack = header[0] & 0x01
             self.source_id = header[1]
             self.group_id = header[2]
             self.header_length = header[3]
-            self.options = None
-            # Create different options depending on the type of the message
-            if (self.ack == 1): self.options = Acknowledgement()
-            elif (self.type == ConnectionRequest.TYPE): self.options = ConnectionRequest(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == ConnectionAccept.TYPE): self.options = ConnectionAccept(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == ConnectionReject.TYPE): self.options = ConnectionReject(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == UserListRequest.TYPE): self.options = UserListRequest()
-            elif (self.type == UserListResponse.TYPE): self.options = UserListResponse(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == DataMessage.TYPE): self.options = DataMessage(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == GroupCreationRequest.TYPE): self.options = GroupCreationRequest(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == GroupCreationAccept.TYPE): self.options = GroupCreationAccept(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == GroupCreationReject.TYPE): self.options = GroupCreationReject()
-            elif (self.type == GroupInvitationRequest.TYPE): self.options = GroupInvitationRequest(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == GroupInvitationAccept.TYPE): self.options = GroupInvitationAccept(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == GroupInvitationReject.TYPE): self.options = GroupInvitationReject(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == GroupDisjointRequest.TYPE): self.options = GroupDisjointRequest()
-            elif (self.type == GroupDissolution.TYPE): self.options = GroupDissolution()
-            elif (self.type == UpdateList.TYPE): self.options = UpdateList(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == UpdateDisconnection.TYPE): self.options = UpdateDisconnection(rawdata=rawdata[self.HEADER_SIZE:])
-            elif (self.type == DisconnectionRequest.TYPE): self.options = DisconnectionRequest()
+            self.extension = self._has_extension()
+            self.wide = False
+            self.options_offset = self.HEADER_SIZE
+            if (self.extension):
+                self.wide = bool(self.sequence) # S bit is not used by the sequence in extended mode
+                self.sequence = self.EXTENSION_STRUCT.unpack_from(rawdata, self.HEADER_SIZE)[0]
+                self.options_offset += self.EXTENSION_SIZE
+                if (self.wide):
+                    source_high, group_high = self.WIDE_STRUCT.unpack_from(rawdata, self.options_offset)
+                    self.source_id |= source_high << 8
+                    self.group_id |= group_high << 8
+                    self.options_offset += self.WIDE_SIZE
+            self._options = None
+            self._rawdata = rawdata # options pending
 
         else:
             raise(ValueError)
 
+    @property
+    def options(self):
+        if (self._rawdata is not None): # first access -> decode options
+            option_class = self._option_class()
+            if (option_class):
+                self._options = option_class(rawdata=self._rawdata, offset=self.options_offset, wide=self.wide)
+            self._rawdata = None
+        return self._options
+
+    @options.setter
+    def options(self, options):
+        self._options = options
+        self._rawdata = None
+
+    def _option_class(self):
+        return Acknowledgement if (self.ack == 1) else OPTIONS_REGISTRY.get(self.type)
+
+    # R = 1 is followed by the sequence number except in Connection Request and 5-byte ACKs (capability only)
+    def _has_extension(self):
+        if (not self.extended):
+            return False
+        if (self.ack == 1):
+            return (self.header_length > self.HEADER_SIZE)
+        return (self.type != ConnectionRequest.TYPE)
+
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.type << 3
-        first_byte |= self.reserved << 2 # reserved
-        first_byte |= self.sequence << 1
+        first_byte |= self.extended << 2
         first_byte |= self.ack
-        return '{}{}'.format(struct.pack(self.HEADER_FORMAT, first_byte, self.source_id, self.group_id, self.header_length), self.options.serialize())
+        if (self.wide):
+            header = self.WIDE_HEADER_STRUCT.pack(first_byte | 0x02, self.source_id & 0xFF, self.group_id & 0xFF, self.header_length, self.sequence,
+                                                    self.source_id >> 8, self.group_id >> 8)
+        elif (self.extension):
+            header = self.EXTENDED_HEADER_STRUCT.pack(first_byte, self.source_id, self.group_id, self.header_length, self.sequence)
+        else:
+            header = self.HEADER_STRUCT.pack(first_byte | (self.sequence << 1), self.source_id, self.group_id, self.header_length)
+        return header + self.options.serialize()
+
+    # Serialized message, with 8-bit IDs unless they don't fit and the peer supports wide IDs
+    @classmethod
+    def encode(cls, dictdata, wide=False):
+        try:
+            return cls(dictdata=dictdata).serialize()
+        except struct.error: # an ID (header or options) does not fit in 8 bits
+            if ((not wide) or dictdata.get('wide')):
+                raise
+            dictdata['wide'] = True
+            return cls(dictdata=dictdata).serialize()
+
+    # True if every ID fits in 8 bits
+    @classmethod
+    def fits(cls, *ids):
+        return all(i <= cls.NARROW_ID for i in ids)
+
+    # True if the serialized message already has the 16-bit sequence (wide IDs are only encoded in extended mode)
+    @staticmethod
+    def has_extension(frame):
+        first_byte = ord(frame[0])
+        return (bool(first_byte & 0x04) and ((first_byte >> 3) != ConnectionRequest.TYPE))
+
+    # Same serialized message with another sequence bit (nothing else is encoded again)
+    @staticmethod
+    def with_sequence(frame, sequence):
+        if (InstantProtocolMessage.has_extension(frame)): # no sequence bit, set when it is sent (extended_frame)
+            return frame
+        return chr((ord(frame[0]) & 0xFD) | (sequence << 1)) + frame[1:]
+
+    # Serialized message with sequence 0 and 1 (shared by every receiver of the same message)
+    @staticmethod
+    def sequence_variants(frame):
+        return (InstantProtocolMessage.with_sequence(frame, 0), InstantProtocolMessage.with_sequence(frame, 1))
+
+    # Same serialized message (1-bit sequence) in the extended mode with a 16-bit sequence
+    @classmethod
+    def extended_frame(cls, frame, sequence):
+        if (cls.has_extension(frame)): # only the sequence changes
+            return frame[:cls.HEADER_SIZE] + cls.EXTENSION_STRUCT.pack(sequence) + frame[(cls.HEADER_SIZE + cls.EXTENSION_SIZE):]
+        first_byte, source_id, group_id, header_length = cls.HEADER_STRUCT.unpack_from(frame)
+        return cls.EXTENDED_HEADER_STRUCT.pack((first_byte & 0xFD) | 0x04, source_id, group_id, header_length + cls.EXTENSION_SIZE, sequence) + frame[cls.HEADER_SIZE:]
 
     def __repr__(self):
-        return 'InstantProtocolMessage(type={}, sequence={}, ack={}, source_id={}, group_id={}, header_length={}, options={})'.format(
-                hex(self.type), hex(self.sequence), hex(self.ack), hex(self.source_id), hex(self.group_id), hex(self.header_length), self.options)
+        return 'InstantProtocolMessage(type={}, extended={}, wide={}, sequence={}, ack={}, source_id={}, group_id={}, header_length={}, options={})'.format(
+                hex(self.type), self.extended, self.wide, hex(self.sequence), hex(self.ack), hex(self.source_id), hex(self.group_id), hex(self.header_length), self.options)
 
 # These private objects will handle psudoheaders (also payload when Data Message)
 class ConnectionRequest(object):
@@ -103,7 +192,7 @@ class ConnectionRequest(object):
      0                   1                   2                   3
      0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    |   Type  |R|S|A|   Source ID   |    Group ID   | Header Length |
+    |   Type  |R|S|A|   Source ID   |W|  Group ID   | Header Length |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |                                               |
     +-+-+-+-+-+-+-+-+                                               +
@@ -111,17 +200,21 @@ class ConnectionRequest(object):
     +               +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |
     +-+-+-+-+-+-+-+-+
+    Group ID of the header (0x00 in the original protocol, old servers ignore it) carries the capabilities of the client:
+    W = the client supports wide IDs (16 bits), used only after a wide Connection Accept
     """
     TYPE = 0x00
     PSEUDOHEADER_FORMAT = '>8s'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_IDS = 0x80 # capability bit in the Group ID
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         if dictdata:
             self.username = dictdata.get('username')
 
         elif rawdata:
-            self.username = (struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)[0]).strip()
+            self.username = (self.PSEUDOHEADER_STRUCT.unpack_from(rawdata, offset)[0]).strip()
 
         else:
             raise(ValueError)
@@ -131,7 +224,7 @@ class ConnectionRequest(object):
 
     def serialize(self):
         normalized_username = '{0: <8}'.format(self.username) # username is always 8 bytes
-        return struct.pack(self.PSEUDOHEADER_FORMAT, normalized_username)
+        return self.PSEUDOHEADER_STRUCT.pack(normalized_username)
 
     def __repr__(self):
         return '[username={}]'.format(self.username)
@@ -145,26 +238,30 @@ class ConnectionAccept(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |   Client ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Client ID has 16 bits with wide IDs (a wide Connection Accept says that the server accepted them)
     """
     TYPE = 0x01
     PSEUDOHEADER_FORMAT = '>B'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_PSEUDOHEADER_STRUCT = struct.Struct('>H')
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.pseudoheader_struct = self.WIDE_PSEUDOHEADER_STRUCT if (wide) else self.PSEUDOHEADER_STRUCT
         if dictdata:
             self.client_id = dictdata.get('client_id') # int
 
         elif rawdata:
-            self.client_id = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)[0]
+            self.client_id = self.pseudoheader_struct.unpack_from(rawdata, offset)[0]
 
         else:
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE
+        return self.pseudoheader_struct.size
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT, self.client_id)
+        return self.pseudoheader_struct.pack(self.client_id)
 
     def __repr__(self):
         return '[client_id={}]'.format(self.client_id)
@@ -181,14 +278,15 @@ class ConnectionReject(object):
     """
     TYPE = 0x02
     PSEUDOHEADER_FORMAT = '>B'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         if dictdata:
             self.error = dictdata.get('error')
 
         elif rawdata:
-            self.error = (struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)[0] & 0x80) >> 7
+            self.error = (self.PSEUDOHEADER_STRUCT.unpack_from(rawdata, offset)[0] & 0x80) >> 7
 
         else:
             raise(ValueError)
@@ -199,7 +297,7 @@ class ConnectionReject(object):
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.error << 7
-        return struct.pack(self.PSEUDOHEADER_FORMAT, first_byte)
+        return self.PSEUDOHEADER_STRUCT.pack(first_byte)
 
     def __repr__(self):
         return '[error={}]'.format(self.error)
@@ -216,16 +314,17 @@ class UserListRequest(object):
     """
     TYPE = 0x03
     PSEUDOHEADER_FORMAT = '' # no options
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
 
-    def __init__(self):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         pass
 
     def size(self):
         return self.PSEUDOHEADER_SIZE # 0
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT)
+        return self.PSEUDOHEADER_STRUCT.pack()
 
     def __repr__(self):
         return '[]'.format()
@@ -247,42 +346,91 @@ class UserListResponse(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |          Port         |
     +-+-+-+-+-+-+-+-+-+-+-+-+
+
+    The list is sent in chunks (datagrams of InstantProtocolMessage.MAX_SIZE bytes at most), the records are followed by:
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |          Chunk Number         |        Number of Chunks       |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    It is shorter than a record, so receivers which don't know it ignore it (every chunk is a list)
+    With wide IDs, Client ID and Group ID of the records have 16 bits (18 bytes per record)
     """
     TYPE = 0x04
     # Repeated format (per user)
-    PSEUDOHEADER_FORMAT_REP = '>BB8sBBBBH' # IP as string of 4 bytes (to split later)
-    PSEUDOHEADER_SIZE_REP = struct.calcsize(PSEUDOHEADER_FORMAT_REP)
+    PSEUDOHEADER_FORMAT_REP = '>BB8s4sH' # IP as string of 4 bytes (socket.inet_aton / socket.inet_ntoa)
+    PSEUDOHEADER_STRUCT_REP = struct.Struct(PSEUDOHEADER_FORMAT_REP)
+    PSEUDOHEADER_SIZE_REP = PSEUDOHEADER_STRUCT_REP.size
+    WIDE_PSEUDOHEADER_STRUCT_REP = struct.Struct('>HH8s4sH')
+    TRAILER_FORMAT = '>HH'
+    TRAILER_STRUCT = struct.Struct(TRAILER_FORMAT)
+    TRAILER_SIZE = TRAILER_STRUCT.size
+    CHUNK_RECORDS = (InstantProtocolMessage.MAX_SIZE - InstantProtocolMessage.EXTENDED_HEADER_STRUCT.size - TRAILER_SIZE) / PSEUDOHEADER_SIZE_REP # users per chunk (63)
+    WIDE_CHUNK_RECORDS = (InstantProtocolMessage.MAX_SIZE - InstantProtocolMessage.WIDE_HEADER_STRUCT.size - TRAILER_SIZE) / WIDE_PSEUDOHEADER_STRUCT_REP.size # (56)
     """
     user_list': [{'client_id': 123, 'group_id': 234, 'username':'User1', 'ip_address': '127.0.0.1', 'port': 2222}, {...}]
-    """
-    def __init__(self, dictdata=None, rawdata=None):
+    An entry can also carry its packed records ('record': pack_record(entry), 'wide_record': pack_record(entry, True)),
+    which are copied as they are ('record' is None if an ID does not fit in 8 bits)
+    'chunk' and 'chunks' (optional): number of this chunk (from 0) and number of chunks of the list (without
+    them there is no trailer, the list is complete)
+    """
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.record_struct = self.WIDE_PSEUDOHEADER_STRUCT_REP if (wide) else self.PSEUDOHEADER_STRUCT_REP
+        self.record_key = 'wide_record' if (wide) else 'record'
         if dictdata:
             self.user_list = dictdata.get('user_list')
+            self.chunk = dictdata.get('chunk', 0)
+            self.chunks = dictdata.get('chunks')
+            self.trailer = (self.chunks is not None)
+            if (not self.trailer):
+                self.chunks = 1
 
         elif rawdata:
             self.user_list = list()
-            for i in range(len(rawdata) / self.PSEUDOHEADER_SIZE_REP):
-                offset = (i * self.PSEUDOHEADER_SIZE_REP)
-                rawclient = struct.unpack(self.PSEUDOHEADER_FORMAT_REP, rawdata[offset:(offset + self.PSEUDOHEADER_SIZE_REP)])
+            self.chunk, self.chunks = 0, 1
+            self.trailer = ((len(rawdata) - offset) % self.record_struct.size == self.TRAILER_SIZE)
+            if (self.trailer):
+                self.chunk, self.chunks = self.TRAILER_STRUCT.unpack_from(rawdata, len(rawdata) - self.TRAILER_SIZE)
+            for i in xrange((len(rawdata) - offset) / self.record_struct.size):
+                rawclient = self.record_struct.unpack_from(rawdata, offset + (i * self.record_struct.size))
                 dictclient = dict(client_id=rawclient[0], group_id=rawclient[1], username=rawclient[2].rstrip('\0'),
-                                    ip_address='{}.{}.{}.{}'.format(rawclient[3],rawclient[4],rawclient[5],rawclient[6]), port=rawclient[7])
+                                    ip_address=socket.inet_ntoa(rawclient[3]), port=rawclient[4])
                 self.user_list.append(dictclient)
         else:
             raise(ValueError)
 
+    # Record of one user (16 bytes, 18 with wide IDs), it can be saved and reused while the user does not change
+    @classmethod
+    def pack_record(cls, user, wide=False):
+        record_struct = cls.WIDE_PSEUDOHEADER_STRUCT_REP if (wide) else cls.PSEUDOHEADER_STRUCT_REP
+        return record_struct.pack(user.get('client_id'), user.get('group_id'), user.get('username'),
+                                    socket.inet_aton(user.get('ip_address')), user.get('port'))
+
+    # Chunks of a list (several lists of CHUNK_RECORDS users at most, at least one)
+    @classmethod
+    def split(cls, user_list, wide=False):
+        records = cls.WIDE_CHUNK_RECORDS if (wide) else cls.CHUNK_RECORDS
+        return [user_list[i:(i + records)] for i in xrange(0, len(user_list), records)] or [user_list]
+
     def size(self):
-        return len(self.user_list) * self.PSEUDOHEADER_SIZE_REP
+        return len(self.user_list) * self.record_struct.size + (self.TRAILER_SIZE if self.trailer else 0)
 
     def serialize(self):
-        serialization = ''
+        # All records are written in a single buffer (linear in the number of users)
+        serialization = bytearray(self.size())
+        offset = 0
         for user in self.user_list:
-            ip_bytes = user.get('ip_address').split('.')
-            serialization = '{}{}'.format(serialization, struct.pack(self.PSEUDOHEADER_FORMAT_REP, user.get('client_id'), user.get('group_id'),
-                                            user.get('username'), int(ip_bytes[0]), int(ip_bytes[1]), int(ip_bytes[2]), int(ip_bytes[3]), user.get('port')))
-        return serialization
+            record = user.get(self.record_key)
+            if (record is None):
+                self.record_struct.pack_into(serialization, offset, user.get('client_id'), user.get('group_id'), user.get('username'),
+                                                socket.inet_aton(user.get('ip_address')), user.get('port'))
+            else:
+                serialization[offset:(offset + self.record_struct.size)] = record
+            offset += self.record_struct.size
+        if (self.trailer):
+            self.TRAILER_STRUCT.pack_into(serialization, offset, self.chunk, self.chunks)
+        return bytes(serialization)
 
     def __repr__(self):
-        return '[user_list={}]'.format(self.user_list)
+        return '[user_list={}, chunk={}, chunks={}]'.format(self.user_list, self.chunk, self.chunks)
 
 class DataMessage(object):
     """
@@ -293,33 +441,75 @@ class DataMessage(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |          Data Length          |    Payload    |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+    Fragment (extended mode, payloads which don't fit in a datagram of InstantProtocolMessage.MAX_SIZE bytes):
+    Data Length is the length of this part of the payload, which is followed by:
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |           Message ID          |        Fragment Number        |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |      Number of Fragments      |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     """
     TYPE = 0x05
     PSEUDOHEADER_FORMAT = '>H' # Payload is not structured data of this protocol
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    TRAILER_FORMAT = '>HHH'
+    TRAILER_STRUCT = struct.Struct(TRAILER_FORMAT)
+    TRAILER_SIZE = TRAILER_STRUCT.size
+    MAX_LENGTH = 0xFFFF # payload of a message (Data Length of the whole message)
+    FRAGMENT_LENGTH = InstantProtocolMessage.MAX_SIZE - InstantProtocolMessage.WIDE_HEADER_STRUCT.size - PSEUDOHEADER_SIZE - TRAILER_SIZE # payload of a fragment (1007, even with wide IDs)
     # This message is different because we also save payload (upper layer) because it is the
     # only one which has payload so we save it here for easy coding.
+    # When decoded, payload is kept as a view of the datagram until the application reads it.
+    # fragment = (message_id, fragment number, number of fragments) or None (whole message)
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         if dictdata:
             self.data_length = dictdata.get('data_length')
             self.payload = dictdata.get('payload')
+            self.fragment = dictdata.get('fragment')
 
         elif rawdata:
-            self.data_length = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata[:self.PSEUDOHEADER_SIZE])[0]
-            self.payload = rawdata[self.PSEUDOHEADER_SIZE:] # rawdata[self.PSEUDOHEADER_SIZE:(self.PSEUDOHEADER_SIZE + self.data_length)]
+            self.data_length = self.PSEUDOHEADER_STRUCT.unpack_from(rawdata, offset)[0]
+            offset += self.PSEUDOHEADER_SIZE
+            self.fragment = None
+            if (len(rawdata) - offset - self.data_length == self.TRAILER_SIZE): # fragment (the payload is followed by the trailer)
+                self.fragment = self.TRAILER_STRUCT.unpack_from(rawdata, offset + self.data_length)
+                self.payload_view = memoryview(rawdata)[offset:(offset + self.data_length)]
+            else:
+                self.payload_view = memoryview(rawdata)[offset:] # [:self.data_length] (not checked by the protocol)
+            self._payload = None
 
         else:
             raise(ValueError)
 
+    # Parts of a payload which is too long for a datagram (one part if it fits)
+    @classmethod
+    def split(cls, payload):
+        return [payload[i:(i + cls.FRAGMENT_LENGTH)] for i in xrange(0, len(payload), cls.FRAGMENT_LENGTH)] or [payload]
+
+    @property
+    def payload(self):
+        if (self._payload is None): # copied only once and only when it is required
+            self._payload = self.payload_view.tobytes()
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self.payload_view = memoryview(payload)
+
     def size(self):
-        return self.PSEUDOHEADER_SIZE # Size of the header (without payload)
+        return self.PSEUDOHEADER_SIZE # Size of the header (without payload and trailer, Header Length is where the payload starts)
 
     def serialize(self):
-        return '{}{}'.format(struct.pack(self.PSEUDOHEADER_FORMAT, self.data_length), self.payload)
+        if (self.fragment):
+            return self.PSEUDOHEADER_STRUCT.pack(self.data_length) + self.payload + self.TRAILER_STRUCT.pack(*self.fragment)
+        return self.PSEUDOHEADER_STRUCT.pack(self.data_length) + self.payload
 
     def __repr__(self):
-        return '[data_length={}, payload={}]'.format(self.data_length, self.payload)
+        return '[data_length={}, payload={}, fragment={}]'.format(self.data_length, self.payload, self.fragment)
 
 class GroupCreationRequest(object):
     """
@@ -330,41 +520,42 @@ class GroupCreationRequest(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |T|   Padding   |   Client ID   |   Client ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Client IDs have 16 bits with wide IDs
     """
     TYPE = 0x06
     PSEUDOHEADER_FORMAT_BASE = '>B' # first byte is readed once
     PSEUDOHEADER_FORMAT_REP = '>B' # repeated format for each user
-    PSEUDOHEADER_SIZE_BASE = struct.calcsize(PSEUDOHEADER_FORMAT_BASE)
-    PSEUDOHEADER_SIZE_REP = struct.calcsize(PSEUDOHEADER_FORMAT_REP)
-
-    def __init__(self, dictdata=None, rawdata=None):
+    PSEUDOHEADER_STRUCT_BASE = struct.Struct(PSEUDOHEADER_FORMAT_BASE)
+    PSEUDOHEADER_STRUCT_REP = struct.Struct(PSEUDOHEADER_FORMAT_REP)
+    PSEUDOHEADER_SIZE_BASE = PSEUDOHEADER_STRUCT_BASE.size
+    PSEUDOHEADER_SIZE_REP = PSEUDOHEADER_STRUCT_REP.size
+    WIDE_PSEUDOHEADER_STRUCT_REP = struct.Struct('>H')
+
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.client_struct = self.WIDE_PSEUDOHEADER_STRUCT_REP if (wide) else self.PSEUDOHEADER_STRUCT_REP
         if dictdata:
             self.type = dictdata.get('type')
             self.client_ids = dictdata.get('client_ids')
 
         elif rawdata:
-            self.type = (struct.unpack(self.PSEUDOHEADER_FORMAT_BASE, rawdata[:self.PSEUDOHEADER_SIZE_BASE])[0] & 0x80) >> 7
-            raw_clients = rawdata[self.PSEUDOHEADER_SIZE_BASE:]
+            self.type = (self.PSEUDOHEADER_STRUCT_BASE.unpack_from(rawdata, offset)[0] & 0x80) >> 7
+            offset += self.PSEUDOHEADER_SIZE_BASE
             self.client_ids = list()
             # Get clients from binary data (apply for each client ID)
-            for i in range(len(raw_clients) / self.PSEUDOHEADER_SIZE_REP):
-                offset = (i * self.PSEUDOHEADER_SIZE_REP)
-                self.client_ids.append(struct.unpack(self.PSEUDOHEADER_FORMAT_REP, raw_clients[offset:(offset + self.PSEUDOHEADER_SIZE_REP)])[0])
+            for i in xrange((len(rawdata) - offset) / self.client_struct.size):
+                self.client_ids.append(self.client_struct.unpack_from(rawdata, offset + (i * self.client_struct.size))[0])
 
         else:
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE_BASE + (len(self.client_ids) * self.PSEUDOHEADER_SIZE_REP)
+        return self.PSEUDOHEADER_SIZE_BASE + (len(self.client_ids) * self.client_struct.size)
 
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.type << 7
-        serialization = '{}'.format(struct.pack(self.PSEUDOHEADER_FORMAT_BASE, first_byte))
-        # List of users after the type (1 or more users)
-        for client_id in self.client_ids:
-            serialization = '{}{}'.format(serialization, struct.pack(self.PSEUDOHEADER_FORMAT_REP, client_id)) # equals to serialization += struct.unpack...
-        return serialization
+        # List of users after the type (1 or more users), joined once
+        return self.PSEUDOHEADER_STRUCT_BASE.pack(first_byte) + ''.join(map(self.client_struct.pack, self.client_ids))
 
     def __repr__(self):
         client_list = ', '.join(str(client) for client in self.client_ids)
@@ -379,18 +570,22 @@ class GroupCreationAccept(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |T|   Padding   |    Group ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Group ID has 16 bits with wide IDs
     """
     TYPE = 0x07
     PSEUDOHEADER_FORMAT = '>BB'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_PSEUDOHEADER_STRUCT = struct.Struct('>BH')
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.pseudoheader_struct = self.WIDE_PSEUDOHEADER_STRUCT if (wide) else self.PSEUDOHEADER_STRUCT
         if dictdata:
             self.type = dictdata.get('type')
             self.group_id = dictdata.get('group_id')
 
         elif rawdata:
-            pseudoheader = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)
+            pseudoheader = self.pseudoheader_struct.unpack_from(rawdata, offset)
             self.type = (pseudoheader[0] & 0x80) >> 7
             self.group_id = pseudoheader[1]
 
@@ -398,12 +593,12 @@ class GroupCreationAccept(object):
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE
+        return self.pseudoheader_struct.size
 
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.type << 7
-        return struct.pack(self.PSEUDOHEADER_FORMAT, first_byte, self.group_id)
+        return self.pseudoheader_struct.pack(first_byte, self.group_id)
 
     def __repr__(self):
         return '[type={}, group_id={}]'.format(self.type, self.group_id)
@@ -420,16 +615,17 @@ class GroupCreationReject(object):
     """
     TYPE = 0x08
     PSEUDOHEADER_FORMAT = ''
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
 
-    def __init__(self):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         pass
 
     def size(self):
         return self.PSEUDOHEADER_SIZE
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT)
+        return self.PSEUDOHEADER_STRUCT.pack()
 
     def __repr__(self):
         return '[]'.format()
@@ -443,19 +639,23 @@ class GroupInvitationRequest(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |T|   Padding   |    Group ID   |   Client ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Group ID and Client ID have 16 bits with wide IDs
     """
     TYPE = 0x09
     PSEUDOHEADER_FORMAT = '>BBB'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_PSEUDOHEADER_STRUCT = struct.Struct('>BHH')
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.pseudoheader_struct = self.WIDE_PSEUDOHEADER_STRUCT if (wide) else self.PSEUDOHEADER_STRUCT
         if dictdata:
             self.type = dictdata.get('type')
             self.group_id = dictdata.get('group_id')
             self.client_id = dictdata.get('client_id')
 
         elif rawdata:
-            pseudoheader = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)
+            pseudoheader = self.pseudoheader_struct.unpack_from(rawdata, offset)
             self.type = (pseudoheader[0] & 0x80) >> 7
             self.group_id = pseudoheader[1]
             self.client_id = pseudoheader[2]
@@ -464,12 +664,12 @@ class GroupInvitationRequest(object):
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE
+        return self.pseudoheader_struct.size
 
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.type << 7
-        return struct.pack(self.PSEUDOHEADER_FORMAT, first_byte, self.group_id, self.client_id)
+        return self.pseudoheader_struct.pack(first_byte, self.group_id, self.client_id)
 
     def __repr__(self):
         return '[type={}, group_id={}, client_id={}]'.format(self.type, self.group_id, self.client_id)
@@ -483,18 +683,22 @@ class GroupInvitationAccept(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |T|   Padding   |    Group ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Group ID has 16 bits with wide IDs
     """
     TYPE = 0x0A
     PSEUDOHEADER_FORMAT = '>BB'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_PSEUDOHEADER_STRUCT = struct.Struct('>BH')
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.pseudoheader_struct = self.WIDE_PSEUDOHEADER_STRUCT if (wide) else self.PSEUDOHEADER_STRUCT
         if dictdata:
             self.type = dictdata.get('type')
             self.group_id = dictdata.get('group_id')
 
         elif rawdata:
-            pseudoheader = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)
+            pseudoheader = self.pseudoheader_struct.unpack_from(rawdata, offset)
             self.type = (pseudoheader[0] & 0x80) >> 7
             self.group_id = pseudoheader[1]
 
@@ -502,12 +706,12 @@ class GroupInvitationAccept(object):
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE
+        return self.pseudoheader_struct.size
 
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.type << 7
-        return struct.pack(self.PSEUDOHEADER_FORMAT, first_byte, self.group_id)
+        return self.pseudoheader_struct.pack(first_byte, self.group_id)
 
     def __repr__(self):
         return '[type={}, group_id={}]'.format(self.type, self.group_id)
@@ -521,18 +725,22 @@ class GroupInvitationReject(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |T|   Padding   |    Group ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Group ID has 16 bits with wide IDs
     """
     TYPE = 0x0B
     PSEUDOHEADER_FORMAT = '>BB'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_PSEUDOHEADER_STRUCT = struct.Struct('>BH')
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.pseudoheader_struct = self.WIDE_PSEUDOHEADER_STRUCT if (wide) else self.PSEUDOHEADER_STRUCT
         if dictdata:
             self.type = dictdata.get('type')
             self.group_id = dictdata.get('group_id')
 
         elif rawdata:
-            pseudoheader = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)
+            pseudoheader = self.pseudoheader_struct.unpack_from(rawdata, offset)
             self.type = (pseudoheader[0] & 0x80) >> 7
             self.group_id = pseudoheader[1]
 
@@ -540,12 +748,12 @@ class GroupInvitationReject(object):
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE
+        return self.pseudoheader_struct.size
 
     def serialize(self):
         first_byte = 0x00
         first_byte |= self.type << 7
-        return struct.pack(self.PSEUDOHEADER_FORMAT, first_byte, self.group_id)
+        return self.pseudoheader_struct.pack(first_byte, self.group_id)
 
     def __repr__(self):
         return '[type={}, group_id={}]'.format(self.type, self.group_id)
@@ -562,16 +770,17 @@ class GroupDisjointRequest(object):
     """
     TYPE = 0x0C
     PSEUDOHEADER_FORMAT = ''
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
 
-    def __init__(self):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         pass
 
     def size(self):
         return self.PSEUDOHEADER_SIZE # 0
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT)
+        return self.PSEUDOHEADER_STRUCT.pack()
 
     def __repr__(self):
         return '[]'.format()
@@ -588,21 +797,22 @@ class GroupDissolution(object):
     """
     TYPE = 0x0D
     PSEUDOHEADER_FORMAT = ''
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         pass
 
     def size(self):
         return self.PSEUDOHEADER_SIZE # 0
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT)
+        return self.PSEUDOHEADER_STRUCT.pack()
 
     def __repr__(self):
         return '[]'.format()
 
-class UpdateList(object):
+class UpdateList(UserListResponse):
     """
      0                   1                   2                   3
      0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
@@ -621,38 +831,7 @@ class UpdateList(object):
     +-+-+-+-+-+-+-+-+
     """
     TYPE = 0x0E
-    # Repeated format (per user)
-    PSEUDOHEADER_FORMAT_REP = '>BB8sBBBBH' # IP as string of 4 bytes (to split later)
-    PSEUDOHEADER_SIZE_REP = struct.calcsize(PSEUDOHEADER_FORMAT_REP)
-
-    def __init__(self, dictdata=None, rawdata=None):
-        if dictdata:
-            self.user_list = dictdata.get('user_list')
-
-        elif rawdata:
-            self.user_list = list()
-            for i in range(len(rawdata) / self.PSEUDOHEADER_SIZE_REP):
-                offset = (i * self.PSEUDOHEADER_SIZE_REP)
-                rawclient = struct.unpack(self.PSEUDOHEADER_FORMAT_REP, rawdata[offset:(offset + self.PSEUDOHEADER_SIZE_REP)])
-                dictclient = dict(client_id=rawclient[0], group_id=rawclient[1], username=rawclient[2].rstrip('\0'),
-                                    ip_address='{}.{}.{}.{}'.format(rawclient[3],rawclient[4],rawclient[5],rawclient[6]), port=rawclient[7])
-                self.user_list.append(dictclient)
-        else:
-            raise(ValueError)
-
-    def size(self):
-        return len(self.user_list) * self.PSEUDOHEADER_SIZE_REP
-
-    def serialize(self):
-        serialization = ''
-        for user in self.user_list:
-            ip_bytes = user.get('ip_address').split('.')
-            serialization = '{}{}'.format(serialization, struct.pack(self.PSEUDOHEADER_FORMAT_REP, user.get('client_id'), user.get('group_id'),
-                                            user.get('username'), int(ip_bytes[0]), int(ip_bytes[1]), int(ip_bytes[2]), int(ip_bytes[3]), user.get('port')))
-        return serialization
-
-    def __repr__(self):
-        return '[user_list={}]'.format(self.user_list)
+    # Same records as User List Response (only updated users)
 
 class UpdateDisconnection(object):
     """
@@ -663,26 +842,30 @@ class UpdateDisconnection(object):
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |               |   Client ID   |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    Client ID has 16 bits with wide IDs
     """
     TYPE = 0x0F
     PSEUDOHEADER_FORMAT = '>B'
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    WIDE_PSEUDOHEADER_STRUCT = struct.Struct('>H')
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
+        self.pseudoheader_struct = self.WIDE_PSEUDOHEADER_STRUCT if (wide) else self.PSEUDOHEADER_STRUCT
         if dictdata:
             self.client_id = dictdata.get('client_id')
 
         elif rawdata:
-            self.client_id = struct.unpack(self.PSEUDOHEADER_FORMAT, rawdata)[0]
+            self.client_id = self.pseudoheader_struct.unpack_from(rawdata, offset)[0]
 
         else:
             raise(ValueError)
 
     def size(self):
-        return self.PSEUDOHEADER_SIZE
+        return self.pseudoheader_struct.size
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT, self.client_id)
+        return self.pseudoheader_struct.pack(self.client_id)
 
     def __repr__(self):
         return '[client_id={}]'.format(self.client_id)
@@ -699,16 +882,17 @@ class DisconnectionRequest(object):
     """
     TYPE = 0x10
     PSEUDOHEADER_FORMAT = ''
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
 
-    def __init__(self, dictdata=None, rawdata=None):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         pass
 
     def size(self):
         return self.PSEUDOHEADER_SIZE
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT)
+        return self.PSEUDOHEADER_STRUCT.pack()
 
     def __repr__(self):
         return '[]'.format()
@@ -726,16 +910,42 @@ class Acknowledgement(object):
     # TYPE = depends on the message which is being acknowledged
     FLAG = 0x01
     PSEUDOHEADER_FORMAT = ''
-    PSEUDOHEADER_SIZE = struct.calcsize(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_STRUCT = struct.Struct(PSEUDOHEADER_FORMAT)
+    PSEUDOHEADER_SIZE = PSEUDOHEADER_STRUCT.size
+    FRAMES = dict() # serialized ACKs (type, sequence, source ID, group ID, R) -> bytes
 
-    def __init__(self):
+    def __init__(self, dictdata=None, rawdata=None, offset=0, wide=False):
         pass
 
+    # Serialized ACK, every 1-bit sequence frame is encoded once and then reused (there are only a few of them)
+    # extended = R bit (capability), extension = 16-bit sequence (packed each time, too many to keep them, wide
+    # if an ID does not fit in 8 bits)
+    @classmethod
+    def frame(cls, type, sequence, source_id, group_id=0x00, extended=0, extension=False):
+        if (extension):
+            if (not InstantProtocolMessage.fits(source_id, group_id)):
+                header_struct = InstantProtocolMessage.WIDE_HEADER_STRUCT
+                return header_struct.pack((type << 3) | 0x06 | cls.FLAG, source_id & 0xFF, group_id & 0xFF, header_struct.size, sequence, source_id >> 8, group_id >> 8)
+            header_struct = InstantProtocolMessage.EXTENDED_HEADER_STRUCT
+            return header_struct.pack((type << 3) | 0x04 | cls.FLAG, source_id, group_id, header_struct.size, sequence)
+        key = (type, sequence, source_id, group_id, extended)
+        frame = cls.FRAMES.get(key)
+        if (frame is None):
+            frame = InstantProtocolMessage(dictdata={'type': type, 'extended': extended, 'sequence': sequence, 'ack': cls.FLAG, 'source_id': source_id, 'group_id': group_id}).serialize()
+            cls.FRAMES[key] = frame
+        return frame
+
     def size(self):
         return self.PSEUDOHEADER_SIZE
 
     def serialize(self):
-        return struct.pack(self.PSEUDOHEADER_FORMAT)
+        return self.PSEUDOHEADER_STRUCT.pack()
 
     def __repr__(self):
         return '[ack]'.format() # print 'ack' to show that it's a special type
+
+# Option class of each message type (ACK is selected by its flag, not by type)
+OPTIONS_REGISTRY = dict((option_class.TYPE, option_class) for option_class in (
+    ConnectionRequest, ConnectionAccept, ConnectionReject, UserListRequest, UserListResponse, DataMessage,
+    GroupCreationRequest, GroupCreationAccept, GroupCreationReject, GroupInvitationRequest, GroupInvitationAccept,
+    GroupInvitationReject, GroupDisjointRequest, GroupDissolution, UpdateList, UpdateDisconnection, DisconnectionRequest))
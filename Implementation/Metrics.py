@@ -0,0 +1,173 @@
+# Metrics.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import sys
+import json
+import bisect
+import socket
+import threading
+import logging as log
+from collections import OrderedDict
+
+# Number of times something happened (packets, retransmissions...), updated on the hot paths
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+# Value read only when a snapshot is taken (queue depths, timers, sessions...): nothing to update
+class Gauge(object):
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def read(self):
+        return self.function()
+
+# Distribution of a value (latencies in seconds) in buckets of fixed upper bounds, plus count and sum
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last bucket has no upper bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def read(self):
+        buckets = OrderedDict(('le_{}'.format(bound), count) for bound, count in zip(self.bounds, self.counts))
+        buckets['le_inf'] = self.counts[-1]
+        return OrderedDict([('count', self.count), ('sum', round(self.sum, 6))] + buckets.items())
+
+# Counter and histogram of a disabled registry (the hot paths call them as usual, nothing is done)
+class NullInstrument(object):
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def read(self):
+        return 0
+
+# Metrics of the process by name, the instruments are created once (when the modules are loaded or the server
+# is created) and kept by who updates them, so an update is only an attribute increment
+class MetricsRegistry(object):
+    LATENCY_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0) # seconds
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled # (set it before the other modules are loaded)
+        self.metrics = dict() # name -> Counter, Gauge or Histogram
+
+    def counter(self, name):
+        if (not self.enabled):
+            return NULL_INSTRUMENT
+        return self.metrics.setdefault(name, Counter())
+
+    # The gauge of the last object registered with this name is kept (the server or client of the process)
+    def gauge(self, name, function):
+        self.metrics[name] = Gauge(function)
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS):
+        if (not self.enabled):
+            return NULL_INSTRUMENT
+        return self.metrics.setdefault(name, Histogram(bounds))
+
+    # name -> value (dict of buckets for histograms), sorted by name
+    def snapshot(self):
+        return OrderedDict((name, self.metrics[name].read()) for name in sorted(self.metrics))
+
+    def format(self, separator='\n'):
+        lines = list()
+        for name, value in self.snapshot().iteritems():
+            if (isinstance(value, dict)):
+                value = ' '.join('{}={}'.format(key, count) for key, count in value.iteritems())
+            lines.append('{} {}'.format(name, value))
+        return separator.join(lines)
+
+    def __repr__(self):
+        return 'MetricsRegistry(enabled={}, metrics={})'.format(self.enabled, len(self.metrics))
+
+NULL_INSTRUMENT = NullInstrument()
+METRICS = MetricsRegistry() # registry of the process
+
+# Local query endpoint: any datagram is answered with the snapshot of the registry ('json' -> JSON, text otherwise)
+# It runs in its own thread, the gauges read the structures of the sessions so the answer is given to schedule
+# (schedule(callback, *args) runs it in the thread of the sessions, None = in this thread, nothing else uses them)
+class MetricsServer(object):
+    MAX_SIZE = 65507 # UDP payload
+
+    def __init__(self, address, registry=METRICS, schedule=None):
+        self.registry = registry
+        self.schedule = schedule
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.address = self.sock.getsockname()
+        self.queries = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    # Ends the thread (woken up by an empty datagram) and closes the socket
+    def close(self):
+        self.running = False
+        if (self.thread):
+            self.sock.sendto('', self.address)
+            self.thread.join()
+            self.thread = None
+        self.sock.close()
+
+    def _serve(self):
+        while self.running:
+            try:
+                command, address = self.sock.recvfrom(64)
+                if (not self.running):
+                    break
+                self.queries += 1
+                if (self.schedule):
+                    self.schedule(self._answer, command, address)
+                else:
+                    self._answer(command, address)
+            except Exception as e: # the endpoint never stops the server
+                log.warn('[Metrics] query failed: {}'.format(e))
+
+    def _answer(self, command, address):
+        if (command.strip() == 'json'):
+            response = json.dumps(self.registry.snapshot())
+        else:
+            response = self.registry.format()
+        self.sock.sendto(response[:self.MAX_SIZE], address)
+
+# Query of the endpoint of a server: python Metrics.py [port] [json]
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if (len(sys.argv) > 1) else 1314
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2.0)
+    sock.sendto(sys.argv[2] if (len(sys.argv) > 2) else 'stats', ('127.0.0.1', port))
+    try:
+        print(sock.recv(MetricsServer.MAX_SIZE))
+    except socket.timeout:
+        sys.exit('No answer from 127.0.0.1:{}'.format(port))
@@ -0,0 +1,54 @@
+# RateLimiter.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+# Token bucket: rate tokens per second up to burst, refilled when it is used (nothing to do meanwhile)
+class TokenBucket(object):
+    __slots__ = ('tokens', 'last')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.last = now
+
+# One token bucket for each key (source address, client ID...)
+# When there are size buckets, the ones which are full again are forgotten (a forgotten key starts with a full
+# bucket, as it would anyway), or every bucket if it is not enough to free half of them (a flood of spoofed
+# addresses cannot fill the memory, and this happens at most once every size/2 new keys)
+class RateLimiter(object):
+    SIZE = 4096
+
+    # rate = tokens per second, burst = tokens of a full bucket
+    def __init__(self, rate, burst, size=SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = dict() # key -> TokenBucket
+        self.allowed = 0
+        self.throttled = 0
+
+    def __repr__(self):
+        return 'RateLimiter(rate={}, burst={}, buckets={}, allowed={}, throttled={})'.format(self.rate, self.burst, len(self.buckets), self.allowed, self.throttled)
+
+    # True if the key has a token left (it is taken), False if it must be throttled
+    def allow(self, key, now):
+        bucket = self.buckets.get(key)
+        if (bucket is None):
+            if (len(self.buckets) >= self.size):
+                self._sweep(now)
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.last) * self.rate)
+            bucket.last = now
+        if (bucket.tokens < 1):
+            self.throttled += 1
+            return False
+        bucket.tokens -= 1
+        self.allowed += 1
+        return True
+
+    def _sweep(self, now):
+        refill = self.burst / self.rate # time to fill an empty bucket
+        self.buckets = dict((key, bucket) for key, bucket in self.buckets.iteritems() if (now - bucket.last < refill))
+        if (len(self.buckets) > self.size / 2):
+            self.buckets.clear()
@@ -0,0 +1,70 @@
+# Reassembly.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import time
+import logging as log
+from collections import OrderedDict
+
+from InstantProtocol import *
+
+# Payloads of the Data Messages sent in fragments (see DataMessage), by source and Message ID
+# Sessions deliver the messages in order, so the fragments of a message arrive one after the other: a message
+# which misses a fragment (the sender gave up, we joined the group in the middle...) is dropped, as the messages
+# not completed in TIMEOUT seconds and the oldest ones when the incomplete messages take more than MAX_PENDING bytes
+class Reassembler(object):
+    TIMEOUT = 30.0
+    MAX_PENDING = 1048576 # bytes of the incomplete messages
+
+    def __init__(self):
+        self.messages = OrderedDict() # (source_id, message_id) -> {'parts', 'length', 'started'} (oldest first)
+        self.pending = 0 # bytes of the incomplete messages
+        self.completed = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return 'Reassembler(messages={}, pending={}, completed={}, dropped={})'.format(len(self.messages), self.pending, self.completed, self.dropped)
+
+    # Fragment received (options of the Data Message) -> whole payload if it was the last one, None otherwise
+    def add(self, source_id, options):
+        now = time.time()
+        self._expire(now)
+        message_id, number, fragments = options.fragment
+        key = (source_id, message_id)
+        message = self.messages.get(key)
+        if (number == 0):
+            if (message):
+                self._drop(key, 'restarted')
+            message = self.messages[key] = {'parts': list(), 'length': 0, 'started': now}
+        elif ((message is None) or (number != len(message['parts']))):
+            if (message):
+                self._drop(key, 'fragment {} missing'.format(len(message['parts'])))
+            return None
+        message['parts'].append(options.payload)
+        message['length'] += len(options.payload)
+        self.pending += len(options.payload)
+        if (message['length'] > DataMessage.MAX_LENGTH):
+            self._drop(key, 'too long')
+            return None
+        if (number == fragments - 1): # last fragment
+            del self.messages[key]
+            self.pending -= message['length']
+            self.completed += 1
+            return ''.join(message['parts'])
+        while (self.pending > self.MAX_PENDING):
+            self._drop(next(iter(self.messages)), 'memory limit')
+        return None
+
+    def _expire(self, now):
+        while (self.messages):
+            key, message = next(self.messages.iteritems())
+            if (now - message['started'] < self.TIMEOUT):
+                break
+            self._drop(key, 'timeout')
+
+    def _drop(self, key, reason):
+        message = self.messages.pop(key)
+        self.pending -= message['length']
+        self.dropped += 1
+        log.warn('\033[1m[---] Message {} of {} dropped ({}, {} bytes received)\033[0m'.format(key[1], key[0], reason, message['length']))
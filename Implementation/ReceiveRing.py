@@ -0,0 +1,68 @@
+# ReceiveRing.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import os
+import errno
+import socket
+import logging as log
+
+# Preallocated buffers for the datagrams of a socket (recvfrom_into, nothing is allocated per datagram)
+# Datagrams are returned as views of the buffers, so a message decoded from them is only valid until
+# its buffer is used again (next batch), it has to be dispatched before
+class ReceiveRing(object):
+    SIZE = 64 # datagrams per batch
+
+    def __init__(self, sock, buffer=1024, size=SIZE):
+        self.sock = sock
+        self.buffers = [bytearray(buffer) for i in xrange(size)]
+        self.views = [memoryview(b) for b in self.buffers]
+        self.received = 0 # datagrams read
+        self.batches = 0
+        self.full_batches = 0 # batches which used every buffer (the socket had more datagrams waiting)
+        self.drops = 0 # datagrams dropped by the kernel, last value read (check_drops)
+
+    def __repr__(self):
+        return 'ReceiveRing(size={}, buffer={}, received={}, batches={}, full_batches={}, drops={})'.format(
+            len(self.buffers), len(self.buffers[0]), self.received, self.batches, self.full_batches, self.drops)
+
+    # One datagram (blocking socket, it is dispatched before the next one is read)
+    def receive(self):
+        nbytes, address = self.sock.recvfrom_into(self.views[0])
+        self.received += 1
+        return self.views[0][:nbytes], address
+
+    # Datagrams waiting in the socket (non-blocking) until it is empty or every buffer is used
+    def drain(self):
+        batch = list()
+        for view in self.views:
+            try:
+                nbytes, address = self.sock.recvfrom_into(view)
+            except socket.error as e:
+                if (e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)): # nothing else to read
+                    break
+                raise
+            batch.append((view[:nbytes], address))
+        self.received += len(batch)
+        self.batches += 1
+        if (len(batch) == len(self.views)):
+            self.full_batches += 1
+        return batch
+
+    # Datagrams dropped by the kernel since the last check (receive buffer full), from the drops
+    # column of /proc/net/udp for the inode of the socket (0 if it is not available)
+    def check_drops(self):
+        inode = str(os.fstat(self.sock.fileno()).st_ino)
+        for path in ('/proc/net/udp', '/proc/net/udp6'):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        fields = line.split()
+                        if (fields[9] == inode):
+                            drops = int(fields[-1])
+                            new_drops, self.drops = drops - self.drops, drops
+                            return new_drops
+            except IOError: # not Linux
+                pass
+        return 0
@@ -0,0 +1,254 @@
+# ReliableSession.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import time
+import logging as log
+from collections import deque
+
+from InstantProtocol import *
+from Metrics import *
+
+# Metrics of every session of the process (see Metrics)
+_SENT = dict((message_type, METRICS.counter('session.sent.{}'.format(option_class.__name__))) for message_type, option_class in OPTIONS_REGISTRY.iteritems())
+_ACKS_SENT = METRICS.counter('session.sent.Acknowledgement')
+_RETRANSMITTED = METRICS.counter('session.retransmitted')
+_EXPIRED = METRICS.counter('session.expired')
+_ACK_RTT = METRICS.histogram('session.ack_rtt')
+_QUEUE_DROPPED = METRICS.counter('session.queue.dropped')
+_QUEUE_COALESCED = METRICS.counter('session.queue.coalesced')
+
+# Retransmission timeout from the round-trip times measured by a session (RFC 6298)
+class RttEstimator(object):
+    ALPHA = 0.125 # gain of the smoothed RTT
+    BETA = 0.25 # gain of the RTT variation
+    K = 4
+    MIN_RTO = 0.05
+    MAX_RTO = 4.0
+
+    def __init__(self, rto):
+        self.srtt = None # smoothed RTT (None until the first sample)
+        self.rttvar = None # RTT variation
+        self.rto = rto # current timeout (backed off after each expiration)
+        self.samples = 0
+        self.backoffs = 0 # consecutive expirations without a new sample
+
+    # RTT of a message that was not resent (Karn's rule is applied by the session)
+    def sample(self, rtt):
+        if (self.srtt is None): # first measure
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+        self.backoffs = 0
+        self.rto = min(max(self.srtt + self.K * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+
+    # Timer expired -> exponential backoff (kept until a new sample is measured)
+    def backoff(self):
+        self.backoffs += 1
+        self.rto = min(self.rto * 2, self.MAX_RTO)
+
+    def __repr__(self):
+        return 'RttEstimator(srtt={}, rttvar={}, rto={}, samples={}, backoffs={})'.format(self.srtt, self.rttvar, self.rto, self.samples, self.backoffs)
+
+# Frames (sequence 0 and 1) waiting for a place in the window of a session
+# Control messages (invitations, Update List, Group Dissolution...) are sent before the Data Messages, so a burst
+# of chat lines does not delay them. Only the Data Messages are limited: when a slow peer has limit of them
+# waiting, the new line is added to the last one if it is from the same user (COALESCE), or the oldest one is dropped
+class MessageQueue(object):
+    DROP = 'drop'
+    COALESCE = 'coalesce' # (DROP if the lines cannot be merged)
+    LIMIT = 256 # Data Messages (None = no limit)
+
+    def __init__(self, limit=LIMIT, policy=COALESCE):
+        self.control = deque()
+        self.data = deque()
+        self.limit = limit
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+
+    def append(self, frames):
+        if ((ord(frames[0][0]) >> 3) != DataMessage.TYPE):
+            self.control.append(frames)
+        elif ((self.limit is None) or (len(self.data) < self.limit)):
+            self.data.append(frames)
+        elif ((self.policy == self.COALESCE) and self._coalesce(frames)):
+            self.coalesced += 1
+            _QUEUE_COALESCED.inc()
+        else:
+            self.data.popleft() # the oldest line is the least interesting one
+            self.data.append(frames)
+            self.dropped += 1
+            _QUEUE_DROPPED.inc()
+            log.debug('[---] Data Message dropped (queue full, {} dropped)'.format(self.dropped))
+
+    def popleft(self):
+        return self.control.popleft() if (self.control) else self.data.popleft()
+
+    # The payload of the new Data Message is added to the last one queued (whole messages of the same user and group
+    # which fit together in a datagram), it is encoded again (nothing is shared with other sessions)
+    def _coalesce(self, frames):
+        last = InstantProtocolMessage(rawdata=self.data[-1][0])
+        new = InstantProtocolMessage(rawdata=frames[0])
+        if (((last.source_id, last.group_id) != (new.source_id, new.group_id)) or last.options.fragment or new.options.fragment):
+            return False
+        payload = last.options.payload + '\n' + new.options.payload
+        if (len(payload) > DataMessage.FRAGMENT_LENGTH):
+            return False
+        self.data[-1] = InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': DataMessage.TYPE, 'wide': last.wide, 'extended': last.extended,
+            'sequence': 0, 'ack': 0, 'source_id': last.source_id, 'group_id': last.group_id, 'options': {'data_length': len(payload), 'payload': payload}}))
+        return True
+
+    def __len__(self):
+        return len(self.control) + len(self.data)
+
+    def __repr__(self):
+        return 'MessageQueue(control={}, data={}, dropped={}, coalesced={})'.format(len(self.control), len(self.data), self.dropped, self.coalesced)
+
+# Base object for every session (server and client side), it implements UDP reliability (Go-Back-N)
+# Legacy mode is Stop & Wait (1-bit sequence, window of 1 message), as every peer of the original protocol
+# Extended mode (16-bit sequence, window of several messages) is used towards peers that support it:
+#   - Connection Request and ACKs with R = 1 announce it (old peers ignore the bit)
+#   - each direction changes to the extended mode on its own, when nothing is waiting for an ACK
+# Messages are encoded once: frames (sequence 0 and 1) are queued, sent and resent as they are
+# IDs of 16 bits (wide) are negotiated by the Connection Request/Accept, they are only used by the messages which need them
+class ReliableSession(object):
+    STATE_IDLE = 0 # nothing waiting for ack
+    STATE_ACK = 1 # waiting for ack
+    RESEND_TIMER = 0.5 # first timeout (until the RTT is measured)
+    RETRIES = 5 # retransmissions of the oldest message before giving up (as the original protocol)
+    WINDOW = 8 # messages sent without ACK in extended mode
+
+    def __init__(self, address, scheduler, extended=True, window=WINDOW, queue_limit=MessageQueue.LIMIT, queue_policy=MessageQueue.COALESCE):
+        self.address = address
+        self.scheduler = scheduler # timers of the process (TimerWheel)
+        self.state = self.STATE_IDLE
+        self.extended_capable = int(extended) # we support the extended mode (R bit of our ACKs)
+        self.peer_extended = False # the peer supports the extended mode
+        self.extended = False # our messages use the extended mode
+        self.recv_extended = False # messages of the peer use the extended mode
+        self.wide = False # both sides support wide IDs (messages with IDs of more than 8 bits)
+        self.max_window = window
+        self.window = 1 # Stop & Wait until the extended mode is used
+        self.modulus = 2 # sequence space
+        self.last_seq_sent = 0
+        self.last_seq_recv = 0
+        self.in_flight = list() # (sequence, frame, time sent or None if resent) waiting for ACK (oldest first)
+        self.message_queue = MessageQueue(queue_limit, queue_policy) # frames waiting for a place in the window
+        self.rtt = RttEstimator(self.RESEND_TIMER)
+        self.timer = None # resend timer of the oldest message in flight
+        self.retries = 0 # retransmissions of the oldest message in flight
+
+    # At least, this methods have to be implemented
+    #def _local_id(self) -> source ID of our ACKs
+    #def _sendto(self, frame) -> sends the frame to this session's address
+    #def _expired(self) -> last attempt expired
+
+    def _can_send(self):
+        return (len(self.in_flight) < self.window)
+
+    # True if the message is the next one sent by the peer (duplicates and messages out of order are only acknowledged)
+    def _is_new(self, message):
+        self.peer_extended = self.peer_extended or bool(message.extended)
+        if (message.extension != self.recv_extended):
+            if (not message.extension): # late copy of a message sent before the peer changed its mode
+                return False
+            self.recv_extended = True # first message in extended mode (sequences start again)
+            self.last_seq_recv = 0
+        return (message.sequence == (self.last_seq_recv + 1) % (InstantProtocolMessage.EXTENDED_SEQUENCES if self.recv_extended else 2))
+
+    # True if the ACK is for a message in flight
+    def _acknowledges(self, message):
+        self.peer_extended = self.peer_extended or bool(message.extended)
+        return ((message.extension == self.extended) and any(sequence == message.sequence for sequence, frame, sent in self.in_flight))
+
+    # Private function (ACK without reliability, the frame is cached so nothing is encoded)
+    def _send_ack(self, message):
+        if (self._is_new(message)):
+            self.last_seq_recv = message.sequence # if we send an ACK, we are acknowledging the last sequence
+        # Cumulative ACK (last message received in order), except for late copies of the legacy mode
+        sequence = self.last_seq_recv if (message.extension == self.recv_extended) else message.sequence
+        log.debug('[---] Sending ACK -> type={}, sequence={}'.format(hex(message.type), sequence))
+        _ACKS_SENT.inc()
+        self._sendto(Acknowledgement.frame(message.type, sequence, self._local_id(), extended=self.extended_capable, extension=message.extension))
+
+    # Private function (send with reliability)
+    def _send(self, dictdata):
+        dictdata['sequence'] = 0 # set when the frame is sent
+        self._send_frames(InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode(dictdata, self.wide)))
+
+    # frames = (frame with sequence 0, frame with sequence 1), they can be shared between sessions
+    def _send_frames(self, frames):
+        # Can we send?
+        if (self._can_send()):
+            if ((not self.in_flight) and (not self.extended) and self.peer_extended and self.extended_capable):
+                log.debug('[---] Extended mode (window={})'.format(self.max_window))
+                self.extended = True
+                self.window = self.max_window
+                self.modulus = InstantProtocolMessage.EXTENDED_SEQUENCES
+                self.last_seq_sent = 0
+            self.last_seq_sent = (self.last_seq_sent + 1) % self.modulus # 0 to 1 and viceversa in legacy mode
+            if (self.extended):
+                frame = InstantProtocolMessage.extended_frame(frames[0], self.last_seq_sent)
+            else:
+                frame = frames[self.last_seq_sent] # set sequence (different each message)
+            log.debug('[STATE_IDLE] Sending message (type={}, sequence={})'.format(hex(ord(frame[0]) >> 3), self.last_seq_sent))
+            if (self.state == self.STATE_IDLE):
+                self.state = self.STATE_ACK
+            self.in_flight.append((self.last_seq_sent, frame, time.time()))
+            self._sendto(frame)
+            _SENT[ord(frame[0]) >> 3].inc()
+            if (len(self.in_flight) == 1): # timer of the oldest message
+                self.retries = 0
+                self._start_timer()
+
+        else: # window full
+            log.debug('[STATE_ACK] Message queued')
+            self.message_queue.append(frames)
+
+    # Retransmissions of the oldest message before giving up
+    def _retry_limit(self):
+        return self.RETRIES
+
+    def _start_timer(self):
+        self.timer = self.scheduler.call_later(self.rtt.rto, self._retransmit)
+
+    def _retransmit(self):
+        if (not self.in_flight): # acknowledged meanwhile
+            return
+        if (self.retries < self._retry_limit()): # next attempts (Go-Back-N: every message in flight, same bytes)
+            self.retries += 1
+            self.rtt.backoff()
+            log.debug('[STATE_ACK] Resending {} messages (rto={})'.format(len(self.in_flight), self.rtt.rto))
+            self.in_flight[:] = [(sequence, frame, None) for sequence, frame, sent in self.in_flight] # no RTT sample from them (Karn)
+            for sequence, frame, sent in self.in_flight:
+                self._sendto(frame)
+            _RETRANSMITTED.inc(len(self.in_flight))
+            self._start_timer()
+        else: # last attempt expired
+            _EXPIRED.inc()
+            self._expired()
+
+    # Messages acknowledged up to sequence (cumulative ACK), every message in flight if None (implicit ACK)
+    # -> send messages in queue while the window allows it
+    def _acknowledged(self, sequence=None):
+        acknowledged = len(self.in_flight)
+        if (sequence is not None):
+            acknowledged = [s for s, frame, sent in self.in_flight].index(sequence) + 1
+        if (acknowledged and (self.in_flight[acknowledged - 1][2] is not None)): # RTT of the last message acknowledged
+            rtt = time.time() - self.in_flight[acknowledged - 1][2]
+            self.rtt.sample(rtt)
+            _ACK_RTT.observe(rtt)
+        del self.in_flight[:acknowledged]
+        self.timer.cancel() # stop timer
+        if (self.in_flight): # new oldest message, new attempts
+            self.retries = 0
+            self._start_timer()
+        self.state = self.STATE_ACK if (self.in_flight) else self.STATE_IDLE
+        while (len(self.message_queue) and self._can_send()):
+            self._send_frames(self.message_queue.popleft())
+            log.debug('[STATE_IDLE] Message dequeued')
@@ -0,0 +1,117 @@
+# Scheduler.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import time
+import threading
+import logging as log
+
+# Handle of a scheduled call (returned by call_later, cancel() as threading.Timer)
+class ScheduledCall(object):
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds # turns of the wheel before it expires
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.wheel._cancel(self)
+
+    def __repr__(self):
+        # only the name of the callback (a bound method would show its session, which shows this timer)
+        return 'ScheduledCall(callback={}, slot={}, rounds={})'.format(getattr(self.callback, '__name__', self.callback), self.slot, self.rounds)
+
+# Hashed timer wheel: all timers of the process (resend, invitation...) run in a single thread
+# call_later and cancel are O(1), every tick only visits the timers of one slot
+class TimerWheel(object):
+    TICK = 0.01 # resolution of 10ms
+    SLOTS = 512 # one turn every 5.12s
+
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [set() for i in xrange(slots)]
+        self.cursor = 0 # slot of the current tick
+        self.last_tick = time.time()
+        self.pending = 0 # number of scheduled calls
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event() # set when there are timers to serve (or the wheel is stopped)
+        self.thread = None
+        self.running = False
+
+    # Same interface as threading.Timer(delay, callback, args) but without any thread per timer
+    def call_later(self, delay, callback, *args):
+        with self.lock:
+            now = time.time()
+            if (self.pending == 0): # wheel stopped while idle (no ticks to catch up)
+                self.last_tick = now
+            ticks = max(1, int(round((delay + (now - self.last_tick)) / self.tick)))
+            slot = (self.cursor + ticks) % len(self.slots)
+            call = ScheduledCall(self, slot, (ticks - 1) / len(self.slots), callback, args)
+            self.slots[slot].add(call)
+            self.pending += 1
+        self.wakeup.set()
+        return call
+
+    def _cancel(self, call):
+        with self.lock:
+            if (call in self.slots[call.slot]): # it can be already expired
+                self.slots[call.slot].remove(call)
+                self.pending -= 1
+
+    # Runs the calls expired until now (it can be driven by the thread or by an external loop)
+    def advance(self, now=None):
+        now = now or time.time()
+        expired = list()
+        with self.lock:
+            while (now - self.last_tick >= self.tick):
+                self.last_tick += self.tick
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                slot = self.slots[self.cursor]
+                for call in list(slot):
+                    if (call.rounds == 0):
+                        slot.remove(call)
+                        expired.append(call)
+                    else:
+                        call.rounds -= 1
+            self.pending -= len(expired)
+            if (self.pending == 0):
+                self.wakeup.clear()
+        # Callbacks are executed without the lock (they usually schedule other calls)
+        for call in expired:
+            try:
+                call.callback(*call.args)
+            except Exception:
+                log.exception('[Scheduler] Error in {}'.format(call))
+
+    # Seconds until the next tick (None if there is nothing to wait for)
+    def next_timeout(self):
+        if (self.pending == 0):
+            return None
+        return max(0, self.last_tick + self.tick - time.time())
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='TimerWheel')
+        self.thread.daemon = True # it doesn't keep the process alive
+        self.thread.start()
+        return self
+
+    # Ends the thread (the pending calls are not run) and waits for it, unless it is called by a callback
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if (self.thread and (self.thread is not threading.current_thread())):
+            self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while self.running:
+            if (self.pending == 0): # sleeping until something is scheduled (or stopped)
+                self.wakeup.wait()
+                continue
+            time.sleep(self.tick)
+            self.advance()
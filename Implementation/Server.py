@@ -5,100 +5,374 @@
 
 import socket
 import sys
+import time
+import select
 import struct
-import random
+import threading
 import logging as log
 
 from InstantProtocol import *
 from SocketError import *
+from ReceiveRing import *
+from UserListSnapshot import *
+from Scheduler import *
+from SessionDirectory import *
+from IdAllocator import *
+from RateLimiter import *
+from Metrics import *
 from ServerSession import *
+from Cluster import *
+
+# Messages received by type (see Metrics)
+_RECEIVED = dict((message_type, METRICS.counter('server.received.{}'.format(option_class.__name__))) for message_type, option_class in OPTIONS_REGISTRY.iteritems())
+_RECEIVED_ACKS = METRICS.counter('server.received.Acknowledgement')
+_RECEIVED_UNKNOWN = METRICS.counter('server.received.unknown')
 
 class Server(object):
-    def __init__(self, address=('localhost', 1313), buffer=1024, loss_rate=5):
+    ENGINE_THREADS = 'threads' # blocking reception, timers in their own thread
+    ENGINE_LOOP = 'loop' # reception and timers in a single thread (select loop)
+    BATCH = 64 # datagrams read at once by the loop before serving the timers (buffers of the receive ring)
+    DROPS_INTERVAL = 1.0 # minimum time between two checks of the datagrams dropped by the kernel
+    KEEPALIVE = 15.0 # seconds without any message of a client before it is probed (see ServerSession.keepalive)
+    KEEPALIVE_INTERVAL = 1.0 # minimum time between two searches of idle sessions
+    ADDRESS_RATE = (500.0, 1000) # datagrams per second (and burst) of each address, ACKs included
+    CLIENT_RATE = (64.0, 128) # messages per second (and burst) of each client, without ACKs (a long message is sent in 64 fragments)
+    MAX_PENDING = 128 # sessions waiting for the ACK of their Connection Accept
+    STATS_INTERVAL = 60.0 # seconds between two snapshots of the metrics in the log
+
+    # cluster = worker of a Cluster (several processes on the same port, always with the loop engine)
+    # rcvbuf = SO_RCVBUF of the socket (None keeps the default of the system)
+    # wide = 16-bit client and group IDs for the clients which support them (extended mode), when the 8-bit ones run out
+    # queue_limit, queue_policy = Data Messages waiting for a slow client (see MessageQueue)
+    # address_rate, client_rate = (rate, burst) of the token buckets of each address and client ID (None = no limit)
+    # max_pending = Connection Requests in progress at the same time (the others are ignored, None = no limit)
+    # stats_address = local address of the metrics query endpoint (see MetricsServer, + worker in a cluster, None = no endpoint)
+    # stats_interval = seconds between two snapshots of the metrics in the log (None = never)
+    def __init__(self, address=('localhost', 1313), buffer=1024, loss_rate=5, extended=True, window=ReliableSession.WINDOW, engine=ENGINE_THREADS, cluster=None, rcvbuf=None, wide=True, queue_limit=MessageQueue.LIMIT, queue_policy=MessageQueue.COALESCE,
+            address_rate=ADDRESS_RATE, client_rate=CLIENT_RATE, max_pending=MAX_PENDING, stats_address=None, stats_interval=STATS_INTERVAL):
         self.address = address
-        self.pool_client_ids = random.sample(xrange(1, 256), 255) # random client ids
-        self.pool_group_ids = random.sample(xrange(2, 256), 254) # random group ids
-        self.session_list = list()
+        self.extended = extended # extended mode for the clients which support it (sliding window)
+        self.window = window
+        self.queue_limit = queue_limit
+        self.queue_policy = queue_policy
+        self.wide = wide and extended
+        self.cluster = cluster
+        self.engine = self.ENGINE_LOOP if (cluster) else engine
+        shared = cluster.share if (cluster) else list # every worker allocates its own part of the IDs
+        self.client_ids = IdAllocator(shared(xrange(1, 256))) # random client ids
+        self.group_ids = IdAllocator(shared(xrange(2, 256))) # random group ids
+        self.wide_client_ids = IdAllocator(shared(xrange(256, 0x10000)) if (self.wide) else ()) # random 16-bit client ids
+        self.wide_group_ids = IdAllocator(shared(xrange(256, 0x10000)) if (self.wide) else ()) # random 16-bit group ids
+        self.sessions = SessionDirectory() if (not cluster) else SharedDirectory(cluster) # sessions by client ID, username and address (of every worker)
+        self.sessions.on_remove = self._session_removed
+        self.sessions.on_empty_group = self._group_emptied
+        self.user_lists = UserListSnapshot(self.sessions) # User List Response cached while the sessions don't change
+        self.idle = IdleIndex() # sessions of this worker by time of their last message
+        self.address_limiter = RateLimiter(*address_rate) if (address_rate) else None # datagrams of each address
+        self.client_limiter = RateLimiter(*client_rate) if (client_rate) else None # messages of each client
+        self.max_pending = max_pending
+        self.pending = set() # sessions waiting for the ACK of their Connection Accept
+        self.pending_rejected = 0 # Connection Requests ignored because of max_pending
+        self.malformed = 0 # datagrams which could not be decoded
+        self.scheduler = TimerWheel() # resend and invitation timers
+        self.running = True # until stop()
+        self.waker = socket.socketpair() if (self.engine == self.ENGINE_LOOP) else None # wakes the loop up when another thread stops it or schedules a call
+        self.keepalive_timer = None # search of idle sessions (armed only while there are sessions)
+        self.keepalive_lock = threading.Lock() # (sessions are touched by the reception while the timer thread searches)
+        if (self.engine == self.ENGINE_THREADS):
+            self.scheduler.start() # single timer thread
         self.sock = SocketError(socket.AF_INET, socket.SOCK_DGRAM, loss_rate) # UDP
+        if (cluster):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # the kernel shares the datagrams between the workers
+        if (rcvbuf):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
         self.sock.bind(address)
         self.buffer = buffer
+        self.ring = ReceiveRing(self.sock, buffer, self.BATCH) # datagrams are read into preallocated buffers
+        self.drops_checked = 0 # last check of the kernel drops
+        self.stats_interval = stats_interval
+        self._register_metrics()
+        if (stats_interval):
+            self.scheduler.call_later(stats_interval, self._dump_metrics)
+        self.stats = None # query endpoint of the metrics
+        if (stats_address):
+            try:
+                self.stats = MetricsServer((stats_address[0], stats_address[1] + (cluster.worker if (cluster) else 0)), schedule=self._call_soon).start()
+                log.info('[Metrics] query endpoint on {}'.format(self.stats.address))
+            except socket.error as e:
+                log.warn('[Metrics] no query endpoint on {}: {}'.format(stats_address, e))
 
     # Main functionality
     def run(self):
+        try:
+            if (self.engine == self.ENGINE_LOOP):
+                self._run_loop()
+            else:
+                self._run_threads()
+        except KeyboardInterrupt:
+            self.ring.check_drops()
+            log.info('Closing server... {} {} {}'.format(self.ring, self.user_lists, self.idle))
+            log.info('Throttled: addresses {}, clients {}, pending={}, malformed={}'.format(self.address_limiter, self.client_limiter, self.pending_rejected, self.malformed))
+            log.info('IDs: clients {} {}, groups {} {}'.format(self.client_ids, self.wide_client_ids, self.group_ids, self.wide_group_ids))
+            queues = [session.message_queue for session in self.sessions if (isinstance(session, ServerSession))]
+            log.info('Queues of {} sessions: dropped={}, coalesced={}'.format(len(queues), sum(queue.dropped for queue in queues), sum(queue.coalesced for queue in queues)))
+            self.close()
+            sys.exit(0)
+
+    # Runs the callback in the thread of the sessions, as a timer (the loop engine is woken up to serve it)
+    def _call_soon(self, callback, *args):
+        self.scheduler.call_later(0, callback, *args)
+        if (self.waker):
+            self.waker[1].send('\x00')
+
+    # Ends the loop engine after its current iteration (it can be called by another thread)
+    def stop(self):
+        self.running = False
+        if (self.waker):
+            self.waker[1].send('\x00')
+
+    # The timer thread is stopped before the interpreter exits (a daemon thread would run during its shutdown)
+    def close(self):
+        if (self.stats):
+            self.stats.close()
+        self.scheduler.stop()
+        self.sock.close()
+        if (self.waker):
+            for sock in self.waker:
+                sock.close()
+
+    def _run_threads(self):
         while True:
-            try:
-                data, client_address = self.sock.recvfrom(self.buffer)
-                message_recv = InstantProtocolMessage(rawdata=data)
-                log.debug(message_recv)
-
-                # ACK first because it's more important than type here
-                if (message_recv.ack == Acknowledgement.FLAG): # ACK
-                    try:
-                        self._get_session(message_recv.source_id).acknowledgement(message_recv)
-                    except SessionNotFound: # when ConnectionReject we can receive an ACK -> ignore it
-                        pass
-                elif (message_recv.type == ConnectionRequest.TYPE):
-                    # Sending messages directly because session is not created yet
-                    new_username = message_recv.options.username
-                    # We don't create a session until it's successful
-                    if (len(self.pool_client_ids) == 0):
-                        log.info('[Connection] (Failed -> maximum reached) {}'.format(new_username))
-                        message_reject = InstantProtocolMessage(dictdata={'type': ConnectionReject.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'error': 0}})
-                        self.sock.sendto(message_reject.serialize(), client_address)
-                    elif (any(new_username == s.username for s in self.session_list)): # username not used
-                        log.info('[Connection] (Failed -> username already taken) {}'.format(new_username))
-                        message_reject = InstantProtocolMessage(dictdata={'type': ConnectionReject.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'error': 1}})
-                        self.sock.sendto(message_reject.serialize(), client_address)
-                    else:
-                        # Create new session and add it to the list
-                        log.info('[Connection] username={}'.format(new_username))
-                        print('\033[1mUser {} connected\033[0m'.format(new_username))
-                        new_session = ServerSession(self, new_username, self.pool_client_ids.pop(0), client_address)
-                        self.session_list.append(new_session)
-
-                elif (message_recv.type == UserListRequest.TYPE):
-                    self._get_session(message_recv.source_id).user_list_response(message_recv)
-
-                elif (message_recv.type == DataMessage.TYPE):
-                    self._get_session(message_recv.source_id).data_message(message_recv)
-
-                elif (message_recv.type == GroupCreationRequest.TYPE):
-                    self._get_session(message_recv.source_id).group_creation_request(message_recv)
-
-                elif (message_recv.type == GroupInvitationRequest.TYPE):
-                    self._get_session(message_recv.source_id).group_invitation_request(message_recv)
-
-                elif (message_recv.type == GroupInvitationAccept.TYPE):
-                    self._get_session(message_recv.source_id).group_invitation_accept(message_recv)
-
-                elif (message_recv.type == GroupInvitationReject.TYPE):
-                    self._get_session(message_recv.source_id).group_invitation_reject(message_recv)
-
-                elif (message_recv.type == GroupDisjointRequest.TYPE):
-                    self._get_session(message_recv.source_id).group_disjoint_request(message_recv)
-
-                elif (message_recv.type == DisconnectionRequest.TYPE):
-                    # it's possible to loose an ACK when disconnection (ignore this message because the session isn't longer available)
+            data, client_address = self.ring.receive()
+            self._dispatch(data, client_address)
+
+    # Sessions are only used by this thread: datagrams and expired timers are served one after the other
+    # (and the notices of the other workers in a cluster, what the sessions send them is flushed every iteration)
+    def _run_loop(self):
+        self.sock.setblocking(False)
+        inputs = [ self.sock, self.waker[0], self.cluster ] if (self.cluster) else [ self.sock, self.waker[0] ]
+        while self.running:
+            readable, _, _ = select.select(inputs, self.cluster.outputs() if (self.cluster) else [], [], self.scheduler.next_timeout())
+            if (self.waker[0] in readable): # (stopped, or something was scheduled by another thread)
+                self.waker[0].recv(64)
+            if (self.cluster in readable):
+                self.cluster.receive()
+            if (self.sock in readable):
+                batch = self.ring.drain() # the socket is emptied first, then every datagram is dispatched
+                for data, client_address in batch:
+                    self._dispatch(data, client_address)
+                if (len(batch) == self.BATCH): # falling behind?
+                    self._check_drops()
+            self.scheduler.advance()
+            if (self.cluster):
+                self.cluster.flush()
+
+    # Warning if the kernel dropped datagrams because the receive buffer was full (the server is too slow)
+    def _check_drops(self):
+        now = time.time()
+        if (now - self.drops_checked >= self.DROPS_INTERVAL):
+            self.drops_checked = now
+            drops = self.ring.check_drops()
+            if (drops):
+                log.warn('\033[1m[---] {} datagrams dropped by the kernel (receive buffer full, {} in total)\033[0m'.format(drops, self.ring.drops))
+
+    # Message received from a client (data is a view of a receive buffer, valid until the next batch)
+    # Floods are dropped as soon as possible: addresses over their rate before decoding anything, messages of
+    # clients over their rate after decoding the header and finding their session (without ACK, so the client sends them again later)
+    def _dispatch(self, data, client_address):
+        now = time.time()
+        if (self.address_limiter and (not self.address_limiter.allow(client_address, now))):
+            log.debug('[Throttled] address={}'.format(client_address))
+            return
+        if (len(data) < InstantProtocolMessage.HEADER_SIZE): # empty or shorter than a header
+            self.malformed += 1
+            log.debug('[Malformed] address={}, length={}'.format(client_address, len(data)))
+            return
+        try:
+            message_recv = InstantProtocolMessage(rawdata=data)
+            log.debug(message_recv)
+            (_RECEIVED_ACKS if (message_recv.ack) else _RECEIVED.get(message_recv.type, _RECEIVED_UNKNOWN)).inc()
+
+            if ((message_recv.ack != Acknowledgement.FLAG) and (message_recv.type != ConnectionRequest.TYPE) and (not self._admitted(message_recv, client_address, now))):
+                pass # (spoofed or over its rate)
+
+            # ACK first because it's more important than type here
+            elif (message_recv.ack == Acknowledgement.FLAG): # ACK
+                try:
+                    self._get_session(message_recv.source_id).acknowledgement(message_recv)
+                except SessionNotFound: # when ConnectionReject we can receive an ACK -> ignore it
+                    pass
+            elif (message_recv.type == ConnectionRequest.TYPE):
+                # Sending messages directly because session is not created yet
+                new_username = message_recv.options.username
+                wide = bool(self.wide and message_recv.extended and (message_recv.group_id & ConnectionRequest.WIDE_IDS)) # both sides support wide IDs
+                # We don't create a session until it's successful
+                session = self.sessions.get_by_address(client_address)
+                if (session and (session.username == new_username)): # Connection Accept lost, it is being resent by the session
+                    log.debug('[Connection] (Repeated request) {}'.format(new_username))
+                elif ((self.max_pending is not None) and (len(self.pending) >= self.max_pending)): # flood (the client asks again later)
+                    self.pending_rejected += 1
+                    log.debug('[Connection] (Ignored -> too many pending) {}'.format(new_username))
+                elif (not (self.client_ids.available() or (wide and self.wide_client_ids.available()))):
+                    log.info('[Connection] (Failed -> maximum reached) {}'.format(new_username))
+                    message_reject = InstantProtocolMessage(dictdata={'type': ConnectionReject.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'error': 0}})
+                    self.sock.sendto(message_reject.serialize(), client_address)
+                elif (self.sessions.get_by_username(new_username)): # username not used
+                    log.info('[Connection] (Failed -> username already taken) {}'.format(new_username))
+                    message_reject = InstantProtocolMessage(dictdata={'type': ConnectionReject.TYPE, 'sequence': 0, 'ack': 0, 'source_id': 0x00, 'group_id': 0x00, 'options': {'error': 1}})
+                    self.sock.sendto(message_reject.serialize(), client_address)
+                else:
+                    # Create new session and add it to the list
+                    log.info('[Connection] username={}'.format(new_username))
+                    print('\033[1mUser {} connected\033[0m'.format(new_username))
+                    new_session = ServerSession(self, new_username, self._allocate(self.client_ids, self.wide_client_ids, wide), client_address, message_recv, wide)
+                    self.sessions.add(new_session)
+                    self._touch(new_session, now)
+                    self.pending.add(new_session)
+
+            elif (message_recv.type == UserListRequest.TYPE):
+                self._get_session(message_recv.source_id).user_list_response(message_recv)
+
+            elif (message_recv.type == DataMessage.TYPE):
+                self._get_session(message_recv.source_id).data_message(message_recv)
+
+            elif (message_recv.type == GroupCreationRequest.TYPE):
+                self._get_session(message_recv.source_id).group_creation_request(message_recv)
+
+            elif (message_recv.type == GroupInvitationRequest.TYPE):
+                self._get_session(message_recv.source_id).group_invitation_request(message_recv)
+
+            elif (message_recv.type == GroupInvitationAccept.TYPE):
+                self._get_session(message_recv.source_id).group_invitation_accept(message_recv)
+
+            elif (message_recv.type == GroupInvitationReject.TYPE):
+                self._get_session(message_recv.source_id).group_invitation_reject(message_recv)
+
+            elif (message_recv.type == GroupDisjointRequest.TYPE):
+                self._get_session(message_recv.source_id).group_disjoint_request(message_recv)
+
+            elif (message_recv.type == DisconnectionRequest.TYPE):
+                try:
                     self._get_session(message_recv.source_id).disconnection_request(message_recv)
+                except SessionNotFound: # our ACK was lost and the session is removed -> acknowledged again, so the client does not wait until it expires
+                    if (not self.sessions.get(message_recv.source_id)): # (not a user of another worker)
+                        self.sock.sendto(Acknowledgement.frame(message_recv.type, message_recv.sequence, 0x00, extended=int(self.extended), extension=message_recv.extension), client_address)
+
+        except SessionNotFound:
+            log.error('Session not found, message coming from unexpected source')
+        except (struct.error, ValueError): # truncated datagram
+            self.malformed += 1
+            log.debug('[Malformed] address={}, length={}'.format(client_address, len(data)))
+
+    # Group ID for a new group (wide = every member supports wide IDs), None if there is no ID left
+    def allocate_group_id(self, wide):
+        return self._allocate(self.group_ids, self.wide_group_ids, wide)
+
+    # Group creation cancelled (nobody joined the group)
+    def release_group_id(self, group_id):
+        self._release(self.group_ids, self.wide_group_ids, group_id)
+
+    # 8-bit IDs are used first (every client supports them), 16-bit IDs when they run out
+    def _allocate(self, pool, wide_pool, wide):
+        new_id = pool.allocate()
+        if ((new_id is None) and wide):
+            new_id = wide_pool.allocate()
+        return new_id
+
+    def _release(self, pool, wide_pool, released_id):
+        (pool if (InstantProtocolMessage.fits(released_id)) else wide_pool).release(released_id)
+
+    # The session was removed from the directory (disconnected or expired) -> its client ID can be used again
+    def _session_removed(self, session):
+        self.idle.discard(session)
+        self.pending.discard(session)
+        self._release(self.client_ids, self.wide_client_ids, session.client_id)
+
+    # The last member left the group -> its group ID can be used again (the public group is never allocated)
+    def _group_emptied(self, group_id):
+        self._release(self.group_ids, self.wide_group_ids, group_id)
+
+    # Clients without any message for KEEPALIVE seconds are probed: the ones which don't answer expire as
+    # any other session whose messages are not acknowledged (their IDs and entries in the directory are released)
+    def _keepalive(self):
+        self.keepalive_timer = None
+        now = time.time()
+        for session in self.idle.idle(now - self.KEEPALIVE):
+            self.idle.touch(session, now) # probed again after KEEPALIVE seconds if it is still idle
+            session.keepalive()
+        self._arm_keepalive(now)
+
+    # Next search when the oldest session becomes idle (the wheel stays idle while there are no sessions)
+    def _arm_keepalive(self, now):
+        with self.keepalive_lock:
+            oldest = self.idle.oldest()
+            if ((self.keepalive_timer is None) and (oldest is not None)):
+                self.keepalive_timer = self.scheduler.call_later(max(self.KEEPALIVE_INTERVAL, oldest + 1 + self.KEEPALIVE - now), self._keepalive)
+
+    # Any message shows that the client is alive
+    def _touch(self, session, now):
+        self.idle.touch(session, now)
+        if (self.keepalive_timer is None):
+            self._arm_keepalive(now)
+
+    # Gauges of the server (read by a snapshot only, the counters are updated where things happen)
+    def _register_metrics(self):
+        local_sessions = lambda: [session for session in self.sessions if (isinstance(session, ServerSession))]
+        METRICS.gauge('server.sessions', lambda: len(local_sessions()))
+        METRICS.gauge('server.sessions.directory', lambda: len(self.sessions)) # every worker
+        METRICS.gauge('server.sessions.pending', lambda: len(self.pending))
+        METRICS.gauge('server.queue.messages', lambda: sum(len(session.message_queue) for session in local_sessions()))
+        METRICS.gauge('server.queue.max', lambda: max([len(session.message_queue) for session in local_sessions()] or [0]))
+        METRICS.gauge('server.in_flight', lambda: sum(len(session.in_flight) for session in local_sessions()))
+        METRICS.gauge('server.timers', lambda: self.scheduler.pending)
+        METRICS.gauge('server.datagrams.received', lambda: self.ring.received)
+        METRICS.gauge('server.datagrams.kernel_drops', lambda: self.ring.drops)
+        METRICS.gauge('server.datagrams.malformed', lambda: self.malformed)
+        METRICS.gauge('server.throttled.address', lambda: self.address_limiter.throttled if (self.address_limiter) else 0)
+        METRICS.gauge('server.throttled.client', lambda: self.client_limiter.throttled if (self.client_limiter) else 0)
+        METRICS.gauge('server.throttled.pending', lambda: self.pending_rejected)
+        METRICS.gauge('server.ids.clients', lambda: len(self.client_ids) + len(self.wide_client_ids))
+        METRICS.gauge('server.ids.groups', lambda: len(self.group_ids) + len(self.wide_group_ids))
+        METRICS.gauge('server.ids.client_occupancy', lambda: round(self.client_ids.occupancy(), 3))
+        METRICS.gauge('server.ids.group_occupancy', lambda: round(self.group_ids.occupancy(), 3))
+        METRICS.gauge('server.user_list.hits', lambda: self.user_lists.hits)
+        METRICS.gauge('server.user_list.misses', lambda: self.user_lists.misses)
 
-            except KeyboardInterrupt:
-                log.info('Closing server...')
-                self.sock.close()
-                sys.exit(0)
+    def _dump_metrics(self):
+        log.info('[Metrics] {}'.format(METRICS.format(', ')))
+        self.scheduler.call_later(self.stats_interval, self._dump_metrics)
 
-            except SessionNotFound:
-                log.error('Session not found, message coming from unexpected source')
+    # Requests of a client are served only from the address of its session (a source ID can be spoofed, the others
+    # are counted as malformed) and within the rate of the client (see CLIENT_RATE)
+    def _admitted(self, message, address, now):
+        session = self.sessions.get(message.source_id)
+        if (not isinstance(session, ServerSession)): # unknown (or of another worker), see _get_session
+            return True
+        if (session.address != address):
+            self.malformed += 1
+            log.debug('[Malformed] address={}, client_id={} (address of another client)'.format(address, message.source_id))
+            return False
+        if (self.client_limiter and (not self.client_limiter.allow(message.source_id, now))):
+            log.debug('[Throttled] client_id={}'.format(message.source_id))
+            return False
+        return True
 
     # This function returns session of the message (user handler)
     def _get_session(self, source_id):
-        for session in self.session_list:
-            if (session.client_id == source_id):
-                return session
-        # Raise exception if not returned value
-        raise SessionNotFound
+        session = self.sessions.get(source_id)
+        # Raise exception if not found (or served by another worker)
+        if (not isinstance(session, ServerSession)):
+            raise SessionNotFound
+        self._touch(session, time.time())
+        return session
 
 # Execution
 if __name__ == '__main__':
     # Comment following line of code to disable log output
     log.basicConfig(format='%(levelname)s: %(message)s', level=log.DEBUG) # DEBUG, INFO, WARN, CRITICAL
-    sys.exit(Server(loss_rate=0.1).run())
+    # python Server.py [threads|loop] [workers]
+    engine = sys.argv[1] if (len(sys.argv) > 1) else Server.ENGINE_THREADS
+    workers = int(sys.argv[2]) if (len(sys.argv) > 2) else 1
+    if (workers > 1):
+        sys.exit(Cluster(workers).run(lambda cluster: Server(loss_rate=0.1, cluster=cluster, stats_address=('127.0.0.1', 1314)).run()))
+    sys.exit(Server(loss_rate=0.1, engine=engine, stats_address=('127.0.0.1', 1314)).run())
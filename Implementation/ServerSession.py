@@ -3,174 +3,328 @@
 # Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
 # Erika Tarazona <erika.tarazona@imt-atlantique.net>
 
-import threading
+import time
 import logging as log
+from collections import OrderedDict
 
 from InstantProtocol import *
+from ReliableSession import *
+
+_RELAYED = METRICS.counter('server.data.relayed') # Data Messages received from the users
+_DELIVERED = METRICS.counter('server.data.delivered') # Data Messages sent to the members of their groups
 
 # Exception when a Session is not found
 class SessionNotFound(Exception):
     pass
 
 # Session for each client
-class ServerSession(object):
+class ServerSession(ReliableSession):
     SERVER_ID = 0x00
     PUBLIC_GROUP_ID = 0x01
     PUBLIC_GROUP_TYPE = 0x0
     NO_GROUP_ID = 0x00 # when group is set to 0 because the destination is not a group
-    STATE_IDLE = 0 # ready to send
-    STATE_ACK = 1 # waiting for ack
     STATE_PENDING_CONN = 2 # client connection
-    RESEND_TIMER = 0.5 # resend in 500ms
+    CONNECT_RETRIES = 2 # retransmissions of the Connection Accept (the client keeps asking while it waits for it)
     GROUP_TIMER = 15 # timer for Group Creation or Invitation Request (sends Group Creation Reject or Invitation Reject if not stopped)
+    PRESENCE_WINDOW = 0.05 # changes of other users are merged in a single Update List during this time (0 = sent at once)...
+    PRESENCE_MAX_DELAY = 1.0 # ...and then while our messages wait for a place in the window (but not longer)
 
-    def __init__(self, server, username, client_id, address):
+    # request = Connection Request of the client (first message of the client, it says if it supports the extended mode)
+    # wide = the client and the server support wide IDs (the Connection Accept is wide to tell the client)
+    def __init__(self, server, username, client_id, address, request, wide=False):
+        super(ServerSession, self).__init__(address, server.scheduler, server.extended, server.window, server.queue_limit, server.queue_policy)
+        self.last_seq_recv = request.sequence
+        self.peer_extended = bool(request.extended)
+        self.wide = wide
         self.server = server
         self.username = username # asked later
         self.client_id = client_id
-        self.group_id = self.PUBLIC_GROUP_ID # public by default
+        self._group_id = self.PUBLIC_GROUP_ID # public by default
         self.group_type = 0 # centralized by default (centralized = 0, decentralized = 1)
-        self.address = address
         self.state = self.STATE_PENDING_CONN
-        self.last_seq_sent = 0
-        self.last_seq_recv = 0
-        self.message_queue = list() # saving dictdata so sequence can be changed
-        self.timer = None
         self.creating_group = False # waiting for a group creation
         self.num_invited_clients = 0 # number of clients invited when creating group
+        self.new_group_id = None # group ID allocated for the group being created
+        self.invited = list() # sessions invited to the group being created
         self.inviting = False # waiting for an invitation response
         self.invitation_timer = None # timer for group creation or invitation
         self.invited_by = None # session of the user who invited us to join a group (invitation or creation)
+        self.invited_group_id = None # group of that invitation
+        self._user_info = None # entry of this user in User List Response and Update List (with its packed record)
+        self.presence = OrderedDict() # client_id -> session of the users changed since our last Update List
+        self.presence_timer = None # window of the pending changes
+        self.presence_since = 0 # time of the first pending change
+        self.presence_due = False # window elapsed, waiting for our queue
 
         # Send message to user -> Connection Accept (and session created for this user)
-        self._send(dictdata={'type': ConnectionAccept.TYPE, 'ack':0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID, 'options': {'client_id': self.client_id}})
+        self._send(dictdata={'type': ConnectionAccept.TYPE, 'wide': self.wide, 'ack':0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID, 'options': {'client_id': self.client_id}})
 
     def __repr__(self):
-        return 'ServerSession(username={}, client_id={}, group_id={}, group_type={}, last_seq_sent={}, last_seq_recv={}, state={}, message_queue={}, timer={}, creating_group={}, num_invited_clients={}, inviting={}, invitation_timer={}, invited_by={})'.format(
-            self.username, self.client_id, self.group_id, self.group_type, self.last_seq_sent, self.last_seq_recv, self.state, self.message_queue, self.timer, self.creating_group, self.num_invited_clients, self.inviting, self.invitation_timer, self.invited_by)
+        return 'ServerSession(username={}, client_id={}, group_id={}, group_type={}, wide={}, last_seq_sent={}, last_seq_recv={}, state={}, message_queue={}, timer={}, rtt={}, creating_group={}, num_invited_clients={}, inviting={}, invitation_timer={}, invited_by={}, presence={})'.format(
+            self.username, self.client_id, self.group_id, self.group_type, self.wide, self.last_seq_sent, self.last_seq_recv, self.state, self.message_queue, self.timer, self.rtt, self.creating_group, self.num_invited_clients, self.inviting, self.invitation_timer, self.invited_by, self.presence.keys())
+
+    # Group of the session, the membership index of the server is updated with it
+    @property
+    def group_id(self):
+        return self._group_id
+
+    @group_id.setter
+    def group_id(self, group_id):
+        old_group_id = self._group_id
+        self._group_id = group_id
+        if (group_id != old_group_id):
+            self.server.sessions.change_group(self, old_group_id)
 
     def user_list_response(self, message):
-        log.info('[User List] username={}'.format(self.username))
-        self.last_seq_recv = message.sequence # first message after creating the session (setting last_seq_recv for the first time)
-        users = list()
-        for user in self.server.session_list:
-            item = dict(client_id=user.client_id, group_id=user.group_id, username=user.username, ip_address=user.address[0], port=user.address[1])
-            users.append(item)
-        self._send(dictdata={'type': UserListResponse.TYPE, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': self.group_id, 'options': {'user_list': users}})
+        # Legacy clients take the response (first chunk) as ACK: a copy of the request means that it was lost, the chunks
+        # waiting for their ACK are sent again at once (the queued ones are on their way, the acknowledged ones arrived)
+        if (self._is_new(message)):
+            chunks = self.server.user_lists.get(self.group_id, self.wide) # same frames until the directory changes
+            log.info('[User List] username={}, chunks={}'.format(self.username, len(chunks)))
+            for frames in chunks:
+                self._send_frames(frames)
+        elif (not message.extension):
+            for i, (sequence, frame, sent) in enumerate(self.in_flight):
+                if ((ord(frame[0]) >> 3) == UserListResponse.TYPE):
+                    self.in_flight[i] = (sequence, frame, None) # no RTT sample from it (Karn)
+                    self._sendto(frame)
+        if (message.extension):
+            self._send_ack(message)
+        else:
+            self.last_seq_recv = message.sequence
 
+    # Fragments of long messages are sent to the group as they arrive (they are not reassembled by the server)
     def data_message(self, message):
-        if (message.sequence != self.last_seq_recv):
-            log.info('[Data message] username={}, payload={}'.format(self.username, message.options.payload))
-            for session in self.server.session_list:
-                if ((session.client_id != self.client_id) and (session.group_id == self.group_id)):
-                    session._send(dictdata={'type': message.type, 'ack': 0, 'source_id': message.source_id, 'group_id': message.group_id, 'options': {'data_length': message.options.data_length, 'payload': message.options.payload}})
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+        if (self._is_new(message)):
+            _RELAYED.inc()
+            fragment = message.options.fragment
+            if (fragment is None):
+                log.info('[Data message] username={}, payload={}'.format(self.username, message.options.payload))
+            else:
+                log.info('[Data message] username={}, message_id={}, fragment={}/{}'.format(self.username, fragment[0], fragment[1] + 1, fragment[2]))
+            # Encoded once for the whole group (every session sends the same frames, wide if the sender has a wide ID)
+            frame = InstantProtocolMessage.encode({'type': message.type, 'sequence': 0, 'ack': 0, 'source_id': message.source_id, 'group_id': message.group_id,
+                'options': {'data_length': message.options.data_length, 'payload': message.options.payload, 'fragment': fragment}}, self.wide)
+            wide = InstantProtocolMessage.has_extension(frame)
+            frames = InstantProtocolMessage.sequence_variants(frame)
+            if (fragment is None):
+                for session in self.server.sessions.fanout(self.group_id):
+                    if (session != self):
+                        session.send_shared(frames, wide)
+            else:
+                whole_frames = None # legacy users receive the first fragment as a whole message (truncated, as sent by a legacy client)
+                if ((fragment[1] == 0) and (not wide)):
+                    whole_frames = InstantProtocolMessage.sequence_variants(InstantProtocolMessage(dictdata={'type': message.type, 'sequence': 0, 'ack': 0, 'source_id': message.source_id, 'group_id': message.group_id,
+                        'options': {'data_length': message.options.data_length, 'payload': message.options.payload}}).serialize())
+                for session in self.server.sessions.fanout(self.group_id):
+                    if (session != self):
+                        session.send_fragment(frames, whole_frames, wide)
+        self._send_ack(message)
+
+    # Frames shared with other sessions (wide = they have wide IDs, users without them don't know the sender)
+    def send_shared(self, frames, wide=False):
+        if (self.wide or (not wide)):
+            _DELIVERED.inc()
+            self._send_frames(frames)
+
+    def send_fragment(self, frames, whole_frames, wide=False):
+        if (wide and (not self.wide)):
+            return
+        if (self.peer_extended and self.extended_capable): # fragments are part of the extended mode
+            _DELIVERED.inc()
+            self._send_frames(frames)
+        elif (whole_frames):
+            _DELIVERED.inc()
+            self._send_frames(whole_frames)
 
     def group_creation_request(self, message):
-        if (message.sequence != self.last_seq_recv):
-            group_id = self.server.pool_group_ids.pop(0)
-            log.info('[Group Creation Request] username={}, group_id={}, client_ids={}'.format(self.username, group_id, message.options.client_ids))
-            self.num_invited_clients = len(message.options.client_ids)
-            self.creating_group = True
-            for session in self.server.session_list:
-                if (session.client_id in message.options.client_ids):
-                    session.invited_by = self
-                    session.invitation_timer = threading.Timer(self.GROUP_TIMER, self.group_creation_reject, []) # set a timer and group_creation_reject (of the sender) will be called when it expires
-                    session.invitation_timer.start()
-                    session._send(dictdata={'type': GroupInvitationRequest.TYPE, 'ack': 0, 'source_id': message.source_id, 'group_id': message.group_id, 'options': {'type': message.options.type, 'group_id': group_id, 'client_id': session.client_id}})
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+        if (self._is_new(message)):
+            invited = [self.server.sessions.get(client_id) for client_id in set(message.options.client_ids)] # each user is invited once (even if repeated in the request)
+            invited = [session for session in invited if (session)]
+            narrow = not all(session.wide for session in [self] + invited) # a user without wide IDs is invited -> 8-bit group ID
+            group_id = self.server.allocate_group_id(not narrow)
+            if (group_id is None):
+                log.info('[Group Creation Request] (Failed -> maximum reached) username={}'.format(self.username))
+                self._send(dictdata={'type': GroupCreationReject.TYPE, 'ack':0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+            else:
+                log.info('[Group Creation Request] username={}, group_id={}, client_ids={}'.format(self.username, group_id, message.options.client_ids))
+                self.num_invited_clients = len(invited) # users not found are not waited
+                self.new_group_id = group_id
+                self.invited = invited
+                self.creating_group = True
+                if (not invited):
+                    self._cancel_group_creation()
+                for session in invited:
+                    if (narrow and (not InstantProtocolMessage.fits(session.client_id))): # the users without wide IDs could not know this one
+                        self.group_creation_reject()
+                    else:
+                        session.invite(self, True, message.source_id, message.group_id, message.options.type, group_id)
+        self._send_ack(message)
 
     def group_creation_accept(self, group_type, group_id):
         log.info('[Group Creation Accept] group_id={}, grop_type={}'.format(group_type, group_id))
         self.creating_group = False
         self.num_invited_clients = 0
+        self.new_group_id = None
+        self.invited = list() # the others can still join the group
         self.group_type = group_type
         self.group_id = group_id
         print('\033[1mGroup {} created in {} mode\033[0m'.format(self.group_id, 'centralized' if self.group_type == 0 else 'decentralized'))
         self._send(dictdata={'type': GroupCreationAccept.TYPE, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID, 'options': {'type': group_type, 'group_id': group_id}})
-        for session in self.server.session_list:
+        for session in self.server.sessions.fanout():
             if (session != self):
                 session.update_list([self])
 
     def group_creation_reject(self):
         if (self.creating_group): # timer expired (called by group creation request for each invitation failed)
             if (self.num_invited_clients == 1): # last invited client (then we cancel Group Creation)
-                self.creating_group = False
-                self.num_invited_clients = 0
-                self._send(dictdata={'type': GroupCreationReject.TYPE, 'ack':0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+                self._cancel_group_creation()
             else:
                 self.num_invited_clients -= 1
 
+    # The group ID is released, so the invitations still pending are withdrawn (an accept would join the next group of this ID)
+    def _cancel_group_creation(self):
+        self.creating_group = False
+        self.num_invited_clients = 0
+        self.server.release_group_id(self.new_group_id) # nobody joined it
+        self.new_group_id = None
+        for session in self.invited:
+            session.invitation_withdrawn(self)
+        self.invited = list()
+        self._send(dictdata={'type': GroupCreationReject.TYPE, 'ack':0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+
     def group_invitation_request(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             log.info('[Group Invitation Request] username={}, group_id={}, client_ids={}'.format(self.username, self.group_id, message.options.client_id))
-            for session in self.server.session_list:
-                if (session.client_id == message.options.client_id):
-                    if (session.invited_by == None): # client is not being invited at this moment
-                        session.invited_by = self
-                        session.invitation_timer = threading.Timer(self.GROUP_TIMER, session.group_invitation_reject, [])
-                        session.invitation_timer.start()
-                        session._send(dictdata={'type': GroupInvitationRequest.TYPE, 'ack': 0, 'source_id': message.source_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': message.options.type, 'group_id': self.group_id, 'client_id': session.client_id}})
-                    else: # notify that user rejected invitation because he's waiting for other invitation
-                        self._send(dictdata={'type': GroupInvitationReject.TYPE, 'ack': 0, 'source_id': message.source_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': message.options.type, 'group_id': self.group_id}})
-                    break # only one user
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+            session = self.server.sessions.get(message.options.client_id) # only one user
+            if (session):
+                session.invite(self, False, message.source_id, self.NO_GROUP_ID, message.options.type, self.group_id)
+        self._send_ack(message)
 
-    def group_invitation_accept(self, message):
-        if (message.sequence != self.last_seq_recv):
-            log.info('[Invitation Accept] username={}, group_id={}'.format(self.username, message.options.group_id))
-            self.group_id = message.options.group_id
-            self.group_type = message.options.type
-            self.invitation_timer.cancel()
-            if (self.invited_by.creating_group):
-                self.invited_by.group_creation_accept(message.options.type, message.options.group_id)
+    # Invitation to join a group (inviter = session of the user who invites, creation = the group is being created)
+    # Sessions of other workers are called in the same way (see Cluster), so they only use methods of each other
+    def invite(self, inviter, creation, source_id, group_id, group_type, new_group_id):
+        if (not self._can_join(inviter, new_group_id)):
+            log.info('[Group Invitation] (Failed -> wide IDs) username={}, group_id={}'.format(self.username, new_group_id))
+            if (creation):
+                inviter.group_creation_reject()
+            else:
+                inviter.group_invitation_rejected(source_id, group_type, new_group_id)
+        elif (creation or (self.invited_by == None)): # client is not being invited at this moment
+            self.invited_by = inviter
+            self.invited_group_id = new_group_id
+            # set a timer, _creation_invitation_expired (group_creation_reject of the sender) or group_invitation_reject will be called when it expires
+            if (creation):
+                self.invitation_timer = self.scheduler.call_later(self.GROUP_TIMER, self._creation_invitation_expired, inviter)
             else:
-                print('\033[1mUser {} changed to group {}\033[0m'.format(self.username, self.group_id))
-                self._send(dictdata={'type': GroupInvitationAccept.TYPE, 'ack': 0, 'source_id': message.source_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': message.options.type, 'group_id': message.options.group_id, 'client_id': self.client_id}}) # send invitation accept back
+                self.invitation_timer = self.scheduler.call_later(self.GROUP_TIMER, self.group_invitation_reject)
+            self._send(dictdata={'type': GroupInvitationRequest.TYPE, 'ack': 0, 'source_id': source_id, 'group_id': group_id, 'options': {'type': group_type, 'group_id': new_group_id, 'client_id': self.client_id}})
+        else: # notify that user rejected invitation because he's waiting for other invitation
+            inviter.group_invitation_rejected(source_id, group_type, new_group_id)
+
+    # Our invitation to a group being created expired, the creator stops waiting for us
+    def _creation_invitation_expired(self, inviter):
+        if (self.invited_by is inviter):
             self.invited_by = None
-            for session in self.server.session_list:
-                if (session != self):
-                    session.update_list([self])
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+            self.invited_group_id = None
+        inviter.group_creation_reject()
+
+    # The creation of the group was cancelled (or it expired), the invitation can no longer be accepted
+    def invitation_withdrawn(self, inviter):
+        if (self.invited_by is inviter):
+            self.invitation_timer.cancel()
+            self.invited_by = None
+            self.invited_group_id = None
+
+    # True if we are invited to this group now
+    def _invited_to(self, group_id):
+        return ((self.invited_by is not None) and (self.invited_group_id == group_id))
+
+    # Users without wide IDs only share a group with users (and group IDs) of 8 bits, so everybody knows the others
+    def _can_join(self, inviter, group_id):
+        members = self.server.sessions.members(group_id) + [inviter]
+        if (not self.wide):
+            return InstantProtocolMessage.fits(group_id, *[member.client_id for member in members])
+        if (not InstantProtocolMessage.fits(self.client_id)):
+            return all(member.wide for member in members)
+        return True
+
+    # The invited user joined our group (it creates the group if it was being created)
+    def invitation_accepted(self, invited, source_id, group_type, group_id):
+        if (self.creating_group and (group_id == self.new_group_id)):
+            self.group_creation_accept(group_type, group_id)
+        elif (group_id == self.group_id):
+            invited.group_invitation_joined(source_id, group_type, group_id)
+        else: # the creation was cancelled while the accept of another worker was on its way -> the user goes back
+            invited.group_dissolution()
+
+    # The invited user rejected our invitation
+    def invitation_rejected(self, source_id, group_type, group_id):
+        if (self.creating_group):
+            self.group_creation_reject()
+        else: # inviting
+            self.group_invitation_rejected(source_id, group_type, group_id)
+
+    def group_invitation_joined(self, source_id, group_type, group_id):
+        print('\033[1mUser {} changed to group {}\033[0m'.format(self.username, self.group_id))
+        self._send(dictdata={'type': GroupInvitationAccept.TYPE, 'ack': 0, 'source_id': source_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': group_type, 'group_id': group_id, 'client_id': self.client_id}}) # send invitation accept back
+
+    # Notify to the user who invited that the invitation has been rejected (our group if the invitation expired)
+    def group_invitation_rejected(self, source_id, group_type=None, group_id=None):
+        if (group_type is None):
+            group_type, group_id = self.group_type, self.group_id
+        self._send(dictdata={'type': GroupInvitationReject.TYPE, 'ack': 0, 'source_id': source_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': group_type, 'group_id': group_id}})
+
+    # The client changes of group when it accepts, so a late accept (creation cancelled, invitation expired) sends it back
+    def group_invitation_accept(self, message):
+        if (self._is_new(message)):
+            if (not self._invited_to(message.options.group_id)):
+                log.info('[Invitation Accept] (Failed -> invitation expired) username={}, group_id={}'.format(self.username, message.options.group_id))
+                self.group_dissolution()
+            else:
+                log.info('[Invitation Accept] username={}, group_id={}'.format(self.username, message.options.group_id))
+                self.group_id = message.options.group_id
+                self.group_type = message.options.type
+                self.invitation_timer.cancel()
+                self.invited_by.invitation_accepted(self, message.source_id, message.options.type, message.options.group_id)
+                self.invited_by = None
+                self.invited_group_id = None
+                for session in self.server.sessions.fanout():
+                    if (session != self):
+                        session.update_list([self])
+        self._send_ack(message)
 
     def group_invitation_reject(self, message=None):
         # the session that has sent the invitation (creating group or invited), session in which the timer was expired calls the session that invites
         if (message): # message reception
-            if (message.sequence != self.last_seq_recv):
+            if (self._is_new(message) and self._invited_to(message.options.group_id)): # (nothing to do if it expired)
                 log.info('[Group Invitation Reject] username={}, group_id={}'.format(self.username, message.options.group_id))
                 self.invitation_timer.cancel()
-                if (self.invited_by.creating_group):
-                    self.invited_by.group_creation_reject()
-                else: # inviting
-                    self.invited_by._send(dictdata={'type': GroupInvitationReject.TYPE, 'ack': 0, 'source_id': message.source_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': message.options.type, 'group_id': message.options.group_id}}) # notify to the session that invited that the invitation has been rejected
+                self.invited_by.invitation_rejected(message.source_id, message.options.type, message.options.group_id)
                 self.invited_by = None # remove state of invitation
-            self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+                self.invited_group_id = None
+            self._send_ack(message)
         else: # timer expires in session who is being invited (this session)
             # we send rejection anyway (even if it is send when timer expires)
-            self.invited_by._send(dictdata={'type': GroupInvitationReject.TYPE, 'ack': 0, 'source_id': self.client_id, 'group_id': self.NO_GROUP_ID, 'options': {'type': self.invited_by.group_type, 'group_id': self.invited_by.group_id}}) # notify to the session that invited that the invitation has been rejected
+            self.invited_by.group_invitation_rejected(self.client_id)
             self.invited_by = None
+            self.invited_group_id = None
 
     def group_disjoint_request(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             log.info('[Disjoint Request] username={}'.format(self.username))
             print('\033[1mUser {} leaved from group {}\033[0m'.format(self.username, self.group_id))
             old_group_id = self.group_id
             self.group_id = self.PUBLIC_GROUP_ID
             self.group_type = self.PUBLIC_GROUP_TYPE
             # Send update to all users
-            for session in self.server.session_list:
+            for session in self.server.sessions.fanout():
                 if (session != self):
                     session.update_list([self])
             # Count if there are enough clients in the group
-            users_group = 0
-            last_session = None
-            for session in self.server.session_list:
-                if (session.group_id == old_group_id):
-                    users_group += 1
-                    last_session = session
-            if (users_group == 1): # minimum 2 users per group (1 has left so...)
-                last_session.group_dissolution() # disolve group
-        self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+            if (self.server.sessions.group_size(old_group_id) == 1): # minimum 2 users per group (1 has left so...)
+                self.server.sessions.members(old_group_id)[0].group_dissolution() # disolve group
+        self._send_ack(message)
 
     def group_dissolution(self):
         log.info('[Group Dissolution] username={}'.format(self.username))
@@ -179,101 +333,133 @@ class ServerSession(object):
         self.group_type = self.PUBLIC_GROUP_TYPE
         self._send(dictdata={'type': GroupDissolution.TYPE, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': self.group_id})
         # Send update to all users
-        for session in self.server.session_list:
+        for session in self.server.sessions.fanout():
             if (session != self):
                 session.update_list([self])
 
+    # Changes of other users (connection, group) are not sent at once: every change received during the window
+    # (or while our queue is busy) is sent in one Update List with the last state of each user
     def update_list(self, updated_sessions):
-        log.info('[Update List] username={}'.format(self.username))
-        users = list()
-        for us in updated_sessions:
-            item = dict(client_id=us.client_id, group_id=us.group_id, username=us.username, ip_address=us.address[0], port=us.address[1])
-            users.append(item)
-        self._send(dictdata={'type': UpdateList.TYPE, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': 0xFF, 'options': {'user_list': users}})
+        for session in updated_sessions:
+            self.presence[session.client_id] = session
+        if ((self.presence_timer is None) and (not self.presence_due)): # first change
+            self.presence_since = time.time()
+            if (self.PRESENCE_WINDOW):
+                self.presence_timer = self.scheduler.call_later(self.PRESENCE_WINDOW, self._presence_window)
+            else: # no window, sent at once
+                self._presence_window()
+
+    def _presence_window(self):
+        self.presence_timer = None
+        self.presence_due = True
+        self._send_presence()
+
+    # Also called when our messages are acknowledged (the queue may be free now)
+    def _send_presence(self):
+        if ((not self.presence_due) or (self not in self.server.sessions)): # disconnected meanwhile
+            return
+        if ((self.message_queue.control or (not self._can_send())) and (time.time() - self.presence_since < self.PRESENCE_MAX_DELAY)): # busy
+            return
+        users = [us.user_info() for us in self.presence.values() if (us in self.server.sessions)]
+        self.presence.clear()
+        self.presence_due = False
+        wide = any(user['record'] is None for user in users)
+        if (wide and (not self.wide)): # users with wide IDs are not known without them
+            users = [user for user in users if (user['record'] is not None)]
+            wide = False
+        if (users):
+            log.info('[Update List] username={}, users={}'.format(self.username, len(users)))
+            for chunk in UpdateList.split(users, wide): # several Update List if they don't fit in a datagram
+                self._send(dictdata={'type': UpdateList.TYPE, 'wide': wide, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': 0xFF, 'options': {'user_list': chunk}})
+
+    # Entry of this user in the lists, the packed records are only computed again when the group changes
+    def user_info(self):
+        if ((self._user_info is None) or (self._user_info['group_id'] != self.group_id)):
+            self._user_info = dict(client_id=self.client_id, group_id=self.group_id, username=self.username, ip_address=self.address[0], port=self.address[1])
+            self._user_info['record'] = UserListResponse.pack_record(self._user_info) if (InstantProtocolMessage.fits(self.client_id, self.group_id)) else None
+            self._user_info['wide_record'] = UserListResponse.pack_record(self._user_info, True)
+        return self._user_info
 
     def update_disconnection(self, old_session):
         log.info('[Update Disconnection] username={}'.format(old_session.username))
+        self.presence.pop(old_session.client_id, None) # a pending change would be received after the disconnection
+        if ((not self.wide) and (not InstantProtocolMessage.fits(old_session.client_id))): # we never told this user about it
+            return
         self._send(dictdata={'type': UpdateDisconnection.TYPE, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': 0xFF, 'options': {'client_id': old_session.client_id}})
 
+    # Probe of an idle client: every client acknowledges an (empty) Update List, if it doesn't the session
+    # expires (nothing is sent while other messages wait for their ACK, they expire in the same way)
+    def keepalive(self):
+        if ((self.state != self.STATE_PENDING_CONN) and (not self.in_flight) and (self in self.server.sessions)):
+            log.debug('[Keepalive] username={}'.format(self.username))
+            self._send(dictdata={'type': UpdateList.TYPE, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': 0xFF, 'options': {'user_list': []}})
+
     def disconnection_request(self, message):
-        if (message.sequence != self.last_seq_recv):
+        if (self._is_new(message)):
             log.info('[Disconnection] (Requested by user) username={}, id={}'.format(self.username, self.client_id))
             print('\033[1mUser {} disconnected\033[0m'.format(self.username))
-            self._send(dictdata={'type': message.type, 'sequence': message.sequence, 'ack': 1, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID})
+            self._send_ack(message)
             # Count if there are enough clients in the group (same as Group Disjoint)
-            if (self.group_id != self.PUBLIC_GROUP_ID):
-                users_group = 0
-                last_session = None
-                for session in self.server.session_list:
-                    if ((session != self) and (self.group_id == session.group_id)):
-                        users_group += 1
-                        last_session = session
-                if (users_group == 1): # minimum 2 users per group (1 has left so...)
-                    last_session.group_dissolution() # disolve group
+            if ((self.group_id != self.PUBLIC_GROUP_ID) and (self.server.sessions.group_size(self.group_id) == 2)): # minimum 2 users per group (1 is leaving so...)
+                for session in self.server.sessions.members(self.group_id):
+                    if (session != self):
+                        session.group_dissolution() # disolve group
             # Send update to all users
-            for session in self.server.session_list:
+            for session in self.server.sessions.fanout():
                 if (session != self):
                     session.update_disconnection(self)
-            self.server.session_list.remove(self) # remove itself from the list
+            self.server.sessions.remove(self) # remove itself from the directory
 
     def acknowledgement(self, message):
-        #log.debug(self.server.session_list)
-        if (message.sequence == self.last_seq_sent): # it can be for connection or any other message
+        #log.debug(self.server.sessions)
+        if (self._acknowledges(message)): # it can be for connection or any other message
             if (self.state == self.STATE_PENDING_CONN): # Session is created now and all other clients are notified
-                for session in self.server.session_list:
+                self.server.pending.discard(self)
+                for session in self.server.sessions.fanout():
                     if (session != self):
                         session.update_list([self])
                 log.info('[Connection] username={}, id={}'.format(self.username, self.client_id))
-                log.debug(self.server.session_list)
+                log.debug(self.server.sessions)
 
-            # Normal behavior -> Stop & Wait (I only wait for one message to be acknowledgement)
             log.debug('[ACK] ACK received')
-            self.state = self.STATE_IDLE
-            self.timer.cancel() # stop timer
-            #log.debug('[STATE_ACK] Stop timer -> {}'.format(message))
-            if (len(self.message_queue)): # send first message in queue if exists
-                self._send(self.message_queue.pop(0))
-
-    # Private function (send with reliability)
-    def _send(self, dictdata, retry=5):
-        # When ACK not UDP reliability
-        if (dictdata.get('ack') == 0x01):
-            self.last_seq_recv = dictdata.get('sequence') # if we send an ACK, we are acknowledging the last sequence
-            message = InstantProtocolMessage(dictdata=dictdata)
-            log.debug('[---] Sending ACK -> {}'.format(message))
-            self.server.sock.sendto(message.serialize(), self.address)
-        ## UDP reliability
-        # First attempt
-        elif (retry == 5):
-            # Can we send?
-            if ((self.state == self.STATE_IDLE) or (self.state == self.STATE_PENDING_CONN)):
-                self.last_seq_sent = 1 - self.last_seq_sent # swap: 0 to 1 and viceversa
-                dictdata['sequence'] = self.last_seq_sent # set sequence (different each message)
-                message = InstantProtocolMessage(dictdata=dictdata)
-                log.debug('[STATE_IDLE] Sending message (retry={}) -> {}'.format(retry, message))
-                self.server.sock.sendto(message.serialize(), self.address)
-                if (self.state == self.STATE_IDLE):
-                    self.state = self.STATE_ACK
-                # Timer to resend
-                self.timer = threading.Timer(self.RESEND_TIMER, self._send, [dictdata, retry - 1])
-                self.timer.start()
-
-            else: # self.state == self.STATE_ACK
-                log.debug('[STATE_ACK] Message queued') # don't show the message because it doesn't have sequence yet
-                self.message_queue.append(dictdata)
-
-        elif (retry > -1): # next attempts
-            message = InstantProtocolMessage(dictdata=dictdata) # dictada has sequence
-            log.debug('[STATE_IDLE] Sending message (retry={}) -> {}'.format(retry, message))
-            self.server.sock.sendto(message.serialize(), self.address)
-            self.timer = threading.Timer(self.RESEND_TIMER, self._send, [dictdata, retry - 1])
-            self.timer.start()
-
-        elif (retry == -1): # last attempt expired
-            if (self.state != self.STATE_PENDING_CONN): # the user is not connected yet
-                for s in self.server.session_list:
-                    if (s != self):
-                        s.update_disconnection(self)
-            log.info('[Disconnection] (Timer expired) username={}, id={}'.format(self.username, self.client_id))
-            if (self in self.server.session_list): # sometimes the user is desconnected before but the Threads continue (Disconnection Request)
-                self.server.session_list.remove(self) # remove itself from the list
+            self._acknowledged(message.sequence)
+            self._send_presence()
+
+    def _local_id(self):
+        return self.SERVER_ID
+
+    def _sendto(self, frame):
+        self.server.sock.sendto(frame, self.address)
+
+    # Nothing else is sent until the Connection Accept is acknowledged (the client is only waiting for it)
+    def _can_send(self):
+        if (self.state == self.STATE_PENDING_CONN):
+            return (not self.in_flight)
+        return super(ServerSession, self)._can_send()
+
+    # A session waiting for the ACK of its Connection Accept holds a place in max_pending, it gives up sooner
+    # (3.5 s) so a flood of requests doesn't keep the others out (a new request of the client starts again)
+    def _retry_limit(self):
+        if (self.state == self.STATE_PENDING_CONN):
+            return self.CONNECT_RETRIES
+        return super(ServerSession, self)._retry_limit()
+
+    # Last attempt expired -> the user is disconnected
+    # The username was accepted by a lower worker at the same time (see Cluster), this session is removed as if it expired
+    # (a client waiting for the Connection Accept gives up, a connected one stops when its messages are not acknowledged)
+    def username_taken(self):
+        log.info('[Connection] (Failed -> username already taken in another worker) username={}, id={}'.format(self.username, self.client_id))
+        del self.in_flight[:] # nothing else is resent to this client
+        self.message_queue.control.clear()
+        self.message_queue.data.clear()
+        message_reject = InstantProtocolMessage(dictdata={'type': ConnectionReject.TYPE, 'sequence': 0, 'ack': 0, 'source_id': self.SERVER_ID, 'group_id': self.NO_GROUP_ID, 'options': {'error': 1}})
+        self.server.sock.sendto(message_reject.serialize(), self.address)
+        self._expired()
+
+    def _expired(self):
+        if (self.state != self.STATE_PENDING_CONN): # the user is not connected yet
+            for s in self.server.sessions.fanout():
+                if (s != self):
+                    s.update_disconnection(self)
+        log.info('[Disconnection] (Timer expired) username={}, id={}'.format(self.username, self.client_id))
+        self.server.sessions.remove(self) # remove itself from the directory (sometimes the user is desconnected before but the timers continue)
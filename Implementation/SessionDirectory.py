@@ -0,0 +1,148 @@
+# SessionDirectory.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import threading
+from collections import OrderedDict
+
+# Sessions of the server indexed by client ID, username, address and group (every lookup is O(1))
+# Iteration follows the connection order (as the old list) over a copy, so sessions can be
+# removed while iterating (timers remove expired sessions from another thread)
+class SessionDirectory(object):
+    def __init__(self):
+        self.by_id = OrderedDict() # client_id -> session
+        self.by_username = dict() # username -> session
+        self.by_address = dict() # (ip_address, port) -> session
+        self.groups = dict() # group_id -> set of sessions (members)
+        self.version = 0 # changes every time a session is added, removed or changes of group (see UserListSnapshot)
+        self.on_remove = None # called with the session when it is removed
+        self.on_empty_group = None # called with the group ID when its last member leaves it (see IdAllocator)
+
+    # A username already used keeps its session (two workers of a cluster can accept the same one, see Cluster)
+    def add(self, session):
+        self.by_id[session.client_id] = session
+        self.by_username.setdefault(session.username, session)
+        self.by_address[session.address] = session
+        self.groups.setdefault(session.group_id, set()).add(session)
+        self.version += 1
+
+    # Nothing happens if the session was already removed (disconnection and timer at the same time)
+    def remove(self, session):
+        if (self.by_id.get(session.client_id) is session):
+            del self.by_id[session.client_id]
+            if (self.by_username.get(session.username) is session): # (the entries can belong to another session)
+                del self.by_username[session.username]
+            if (self.by_address.get(session.address) is session):
+                del self.by_address[session.address]
+            self._leave(session, session.group_id)
+            self.version += 1
+            if (self.on_remove):
+                self.on_remove(session)
+
+    # The session has changed its group (called by the session when its group_id is set)
+    def change_group(self, session, old_group_id):
+        if (session in self):
+            self._leave(session, old_group_id)
+            self.groups.setdefault(session.group_id, set()).add(session)
+            self.version += 1
+
+    def _leave(self, session, group_id):
+        members = self.groups[group_id]
+        members.discard(session)
+        if (not members): # nobody in the group
+            del self.groups[group_id]
+            if (self.on_empty_group):
+                self.on_empty_group(group_id)
+
+    def get(self, client_id):
+        return self.by_id.get(client_id)
+
+    def get_by_username(self, username):
+        return self.by_username.get(username)
+
+    def get_by_address(self, address):
+        return self.by_address.get(address)
+
+    # Sessions of the group (copy, the group can change while it is used)
+    def members(self, group_id):
+        return list(self.groups.get(group_id, ()))
+
+    # Sessions which receive what is sent to a group (every session if None)
+    def fanout(self, group_id=None):
+        return self.members(group_id) if (group_id is not None) else self.by_id.values()
+
+    def group_size(self, group_id):
+        return len(self.groups.get(group_id, ()))
+
+    def __contains__(self, session):
+        return (self.by_id.get(session.client_id) is session)
+
+    def __iter__(self):
+        return iter(self.by_id.values()) # list (copy) in Python 2
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __repr__(self):
+        return 'SessionDirectory({})'.format(self.by_id.values())
+
+# Sessions of this process by second of their last message, oldest second first: the idle ones are found
+# without visiting the others (O(idle)), a message only moves its session when the second has changed
+# (locked: the threads engine receives and serves the timers in different threads)
+class IdleIndex(object):
+    def __init__(self):
+        self.last = dict() # session -> second of its last message
+        self.seconds = OrderedDict() # second -> set of sessions (oldest first)
+        self.lock = threading.Lock()
+
+    def touch(self, session, now):
+        second = int(now)
+        if (self.last.get(session) == second): # already there (most messages)
+            return
+        with self.lock:
+            self._remove(session)
+            self.last[session] = second
+            members = self.seconds.get(second)
+            if (members is None):
+                members = self.seconds[second] = set()
+            members.add(session)
+
+    def discard(self, session):
+        with self.lock:
+            self._remove(session)
+
+    # Sessions without any message since then (oldest first), they leave the index until they are touched again
+    def idle(self, since):
+        idle = list()
+        with self.lock:
+            while (self.seconds):
+                second, members = next(self.seconds.iteritems())
+                if (second >= int(since)):
+                    break
+                del self.seconds[second]
+                for session in members:
+                    del self.last[session]
+                idle.extend(members)
+        return idle
+
+    # Second of the oldest message (None without sessions)
+    def oldest(self):
+        with self.lock:
+            while (self.seconds):
+                second, members = next(self.seconds.iteritems())
+                if (members):
+                    return second
+                del self.seconds[second] # every session left it
+        return None
+
+    def _remove(self, session):
+        second = self.last.pop(session, None)
+        if (second is not None):
+            self.seconds[second].discard(session) # (an empty second is removed by idle)
+
+    def __len__(self):
+        return len(self.last)
+
+    def __repr__(self):
+        return 'IdleIndex(sessions={}, seconds={})'.format(len(self.last), len(self.seconds))
@@ -6,24 +6,43 @@
 import socket
 import random
 import logging as log
-
+
+from Metrics import *
+
+_SENT = METRICS.counter('socket.sent')
+_LOST = METRICS.counter('socket.lost') # simulated loss
+
 class SocketError(object):
     def __init__(self, domain, transport, probability):
         self.sock = socket.socket(domain, transport)
-        self.error = probability
-
-    def sendto(self, *p):
-        test = random.random()
-        if test > self.error:
+        self.error = probability
+
+    def sendto(self, *p):
+        test = random.random()
+        if test > self.error:
+            _SENT.inc()
             return self.sock.sendto(*p)
-        else :
+        else :
+            _LOST.inc()
             log.warn('\033[1m[-+-]Packet loss\033[0m')
-
-    def recvfrom(self, *p):
+
+    def recvfrom(self, *p):
         return self.sock.recvfrom(*p)
 
+    def recvfrom_into(self, *p):
+        return self.sock.recvfrom_into(*p)
+
     def close(self):
         return self.sock.close()
-
-    def bind(self, addr):
+
+    def setsockopt(self, *p):
+        return self.sock.setsockopt(*p)
+
+    def bind(self, addr):
         return self.sock.bind(addr)
+
+    def setblocking(self, flag):
+        return self.sock.setblocking(flag)
+
+    def fileno(self):
+        return self.sock.fileno()
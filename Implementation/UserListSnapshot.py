@@ -0,0 +1,62 @@
+# UserListSnapshot.py
+# Copyright (C) 2017
+# Jesus Alberto Polo <jesus.pologarcia@imt-atlantique.net>
+# Erika Tarazona <erika.tarazona@imt-atlantique.net>
+
+import logging as log
+
+from InstantProtocol import *
+
+# User List Response of every session of the directory, serialized once for each version of the directory
+# (it changes when a session is added, removed or changes of group) and sent as it is to every request
+# The list is split in chunks of UserListResponse.MAX_SIZE bytes, the records of the users are shared
+# by the responses of every group, only the header (Group ID) is different
+# Sessions without wide IDs receive the users of 8-bit IDs, the others receive every user (wide records if needed)
+class UserListSnapshot(object):
+    SERVER_ID = 0x00
+
+    def __init__(self, sessions):
+        self.sessions = sessions # SessionDirectory
+        self.version = None # version of the directory of the cached frames
+        self.users = list() # entries of the users (with their packed records)
+        self.narrow = True # every user has 8-bit IDs
+        self.chunks = dict() # wide -> entries of the users of each chunk
+        self.frames = dict() # (group_id, wide) -> list of frames of each chunk (sequence 0 and 1)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'UserListSnapshot(version={}, groups={}, users={}, narrow={}, hits={}, misses={})'.format(
+            self.version, len(self.frames), len(self.users), self.narrow, self.hits, self.misses)
+
+    # Frames of the chunks of the response for a session of the group (see ReliableSession._send_frames)
+    # wide = the session supports wide IDs
+    def get(self, group_id, wide=False):
+        version = self.sessions.version # read before the sessions (they can change meanwhile, then the next request misses)
+        if (version != self.version):
+            log.debug('[User List] new snapshot version={}'.format(version))
+            self.frames.clear()
+            self.chunks.clear()
+            self.users = [user.user_info() for user in self.sessions]
+            self.narrow = all(user['record'] is not None for user in self.users)
+            self.version = version
+        wide = wide and ((not self.narrow) or (not InstantProtocolMessage.fits(group_id))) # 8 bits while they are enough
+        frames = self.frames.get((group_id, wide))
+        if (frames is None):
+            self.misses += 1
+            chunks = self._chunks(wide)
+            frames = [InstantProtocolMessage.sequence_variants(InstantProtocolMessage.encode({'type': UserListResponse.TYPE, 'wide': wide, 'sequence': 0, 'ack': 0,
+                        'source_id': self.SERVER_ID, 'group_id': group_id, 'options': {'user_list': chunk, 'chunk': i, 'chunks': len(chunks)}}))
+                        for i, chunk in enumerate(chunks)]
+            self.frames[(group_id, wide)] = frames
+        else:
+            self.hits += 1
+        return frames
+
+    # Users split in chunks, shared by the responses of every group
+    def _chunks(self, wide):
+        chunks = self.chunks.get(wide)
+        if (chunks is None):
+            users = self.users if (wide) else [user for user in self.users if (user['record'] is not None)]
+            chunks = self.chunks[wide] = UserListResponse.split(users, wide)
+        return chunks